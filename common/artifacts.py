@@ -0,0 +1,204 @@
+"""
+Debug artifact sink (sales XML, extract_all JSON/HTML, worker responses).
+
+Steps call put() and return immediately; a background thread drains a bounded queue
+and writes artifacts in batches (GitHub: one commit per batch via the Git Data API).
+When the queue is full the artifact is dropped and counted — debug output must
+never slow down or fail a run.
+
+Env:
+  ARTIFACT_SINK              github | local | none  (default: github if GITHUB_TOKEN else none)
+  ARTIFACT_DIR               local sink root (default <LOCAL_DATA_DIR>/artifacts)
+  ARTIFACT_QUEUE_MAX         queued artifacts before dropping (500)
+  ARTIFACT_BATCH_MAX         artifacts per flush / commit (50)
+  ARTIFACT_FLUSH_INTERVAL_S  max wait to fill a batch (2.0)
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+from common import github_api
+from common.local_db import data_path
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except Exception:
+        return default
+
+
+QUEUE_MAX = _env_int("ARTIFACT_QUEUE_MAX", 500)
+BATCH_MAX = _env_int("ARTIFACT_BATCH_MAX", 50)
+try:
+    FLUSH_INTERVAL_S = float(os.getenv("ARTIFACT_FLUSH_INTERVAL_S") or 2.0)
+except Exception:
+    FLUSH_INTERVAL_S = 2.0
+
+
+class ArtifactBackend(ABC):
+    name = "base"
+
+    @abstractmethod
+    def write_batch(self, files: Dict[str, bytes], messages: List[str]) -> Tuple[int, Optional[str]]:
+        ...
+
+
+class LocalDirBackend(ArtifactBackend):
+    name = "local"
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or os.getenv("ARTIFACT_DIR") or data_path("artifacts")
+
+    def write_batch(self, files, messages):
+        for path, data in files.items():
+            target = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp = f"{target}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, target)
+        return 200, None
+
+
+class GitHubBackend(ArtifactBackend):
+    name = "github"
+
+    def write_batch(self, files, messages):
+        token = os.getenv("GITHUB_TOKEN") or ""
+        if len(messages) == 1:
+            message = messages[0]
+        else:
+            message = f"debug: {len(files)} artifacts"
+        st, info = github_api.commit_files(token, files, message)
+        return st, (None if st in (200, 201) else str(info)[:500])
+
+
+class ArtifactSink:
+    """Bounded queue + one background writer thread around an ArtifactBackend."""
+
+    def __init__(self, backend: ArtifactBackend, maxsize: int = QUEUE_MAX):
+        self.backend = backend
+        self.name = backend.name
+        self._q: "queue.Queue[Tuple[str, bytes, str]]" = queue.Queue(maxsize=maxsize)
+        self._cv = threading.Condition()
+        self._unfinished = 0
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"queued": 0, "dropped": 0, "written": 0, "failed": 0, "batches": 0}
+        self.last_error: Optional[str] = None
+
+    def put(self, path: str, data: bytes, message: str = "") -> str:
+        """Enqueue and return at once: 'queued' or 'dropped' (queue full)."""
+        with self._cv:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name=f"artifacts-{self.name}", daemon=True)
+                self._thread.start()
+            try:
+                self._q.put_nowait((path, data, message))
+            except queue.Full:
+                self.stats["dropped"] += 1
+                return "dropped"
+            self._unfinished += 1
+            self.stats["queued"] += 1
+        return "queued"
+
+    def _next_batch(self) -> List[Tuple[str, bytes, str]]:
+        batch = [self._q.get()]
+        deadline = time.monotonic() + FLUSH_INTERVAL_S
+        while len(batch) < BATCH_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=left))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            files: Dict[str, bytes] = {}
+            messages: List[str] = []
+            for path, data, message in batch:
+                files[path] = data  # same path twice in one batch -> newest wins
+                if message:
+                    messages.append(message)
+            try:
+                st, err = self.backend.write_batch(files, messages)
+                ok = st in (200, 201)
+                self.last_error = None if ok else f"{st}: {err}"
+            except Exception as e:
+                ok = False
+                self.last_error = f"{type(e).__name__}: {e}"
+            with self._cv:
+                self.stats["batches"] += 1
+                self.stats["written" if ok else "failed"] += len(files)
+                self._unfinished -= len(batch)
+                self._cv.notify_all()
+
+    def flush(self, timeout_s: float = 30.0) -> bool:
+        """Block until everything queued so far is written (or timeout)."""
+        deadline = time.monotonic() + timeout_s
+        with self._cv:
+            while self._unfinished > 0:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cv.wait(left)
+        return True
+
+
+class NullSink:
+    name = "none"
+    stats: Dict[str, int] = {}
+
+    def put(self, path: str, data: bytes, message: str = "") -> str:
+        return "disabled"
+
+    def flush(self, timeout_s: float = 30.0) -> bool:
+        return True
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def _build():
+    kind = (os.getenv("ARTIFACT_SINK") or ("github" if os.getenv("GITHUB_TOKEN") else "none")).strip().lower()
+    if kind == "github":
+        return ArtifactSink(GitHubBackend())
+    if kind == "local":
+        return ArtifactSink(LocalDirBackend())
+    return NullSink()
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = _build()
+    return _sink
+
+
+def put(path: str, data: bytes, message: str = "") -> str:
+    return get_sink().put(path, data, message)
+
+
+def enabled() -> bool:
+    return get_sink().name != "none"
+
+
+def shutdown(timeout_s: float = 30.0) -> bool:
+    """Flush pending artifacts (gunicorn worker_exit / interpreter exit)."""
+    if _sink is None:
+        return True
+    return _sink.flush(timeout_s)
+
+
+atexit.register(shutdown)
@@ -0,0 +1,131 @@
+"""
+Persistent TTL/LRU cache for PayTraq client data (client record, contacts, shipping
+addresses, banks), keyed by (ClientID, endpoint). Backed by SQLite so it survives
+restarts; only successful XML bodies are cached.
+
+Env:
+  CLIENT_CACHE               1 (default) / 0 to disable
+  CLIENT_CACHE_PATH          sqlite file (default <LOCAL_DATA_DIR>/client_cache.sqlite3)
+  CLIENT_CACHE_TTL_S         entry lifetime in seconds (3600)
+  CLIENT_CACHE_MAX_ENTRIES   LRU bound on rows (20000)
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from common.local_db import connect, data_path
+
+TTL_S = float(os.getenv("CLIENT_CACHE_TTL_S") or 3600)
+MAX_ENTRIES = int(os.getenv("CLIENT_CACHE_MAX_ENTRIES") or 20000)
+
+_init_lock = threading.Lock()
+_initialized_path: Optional[str] = None
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+
+
+def enabled() -> bool:
+    return (os.getenv("CLIENT_CACHE") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def _path() -> str:
+    return os.getenv("CLIENT_CACHE_PATH") or data_path("client_cache.sqlite3")
+
+
+def _conn():
+    global _initialized_path
+    path = _path()
+    conn = connect(path)
+    if _initialized_path != path:
+        with _init_lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS client_cache ("
+                " client_id TEXT NOT NULL, endpoint TEXT NOT NULL,"
+                " status INTEGER NOT NULL, body TEXT NOT NULL, auth_used TEXT,"
+                " fetched_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (client_id, endpoint))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS client_cache_lru ON client_cache(accessed_at)")
+            _initialized_path = path
+    return conn
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + n
+
+
+def stats() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def get(client_id: str, endpoint: str) -> Optional[Tuple[int, str, str]]:
+    """(status, body, auth_used) if cached and fresh, else None."""
+    now = time.time()
+    conn = _conn()
+    try:
+        row = conn.execute(
+            "SELECT status, body, auth_used, fetched_at FROM client_cache WHERE client_id = ? AND endpoint = ?",
+            (str(client_id), endpoint),
+        ).fetchone()
+        if row is None:
+            _count("misses")
+            return None
+        if now - row[3] > TTL_S:
+            conn.execute("DELETE FROM client_cache WHERE client_id = ? AND endpoint = ?", (str(client_id), endpoint))
+            _count("expired")
+            _count("misses")
+            return None
+        conn.execute(
+            "UPDATE client_cache SET accessed_at = ? WHERE client_id = ? AND endpoint = ?",
+            (now, str(client_id), endpoint),
+        )
+    finally:
+        conn.close()
+    _count("hits")
+    return int(row[0]), row[1], row[2] or "cache"
+
+
+def put(client_id: str, endpoint: str, status: int, body: str, auth_used: str) -> None:
+    now = time.time()
+    conn = _conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO client_cache(client_id, endpoint, status, body, auth_used, fetched_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(client_id, endpoint) DO UPDATE SET status = excluded.status, body = excluded.body,"
+            " auth_used = excluded.auth_used, fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at",
+            (str(client_id), endpoint, int(status), body, auth_used, now, now),
+        )
+        total = conn.execute("SELECT COUNT(*) FROM client_cache").fetchone()[0]
+        if total > MAX_ENTRIES:
+            cur = conn.execute(
+                "DELETE FROM client_cache WHERE rowid IN"
+                " (SELECT rowid FROM client_cache ORDER BY accessed_at ASC LIMIT ?)",
+                (total - MAX_ENTRIES,),
+            )
+            _count("evicted", cur.rowcount or 0)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def invalidate(client_id: Optional[str] = None) -> int:
+    """Drop one client's entries (or everything when client_id is None). Returns rows removed."""
+    conn = _conn()
+    try:
+        if client_id is None:
+            cur = conn.execute("DELETE FROM client_cache")
+        else:
+            cur = conn.execute("DELETE FROM client_cache WHERE client_id = ?", (str(client_id),))
+        n = cur.rowcount or 0
+    finally:
+        conn.close()
+    _count("invalidated", n)
+    return n
@@ -0,0 +1,93 @@
+"""
+Dedupe ledger: doc_id -> canonical hash of the sale XML the worker last acked.
+
+Pending re-checks, document_id overrides and retries can hand the worker the same,
+unchanged sale again; every resend costs Pipedrive API calls. step_06 consults the
+ledger and answers "not modified" when the sale's hash matches the acked entry;
+step_08 records the hash after a successful ack. {"force": true} bypasses it.
+
+The hash is SHA-256 over the C14N 2.0 form of the XML (whitespace-only text
+stripped), so formatting differences between PayTraq responses don't count as
+changes.
+
+Env:
+  DEDUPE_LEDGER        1 (default) / 0 to disable
+  DEDUPE_LEDGER_PATH   sqlite file (default <LOCAL_DATA_DIR>/dedupe_ledger.sqlite3)
+"""
+import hashlib
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, Optional
+
+from common.local_db import connect, data_path
+
+_init_lock = threading.Lock()
+_initialized_path: Optional[str] = None
+
+
+def enabled() -> bool:
+    return (os.getenv("DEDUPE_LEDGER") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def _path() -> str:
+    return os.getenv("DEDUPE_LEDGER_PATH") or data_path("dedupe_ledger.sqlite3")
+
+
+def _conn():
+    global _initialized_path
+    path = _path()
+    conn = connect(path)
+    if _initialized_path != path:
+        with _init_lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ledger ("
+                " doc_id INTEGER PRIMARY KEY, xml_hash TEXT NOT NULL,"
+                " worker_status TEXT, acked_at REAL NOT NULL)"
+            )
+            _initialized_path = path
+    return conn
+
+
+def canonical_hash(xml: str) -> str:
+    try:
+        canon = ET.canonicalize(xml, strip_text=True)
+    except Exception:
+        canon = xml or ""
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+def lookup(doc_id: int) -> Optional[Dict[str, Any]]:
+    conn = _conn()
+    try:
+        row = conn.execute(
+            "SELECT xml_hash, worker_status, acked_at FROM ledger WHERE doc_id = ?", (int(doc_id),)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return {"xml_hash": row[0], "worker_status": row[1], "acked_at": row[2]}
+
+
+def is_acked(doc_id: int, xml_hash: str) -> Optional[Dict[str, Any]]:
+    """The ledger entry if this exact sale content was already acked by the worker."""
+    entry = lookup(doc_id)
+    if entry is not None and entry["xml_hash"] == xml_hash:
+        return entry
+    return None
+
+
+def record_ack(doc_id: int, xml_hash: str, worker_status: Optional[str] = None) -> None:
+    conn = _conn()
+    try:
+        conn.execute(
+            "INSERT INTO ledger(doc_id, xml_hash, worker_status, acked_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(doc_id) DO UPDATE SET xml_hash = excluded.xml_hash,"
+            " worker_status = excluded.worker_status, acked_at = excluded.acked_at",
+            (int(doc_id), xml_hash, worker_status, time.time()),
+        )
+    finally:
+        conn.close()
+
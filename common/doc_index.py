@@ -0,0 +1,193 @@
+"""
+Local index of PayTraq sales: doc_id -> (ref, date, status, client_id).
+
+Filled incrementally whenever a step sees a sale XML and backfillable from the
+recorded debug corpus:
+
+    python -m common.doc_index backfill state/debug
+
+step_02's document_ref / date overrides ask it for the first indexed match
+(first_match, on the ref / date indexes) and fetch from PayTraq only that candidate,
+to verify it, plus the ids below it the index doesn't know (or only as drafts).
+
+Env:
+  DOC_INDEX        1 (default) / 0 to disable
+  DOC_INDEX_PATH   sqlite file (default <LOCAL_DATA_DIR>/doc_index.sqlite3)
+"""
+import glob
+import os
+import re
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from common.local_db import connect, data_path
+from common.sale_document import SaleDocument
+
+_init_lock = threading.Lock()
+_initialized_path: Optional[str] = None
+
+# sqlite caps bound parameters per statement; look ids up in chunks.
+_LOOKUP_CHUNK = 500
+
+
+def enabled() -> bool:
+    return (os.getenv("DOC_INDEX") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def _path() -> str:
+    return os.getenv("DOC_INDEX_PATH") or data_path("doc_index.sqlite3")
+
+
+def _conn():
+    global _initialized_path
+    path = _path()
+    conn = connect(path)
+    if _initialized_path != path:
+        with _init_lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                " doc_id INTEGER PRIMARY KEY, ref TEXT, date TEXT, status TEXT, client_id TEXT,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS docs_ref ON docs(ref)")
+            conn.execute("CREATE INDEX IF NOT EXISTS docs_date ON docs(date)")
+            _initialized_path = path
+    return conn
+
+
+def _row(doc: SaleDocument, doc_id: Optional[int] = None):
+    did = doc.document_id or doc_id
+    if not did:
+        return None
+    return (int(did), doc.ref, doc.date, doc.status, doc.client_id, time.time())
+
+
+def record_many(docs: Iterable[SaleDocument]) -> int:
+    rows = [r for r in (_row(d) for d in docs) if r is not None]
+    if not rows:
+        return 0
+    conn = _conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO docs(doc_id, ref, date, status, client_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(doc_id) DO UPDATE SET ref = excluded.ref, date = excluded.date,"
+            " status = excluded.status, client_id = excluded.client_id, updated_at = excluded.updated_at",
+            rows,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def record(doc: Optional[SaleDocument], doc_id: Optional[int] = None) -> None:
+    """Best-effort upsert of one sale; never raises (indexing must not break a run)."""
+    if doc is None or doc.root is None or not enabled():
+        return
+    try:
+        row = _row(doc, doc_id)
+        if row is None:
+            return
+        conn = _conn()
+        try:
+            conn.execute(
+                "INSERT INTO docs(doc_id, ref, date, status, client_id, updated_at) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(doc_id) DO UPDATE SET ref = excluded.ref, date = excluded.date,"
+                " status = excluded.status, client_id = excluded.client_id, updated_at = excluded.updated_at",
+                row,
+            )
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+
+def lookup(ids: Iterable[int]) -> Dict[int, dict]:
+    """doc_id -> {"ref", "date", "status", "client_id"} for the ids the index knows."""
+    ids = [int(i) for i in ids]
+    out: Dict[int, dict] = {}
+    if not ids or not enabled():
+        return out
+    conn = _conn()
+    try:
+        for i in range(0, len(ids), _LOOKUP_CHUNK):
+            chunk = ids[i:i + _LOOKUP_CHUNK]
+            q = f"SELECT doc_id, ref, date, status, client_id FROM docs WHERE doc_id IN ({','.join('?' * len(chunk))})"
+            for did, ref, date, status, client_id in conn.execute(q, chunk):
+                out[int(did)] = {"ref": ref, "date": date, "status": status, "client_id": client_id}
+    finally:
+        conn.close()
+    return out
+
+
+def first_match(ref: Optional[str], date_from: Optional[str], date_to: Optional[str],
+                lo: int, hi: int, among: Iterable[int]) -> Optional[int]:
+    """Lowest indexed, non-draft doc_id in [lo, hi] and in `among` whose ref / date match
+    (same rules as step_02's override). Drafts are skipped: their ref/date can change."""
+    if not enabled() or not (ref or date_from or date_to):
+        return None
+    wanted = {int(i) for i in among}
+    where = ["doc_id BETWEEN ? AND ?", "COALESCE(status, '') != 'draft'"]
+    args: list = [int(lo), int(hi)]
+    if ref:
+        where.append("ref = ?")
+        args.append(ref)
+    if date_from and date_to:
+        where.append("date BETWEEN ? AND ?")
+        args += [date_from, date_to]
+    elif date_from:
+        where.append("date >= ?")
+        args.append(date_from)
+    elif date_to:
+        where.append("date <= ?")
+        args.append(date_to)
+    conn = _conn()
+    try:
+        for (did,) in conn.execute(f"SELECT doc_id FROM docs WHERE {' AND '.join(where)} ORDER BY doc_id", args):
+            if int(did) in wanted:
+                return int(did)
+    finally:
+        conn.close()
+    return None
+
+
+def backfill_from_dir(path: str, batch: int = 500) -> Dict[str, int]:
+    """Index every state/debug/sales_<id>.xml under `path`."""
+    seen = indexed = failed = 0
+    docs = []
+    for fp in sorted(glob.glob(os.path.join(path, "sales_*.xml"))):
+        m = re.search(r"sales_(\d+)\.xml$", fp)
+        if not m:
+            continue
+        seen += 1
+        try:
+            with open(fp, "r", encoding="utf-8") as f:
+                doc = SaleDocument(f.read())
+        except Exception:
+            failed += 1
+            continue
+        if doc.root is None:
+            failed += 1
+            continue
+        if doc.document_id is None:
+            doc.document_id = int(m.group(1))  # fill the cached property from the file name
+        docs.append(doc)
+        if len(docs) >= batch:
+            indexed += record_many(docs)
+            docs = []
+    indexed += record_many(docs)
+    return {"files": seen, "indexed": indexed, "failed": failed}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "backfill":
+        print(backfill_from_dir(sys.argv[2]))
+    else:
+        print("usage: python -m common.doc_index backfill <dir with sales_*.xml>")
+        sys.exit(2)
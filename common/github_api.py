@@ -0,0 +1,198 @@
+"""
+GitHub repo helpers shared by the state store and debug artifacts.
+
+commit_files() writes any number of files as ONE commit through the Git Data API
+(tree with inline contents -> commit -> fast-forward ref update). The ref update is
+a compare-and-swap (force=false): if someone else moved the branch in between, we
+rebuild on top of the new head and try again. Files whose contents depend on what is
+on the branch (the state cursor, pending list) pass a rebuild callback that
+recomputes them from the new head; without one the same contents are re-sent
+(fine for write-once files like debug artifacts).
+
+Env:
+  GITHUB_TOKEN, GITHUB_OWNER, GITHUB_REPO
+  GITHUB_BRANCH    branch to commit to (default: the repo's default branch)
+  GITHUB_API_URL   API root (default https://api.github.com; point at a fake for offline runs)
+"""
+import base64
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+from common import http_client
+
+DEFAULT_OWNER = "AlendaSIA"
+DEFAULT_REPO = "Jaunais_step0-trigger"
+
+# How many times to rebuild the commit when the ref CAS loses a race.
+COMMIT_ATTEMPTS = 4
+
+_default_branch: Dict[str, str] = {}
+_branch_lock = threading.Lock()
+
+
+def api_url() -> str:
+    return (os.getenv("GITHUB_API_URL") or "https://api.github.com").rstrip("/")
+
+
+def repo_full() -> str:
+    owner = os.getenv("GITHUB_OWNER") or DEFAULT_OWNER
+    repo = os.getenv("GITHUB_REPO") or DEFAULT_REPO
+    return f"{owner}/{repo}"
+
+
+def repo_url(suffix: str = "") -> str:
+    return f"{api_url()}/repos/{repo_full()}{suffix}"
+
+
+def headers(token: str) -> dict:
+    return {
+        "Authorization": f"token {token}",
+        "Accept": "application/vnd.github+json",
+    }
+
+
+def commit_message(message: str) -> str:
+    msg = (message or "").strip()
+    if msg.startswith("[skip ci]"):
+        return msg
+    return f"[skip ci] {msg}"
+
+
+def branch(token: str) -> Optional[str]:
+    env_branch = (os.getenv("GITHUB_BRANCH") or "").strip()
+    if env_branch:
+        return env_branch
+    key = repo_url()
+    if key in _default_branch:
+        return _default_branch[key]
+    r = http_client.get(repo_url(), headers=headers(token), timeout=20)
+    if r.status_code != 200:
+        return None
+    name = (r.json() or {}).get("default_branch")
+    if name:
+        with _branch_lock:
+            _default_branch[key] = name
+    return name
+
+
+def _tree_entry(path: str, content: bytes, token: str) -> Tuple[Optional[dict], Any]:
+    try:
+        text = content.decode("utf-8")
+        return {"path": path, "mode": "100644", "type": "blob", "content": text}, None
+    except UnicodeDecodeError:
+        pass
+    r = http_client.post(
+        repo_url("/git/blobs"),
+        headers=headers(token),
+        json={"content": base64.b64encode(content).decode("ascii"), "encoding": "base64"},
+        timeout=30,
+    )
+    if r.status_code not in (200, 201):
+        return None, (r.status_code, (r.text or "")[:500])
+    return {"path": path, "mode": "100644", "type": "blob", "sha": (r.json() or {}).get("sha")}, None
+
+
+def read_file(token: str, path: str, ref: Optional[str] = None) -> Tuple[Optional[str], int]:
+    """(text, status) of `path` at `ref` (default: branch head); (None, 404) if missing."""
+    params = {"ref": ref} if ref else None
+    r = http_client.get(repo_url(f"/contents/{path}"), headers=headers(token), params=params, timeout=20)
+    if r.status_code != 200:
+        return None, r.status_code
+    data = r.json() or {}
+    if "content" not in data:
+        return None, r.status_code
+    return base64.b64decode(data["content"]).decode("utf-8").strip(), 200
+
+
+# rebuild(read) -> files to commit on the new head, or None to give up.
+# read(path) -> (text, status) at that head.
+Rebuild = Callable[[Callable[[str], Tuple[Optional[str], int]]], Optional[Dict[str, Union[str, bytes]]]]
+
+
+def commit_files(
+    token: str,
+    files: Dict[str, Union[str, bytes]],
+    message: str,
+    rebuild: Optional[Rebuild] = None,
+) -> Tuple[int, Dict[str, Any]]:
+    """Commit all `files` (path -> content) as a single commit on the branch head.
+
+    After a lost ref race, `rebuild` (if given) recomputes the files against the new
+    head; returning None aborts with 409, an empty dict means nothing is left to write.
+
+    Returns (status, info). status is 201 on success (info has commit_sha, attempts),
+    otherwise the failing HTTP status (409 after losing the ref race COMMIT_ATTEMPTS times).
+    """
+    if not files:
+        return 200, {"note": "nothing to commit"}
+    br = branch(token)
+    if not br:
+        return 0, {"error": "cannot resolve branch"}
+    ref_url = repo_url(f"/git/refs/heads/{br}")
+    h = headers(token)
+
+    def build_entries(to_write):
+        out = []
+        for path, content in to_write.items():
+            raw = content.encode("utf-8") if isinstance(content, str) else bytes(content)
+            entry, err = _tree_entry(path, raw, token)
+            if entry is None:
+                return None, (err[0], {"error": "blob create failed", "path": path, "body": err[1]})
+            out.append(entry)
+        return out, None
+
+    entries, failed = build_entries(files)
+    if failed:
+        return failed
+
+    last_status = 0
+    for attempt in range(1, COMMIT_ATTEMPTS + 1):
+        r = http_client.get(repo_url(f"/git/ref/heads/{br}"), headers=h, timeout=20)
+        if r.status_code != 200:
+            return r.status_code, {"error": "ref read failed", "body": (r.text or "")[:500]}
+        head_sha = ((r.json() or {}).get("object") or {}).get("sha")
+
+        if attempt > 1 and rebuild is not None:
+            # Lost the race: recompute from what the other writer committed, never
+            # replay contents that were derived from the old head.
+            files = rebuild(lambda path: read_file(token, path, head_sha))
+            if files is None:
+                return 409, {"error": "ref moved concurrently; rebuild declined", "attempts": attempt}
+            if not files:
+                return 200, {"note": "nothing to commit after rebuild", "attempts": attempt}
+            entries, failed = build_entries(files)
+            if failed:
+                return failed
+
+        r = http_client.get(repo_url(f"/git/commits/{head_sha}"), headers=h, timeout=20)
+        if r.status_code != 200:
+            return r.status_code, {"error": "head commit read failed", "body": (r.text or "")[:500]}
+        base_tree = ((r.json() or {}).get("tree") or {}).get("sha")
+
+        r = http_client.post(
+            repo_url("/git/trees"), headers=h, json={"base_tree": base_tree, "tree": entries}, timeout=30
+        )
+        if r.status_code not in (200, 201):
+            return r.status_code, {"error": "tree create failed", "body": (r.text or "")[:500]}
+        tree_sha = (r.json() or {}).get("sha")
+
+        r = http_client.post(
+            repo_url("/git/commits"),
+            headers=h,
+            json={"message": commit_message(message), "tree": tree_sha, "parents": [head_sha]},
+            timeout=30,
+        )
+        if r.status_code not in (200, 201):
+            return r.status_code, {"error": "commit create failed", "body": (r.text or "")[:500]}
+        commit_sha = (r.json() or {}).get("sha")
+
+        # CAS: only succeeds if the branch still points at head_sha (fast-forward).
+        r = http_client.request("PATCH", ref_url, headers=h, json={"sha": commit_sha, "force": False}, timeout=30)
+        if r.status_code == 200:
+            return 201, {"commit_sha": commit_sha, "attempts": attempt, "files": sorted(files)}
+        last_status = r.status_code
+        if r.status_code not in (409, 422):
+            return r.status_code, {"error": "ref update failed", "body": (r.text or "")[:500]}
+
+    return 409 if last_status in (409, 422) else last_status, {"error": "ref moved concurrently", "attempts": COMMIT_ATTEMPTS}
@@ -0,0 +1,163 @@
+"""
+Shared, pooled HTTP client for PayTraq, GitHub and the worker.
+
+One requests.Session per host (keep-alive connection pool sized per host), shared by
+all steps and all gunicorn threads of the process. Idempotent calls (GET/HEAD) are
+retried with exponential backoff on connection errors and 429/5xx. Every call is
+reported to common.metrics (latency, bytes, endpoint template).
+
+Env:
+  HTTP_CONNECT_TIMEOUT_S   default connect timeout (5)
+  HTTP_READ_TIMEOUT_S      default read timeout when the caller passes none (30)
+  HTTP_POOL_MAXSIZE        default connections kept per host (10)
+  HTTP_POOL_SIZES          per-host override, e.g. "go.paytraq.com=16,api.github.com=4"
+  HTTP_RETRIES             retries for idempotent calls (2)
+  HTTP_BACKOFF_S           backoff factor in seconds (0.5 -> 0.5s, 1s, 2s ...)
+"""
+import os
+import threading
+import time
+from http import cookiejar
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common import metrics
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name) or default)
+    except Exception:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except Exception:
+        return default
+
+
+CONNECT_TIMEOUT_S = _env_float("HTTP_CONNECT_TIMEOUT_S", 5.0)
+READ_TIMEOUT_S = _env_float("HTTP_READ_TIMEOUT_S", 30.0)
+POOL_MAXSIZE = _env_int("HTTP_POOL_MAXSIZE", 10)
+RETRIES = _env_int("HTTP_RETRIES", 2)
+BACKOFF_S = _env_float("HTTP_BACKOFF_S", 0.5)
+
+RETRY_METHODS = frozenset({"GET", "HEAD"})
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions: Dict[str, requests.Session] = {}
+_lock = threading.Lock()
+
+
+class _NoCookies(cookiejar.DefaultCookiePolicy):
+    """Sessions are shared across threads/runs; never keep server cookies between calls."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def _pool_sizes() -> Dict[str, int]:
+    out: Dict[str, int] = {}
+    for part in (os.getenv("HTTP_POOL_SIZES") or "").split(","):
+        host, _, size = part.partition("=")
+        host = host.strip().lower()
+        if host and size.strip().isdigit():
+            out[host] = int(size.strip())
+    return out
+
+
+def _new_session(host: str) -> requests.Session:
+    retry = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=RETRIES,
+        status=RETRIES,
+        backoff_factor=BACKOFF_S,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=RETRY_METHODS,
+        raise_on_status=False,
+        respect_retry_after_header=True,
+    )
+    size = _pool_sizes().get(host, POOL_MAXSIZE)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=False, max_retries=retry)
+    s = requests.Session()
+    s.cookies.set_policy(_NoCookies())
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def session_for(url: str) -> requests.Session:
+    """The shared Session for the url's host (created on first use)."""
+    host = (urlparse(url).netloc or "").lower()
+    s = _sessions.get(host)
+    if s is not None:
+        return s
+    with _lock:
+        s = _sessions.get(host)
+        if s is None:
+            s = _new_session(host)
+            _sessions[host] = s
+        return s
+
+
+def _timeout(timeout: Optional[object]):
+    if timeout is None:
+        return (CONNECT_TIMEOUT_S, READ_TIMEOUT_S)
+    if isinstance(timeout, (int, float)):
+        # callers pass a single "overall" number; keep connect short, use it as read timeout
+        return (min(CONNECT_TIMEOUT_S, float(timeout)), float(timeout))
+    return timeout
+
+
+def _body_len(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    return 0  # generators / files: unknown
+
+
+def request(method: str, url: str, timeout: Optional[object] = None, **kwargs) -> requests.Response:
+    method = method.upper()
+    started = time.perf_counter()
+    try:
+        r = session_for(url).request(method, url, timeout=_timeout(timeout), **kwargs)
+    except Exception:
+        metrics.observe_http(method, url, 0, time.perf_counter() - started, 0, 0)
+        raise
+    bytes_in = 0 if kwargs.get("stream") else len(r.content or b"")
+    metrics.observe_http(
+        method, url, r.status_code, time.perf_counter() - started, bytes_in,
+        _body_len(getattr(getattr(r, "request", None), "body", None)),
+    )
+    return r
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def put(url: str, **kwargs) -> requests.Response:
+    return request("PUT", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def close_all() -> None:
+    """Drop all pooled connections (gunicorn worker_exit)."""
+    with _lock:
+        for s in _sessions.values():
+            try:
+                s.close()
+            except Exception:
+                pass
+        _sessions.clear()
@@ -0,0 +1,116 @@
+"""
+In-process job queue for /run?async=1.
+
+submit() hands a callable to a small thread pool and returns a job id right away;
+get() returns the job's status, trace and result. The callable returns
+(result, trace). Finished jobs are kept for JOBS_TTL_S and then evicted.
+
+Jobs live in the gunicorn worker that accepted them, so GET /jobs/<id> has to
+reach the same process (one worker per container, as the Dockerfile runs it).
+
+Env:
+  JOBS_WORKERS     jobs running at the same time (default 1)
+  JOBS_QUEUE_MAX   queued + running jobs before submit() refuses (default 20)
+  JOBS_TTL_S       how long finished jobs stay queryable (default 3600)
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS") or 1)
+JOBS_QUEUE_MAX = int(os.getenv("JOBS_QUEUE_MAX") or 20)
+JOBS_TTL_S = float(os.getenv("JOBS_TTL_S") or 3600)
+
+_ACTIVE = ("queued", "running")
+
+_lock = threading.Lock()
+_jobs: Dict[str, Dict[str, Any]] = {}
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(1, JOBS_WORKERS), thread_name_prefix="run-job")
+        return _pool
+
+
+def _evict(now: float) -> None:
+    """Drop finished jobs older than JOBS_TTL_S (caller holds _lock)."""
+    for job_id in [j for j, rec in _jobs.items()
+                   if rec["status"] not in _ACTIVE and now - (rec.get("finished_at") or now) >= JOBS_TTL_S]:
+        del _jobs[job_id]
+
+
+def _snapshot(rec: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(rec)
+    if out.get("started_at"):
+        out["queued_s"] = round(out["started_at"] - out["created_at"], 3)
+        out["elapsed_s"] = round((out.get("finished_at") or time.time()) - out["started_at"], 3)
+    return out
+
+
+def _run(job_id: str, fn: Callable[[], Tuple[Any, Optional[List[Any]]]]) -> None:
+    with _lock:
+        rec = _jobs[job_id]
+        rec["status"] = "running"
+        rec["started_at"] = time.time()
+    try:
+        result, trace = fn()
+        update = {"status": "done", "result": result, "trace": trace}
+    except Exception as e:
+        update = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+    with _lock:
+        rec.update(update)
+        rec["finished_at"] = time.time()
+
+
+def submit(fn: Callable[[], Tuple[Any, Optional[List[Any]]]], kind: str = "run") -> Dict[str, Any]:
+    """Queue fn; returns the new job. Raises QueueFull when JOBS_QUEUE_MAX jobs are pending."""
+    pool = _executor()
+    now = time.time()
+    with _lock:
+        _evict(now)
+        active = sum(1 for rec in _jobs.values() if rec["status"] in _ACTIVE)
+        if active >= JOBS_QUEUE_MAX:
+            raise QueueFull(f"{active} jobs queued or running (JOBS_QUEUE_MAX={JOBS_QUEUE_MAX})")
+        job_id = uuid.uuid4().hex
+        rec = {"job_id": job_id, "kind": kind, "status": "queued", "created_at": now}
+        _jobs[job_id] = rec
+        snap = _snapshot(rec)
+    pool.submit(_run, job_id, fn)
+    return snap
+
+
+def get(job_id: str) -> Optional[Dict[str, Any]]:
+    with _lock:
+        _evict(time.time())
+        rec = _jobs.get(job_id)
+        return _snapshot(rec) if rec is not None else None
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        out = {"queued": 0, "running": 0, "done": 0, "error": 0}
+        for rec in _jobs.values():
+            out[rec["status"]] = out.get(rec["status"], 0) + 1
+        return out
+
+
+def shutdown(timeout_s: float = 30.0) -> bool:
+    """Wait up to timeout_s for queued/running jobs (gunicorn worker exit). True if all finished."""
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        with _lock:
+            if not any(rec["status"] in _ACTIVE for rec in _jobs.values()):
+                return True
+        time.sleep(0.1)
+    return False
@@ -0,0 +1,237 @@
+"""
+Append-only processing journal: one JSON line per processed document.
+
+Each record holds doc_id, picked_by, outcome, per-step timings, worker status and
+the state transition (cursor / in_progress / pending). It replaces digging through
+thousands of state/debug files on GitHub to find what happened to one order.
+
+Sidecar index (journal.idx), read through mmap:
+  header   8 bytes magic + uint64 `sorted_count`
+  records  16 bytes each: int64 doc_id, int64 byte offset into journal.jsonl
+The first `sorted_count` records are sorted by (doc_id, offset) and binary-searched;
+records appended since the last compaction form a short unsorted tail that is
+scanned. Once the tail exceeds JOURNAL_INDEX_TAIL_MAX it is merged into the sorted
+part (rewrite + atomic replace), so lookups stay O(log n) with millions of records.
+
+Appends from several gunicorn workers are serialized with flock on journal.lock.
+
+CLI:
+  python -m common.journal lookup <doc_id>
+  python -m common.journal compact
+  python -m common.journal reindex      # rebuild journal.idx from journal.jsonl
+
+Env:
+  JOURNAL                  1 (default) / 0 to disable
+  JOURNAL_DIR              directory (default <LOCAL_DATA_DIR>/journal)
+  JOURNAL_INDEX_TAIL_MAX   unsorted index records before compaction (4096)
+  JOURNAL_FSYNC            1 -> fsync every append (default 0)
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from common.local_db import data_path
+
+_MAGIC = b"S0JIDX01"
+_HEADER = struct.Struct("<8sQ")
+_REC = struct.Struct("<qq")
+
+TAIL_MAX = int(os.getenv("JOURNAL_INDEX_TAIL_MAX") or 4096)
+
+
+def enabled() -> bool:
+    return (os.getenv("JOURNAL") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def _dir() -> str:
+    d = os.getenv("JOURNAL_DIR") or data_path("journal")
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def _paths() -> Tuple[str, str, str]:
+    d = _dir()
+    return os.path.join(d, "journal.jsonl"), os.path.join(d, "journal.idx"), os.path.join(d, "journal.lock")
+
+
+@contextmanager
+def _locked():
+    _, _, lock_path = _paths()
+    with open(lock_path, "a") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def _read_header(f) -> int:
+    f.seek(0)
+    head = f.read(_HEADER.size)
+    if len(head) < _HEADER.size:
+        return 0
+    magic, sorted_count = _HEADER.unpack(head)
+    if magic != _MAGIC:
+        raise ValueError("journal.idx: bad magic")
+    return int(sorted_count)
+
+
+def _write_index(path: str, records: List[Tuple[int, int]]) -> None:
+    records.sort()
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(records)))
+        for rec in records:
+            f.write(_REC.pack(*rec))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _all_index_records(idx_path: str) -> List[Tuple[int, int]]:
+    if not os.path.exists(idx_path):
+        return []
+    with open(idx_path, "rb") as f:
+        _read_header(f)
+        f.seek(_HEADER.size)
+        data = f.read()
+    usable = len(data) - len(data) % _REC.size
+    return [rec for rec in _REC.iter_unpack(data[:usable])]
+
+
+def append(record: Dict[str, Any]) -> int:
+    """Append one record (must carry an int "doc_id"). Returns its byte offset."""
+    doc_id = int(record["doc_id"])
+    record.setdefault("ts", round(time.time(), 3))
+    line = (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+    jpath, ipath, _ = _paths()
+    fsync = (os.getenv("JOURNAL_FSYNC") or "0").strip() == "1"
+    with _locked():
+        with open(jpath, "ab") as jf:
+            offset = jf.seek(0, os.SEEK_END)
+            jf.write(line)
+            jf.flush()
+            if fsync:
+                os.fsync(jf.fileno())
+        with open(ipath, "ab") as xf:
+            if xf.seek(0, os.SEEK_END) == 0:
+                xf.write(_HEADER.pack(_MAGIC, 0))
+            xf.write(_REC.pack(doc_id, offset))
+            xf.flush()
+            if fsync:
+                os.fsync(xf.fileno())
+            size = xf.tell()
+        with open(ipath, "rb") as xf:
+            sorted_count = _read_header(xf)
+        if (size - _HEADER.size) // _REC.size - sorted_count > TAIL_MAX:
+            _write_index(ipath, _all_index_records(ipath))
+    return offset
+
+
+def _offsets(doc_id: int) -> List[int]:
+    _, ipath, _ = _paths()
+    if not os.path.exists(ipath) or os.path.getsize(ipath) <= _HEADER.size:
+        return []
+    with open(ipath, "rb") as f:
+        sorted_count = _read_header(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            n_total = (len(mm) - _HEADER.size) // _REC.size
+            sorted_count = min(sorted_count, n_total)
+
+            def key(i: int) -> int:
+                return _REC.unpack_from(mm, _HEADER.size + i * _REC.size)[0]
+
+            lo, hi = 0, sorted_count
+            while lo < hi:  # lower bound of doc_id in the sorted part
+                mid = (lo + hi) // 2
+                if key(mid) < doc_id:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            out = []
+            i = lo
+            while i < sorted_count:
+                d, off = _REC.unpack_from(mm, _HEADER.size + i * _REC.size)
+                if d != doc_id:
+                    break
+                out.append(off)
+                i += 1
+            for i in range(sorted_count, n_total):
+                d, off = _REC.unpack_from(mm, _HEADER.size + i * _REC.size)
+                if d == doc_id:
+                    out.append(off)
+    return sorted(out)
+
+
+def lookup(doc_id: int, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """All journal records for doc_id, oldest first (the newest `limit` if given)."""
+    offsets = _offsets(int(doc_id))
+    if limit is not None:
+        offsets = offsets[-max(0, int(limit)):] if limit else []
+    if not offsets:
+        return []
+    jpath, _, _ = _paths()
+    out = []
+    with open(jpath, "rb") as jf:
+        for off in offsets:
+            jf.seek(off)
+            line = jf.readline()
+            try:
+                out.append(json.loads(line))
+            except Exception:
+                out.append({"doc_id": int(doc_id), "offset": off, "error": "unreadable record"})
+    return out
+
+
+def compact() -> int:
+    """Merge the unsorted tail into the sorted index. Returns the record count."""
+    _, ipath, _ = _paths()
+    with _locked():
+        records = _all_index_records(ipath)
+        _write_index(ipath, records)
+    return len(records)
+
+
+def _scan_journal(jpath: str) -> Iterator[Tuple[int, int]]:
+    with open(jpath, "rb") as jf:
+        offset = 0
+        for line in jf:
+            try:
+                yield int(json.loads(line)["doc_id"]), offset
+            except Exception:
+                pass
+            offset += len(line)
+
+
+def reindex() -> int:
+    """Rebuild journal.idx from journal.jsonl (e.g. after losing the index)."""
+    jpath, ipath, _ = _paths()
+    with _locked():
+        records = list(_scan_journal(jpath)) if os.path.exists(jpath) else []
+        _write_index(ipath, records)
+    return len(records)
+
+
+def _main(argv: List[str]) -> int:
+    if len(argv) >= 2 and argv[0] == "lookup":
+        for rec in lookup(int(argv[1])):
+            print(json.dumps(rec, ensure_ascii=False))
+        return 0
+    if argv[:1] == ["compact"]:
+        print(f"compacted: {compact()} records")
+        return 0
+    if argv[:1] == ["reindex"]:
+        print(f"reindexed: {reindex()} records")
+        return 0
+    print("usage: python -m common.journal lookup <doc_id> | compact | reindex", file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
@@ -0,0 +1,30 @@
+"""
+Local data directory and SQLite helper shared by the on-disk stores.
+
+Env:
+  LOCAL_DATA_DIR   where local state / caches live (default /tmp/step0-data)
+"""
+import os
+import sqlite3
+
+DATA_DIR = os.getenv("LOCAL_DATA_DIR") or "/tmp/step0-data"
+
+
+def data_path(name: str) -> str:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, name)
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite db for short-lived use from any thread.
+
+    WAL + synchronous=FULL: every commit is fsync'd; readers don't block the writer.
+    Writers should use `BEGIN IMMEDIATE` so the write lock is taken up front.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
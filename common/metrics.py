@@ -0,0 +1,182 @@
+"""
+In-process metrics: step durations, outbound HTTP accounting and run outcomes.
+
+http_client reports every call here (host, method, endpoint template, status,
+latency, bytes). The runner wraps each step in http_scope(), so the step's trace
+entry shows which hosts/endpoints its time went to; the same numbers are
+aggregated per process and rendered for Prometheus by render() (GET /metrics).
+
+Endpoint templates keep label cardinality bounded: numeric path segments become
+{id}, 40-hex segments {sha}, and everything after /contents/ is {path}.
+
+Steps that fan out over a ThreadPoolExecutor submit propagate(fn), so calls made
+by pool threads are still attributed to the calling step.
+
+Counters are per process (each gunicorn worker exposes its own).
+"""
+import contextvars
+import re
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+STEP_BUCKETS_S = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_HEX40 = re.compile(r"^[0-9a-f]{40}$")
+
+_lock = threading.Lock()
+# (step) -> [bucket counts..., +Inf count, sum]
+_step_hist: Dict[str, list] = {}
+# (host, method, endpoint, status_class) -> [count, seconds, bytes_in, bytes_out]
+_http: Dict[Tuple[str, str, str, str], list] = {}
+# (mode, outcome) -> count
+_runs: Dict[Tuple[str, str], int] = {}
+# outcome -> count
+_docs: Dict[str, int] = {}
+
+
+class _Scope:
+    """HTTP calls made while a step runs: "host METHOD endpoint" -> count/ms/bytes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, key: str, elapsed_s: float, bytes_in: int, bytes_out: int, error: bool) -> None:
+        with self._lock:
+            row = self.calls.setdefault(key, {"count": 0, "ms": 0.0, "bytes_in": 0, "bytes_out": 0, "errors": 0})
+            row["count"] += 1
+            row["ms"] = round(row["ms"] + elapsed_s * 1000, 1)
+            row["bytes_in"] += bytes_in
+            row["bytes_out"] += bytes_out
+            row["errors"] += 1 if error else 0
+
+
+_scope: contextvars.ContextVar[Optional[_Scope]] = contextvars.ContextVar("step0_http_scope", default=None)
+
+
+@contextmanager
+def http_scope() -> Iterator[_Scope]:
+    scope = _Scope()
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+def propagate(fn: Callable) -> Callable:
+    """fn bound to a copy of the caller's context (for pool.submit)."""
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.run(fn, *a, **kw)
+
+
+def endpoint_template(path: str) -> str:
+    parts = []
+    for seg in (path or "/").split("/"):
+        if parts and parts[-1] == "contents":
+            parts.append("{path}")
+            break
+        if seg.isdigit():
+            seg = "{id}"
+        elif _HEX40.match(seg):
+            seg = "{sha}"
+        parts.append(seg)
+    return "/".join(parts) or "/"
+
+
+def observe_http(method: str, url: str, status: int, elapsed_s: float, bytes_in: int, bytes_out: int) -> None:
+    u = urlparse(url)
+    host = (u.netloc or "").lower()
+    endpoint = endpoint_template(u.path)
+    status_class = f"{status // 100}xx" if status else "error"
+    with _lock:
+        row = _http.setdefault((host, method, endpoint, status_class), [0, 0.0, 0, 0])
+        row[0] += 1
+        row[1] += elapsed_s
+        row[2] += bytes_in
+        row[3] += bytes_out
+    scope = _scope.get()
+    if scope is not None:
+        scope.add(f"{host} {method} {endpoint}", elapsed_s, bytes_in, bytes_out, error=not status or status >= 400)
+
+
+def observe_step(step: str, elapsed_s: float) -> None:
+    with _lock:
+        hist = _step_hist.setdefault(step, [0] * (len(STEP_BUCKETS_S) + 1) + [0.0])
+        for i, le in enumerate(STEP_BUCKETS_S):
+            if elapsed_s <= le:
+                hist[i] += 1
+        hist[len(STEP_BUCKETS_S)] += 1
+        hist[-1] += elapsed_s
+
+
+def observe_run(mode: str, outcome: str) -> None:
+    with _lock:
+        _runs[(mode, outcome)] = _runs.get((mode, outcome), 0) + 1
+
+
+def observe_document(outcome: str) -> None:
+    with _lock:
+        _docs[outcome] = _docs.get(outcome, 0) + 1
+
+
+def _labels(**kw: str) -> str:
+    def esc(v: str) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in kw.items()) + "}"
+
+
+def render() -> str:
+    """Prometheus text exposition format (0.0.4)."""
+    with _lock:
+        step_hist = {k: list(v) for k, v in _step_hist.items()}
+        http = {k: list(v) for k, v in _http.items()}
+        runs = dict(_runs)
+        docs = dict(_docs)
+
+    out = [
+        "# HELP step0_step_duration_seconds Wall time per pipeline step.",
+        "# TYPE step0_step_duration_seconds histogram",
+    ]
+    for step, hist in sorted(step_hist.items()):
+        for i, le in enumerate(STEP_BUCKETS_S):
+            out.append(f"step0_step_duration_seconds_bucket{_labels(step=step, le=repr(le))} {hist[i]}")
+        n = hist[len(STEP_BUCKETS_S)]
+        out.append(f"step0_step_duration_seconds_bucket{_labels(step=step, le='+Inf')} {n}")
+        out.append(f"step0_step_duration_seconds_sum{_labels(step=step)} {hist[-1]:.6f}")
+        out.append(f"step0_step_duration_seconds_count{_labels(step=step)} {n}")
+
+    http_metrics = (
+        ("step0_http_requests_total", "Outbound HTTP requests.", 0, "{:d}"),
+        ("step0_http_request_seconds_total", "Total latency of outbound HTTP requests.", 1, "{:.6f}"),
+        ("step0_http_response_bytes_total", "Bytes received from outbound HTTP requests.", 2, "{:d}"),
+        ("step0_http_request_bytes_total", "Bytes sent in outbound HTTP request bodies.", 3, "{:d}"),
+    )
+    for name, help_text, idx, fmt in http_metrics:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} counter")
+        for (host, method, endpoint, status_class), row in sorted(http.items()):
+            labels = _labels(host=host, method=method, endpoint=endpoint, status=status_class)
+            out.append(f"{name}{labels} {fmt.format(row[idx])}")
+
+    out.append("# HELP step0_runs_total Pipeline runs by mode and outcome.")
+    out.append("# TYPE step0_runs_total counter")
+    for (mode, outcome), n in sorted(runs.items()):
+        out.append(f"step0_runs_total{_labels(mode=mode, outcome=outcome)} {n}")
+
+    out.append("# HELP step0_documents_total Processed documents by outcome.")
+    out.append("# TYPE step0_documents_total counter")
+    for outcome, n in sorted(docs.items()):
+        out.append(f"step0_documents_total{_labels(outcome=outcome)} {n}")
+
+    return "\n".join(out) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        _step_hist.clear()
+        _http.clear()
+        _runs.clear()
+        _docs.clear()
@@ -0,0 +1,74 @@
+"""
+Pending-draft schedule stored in state/pending_draft_ids.txt.
+
+One line per deferred draft:  "<doc_id> <next_check_at> <attempts>"
+(next_check_at = unix seconds). Bare "<doc_id>" lines from the old format are read
+as due now with 0 attempts, so existing state keeps working.
+
+Every re-check that still finds a draft pushes next_check_at out exponentially
+(PENDING_BACKOFF_BASE_S * 2^attempts, capped at PENDING_BACKOFF_MAX_S), so
+long-lived drafts stop costing a PayTraq call on every run and newer ones get
+their turn.
+
+In ctx the schedule travels as {"<doc_id>": [next_check_at, attempts]} (JSON-safe).
+"""
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+BACKOFF_BASE_S = int(os.getenv("PENDING_BACKOFF_BASE_S") or 300)
+BACKOFF_MAX_S = int(os.getenv("PENDING_BACKOFF_MAX_S") or 86400)
+
+Schedule = Dict[str, List[int]]
+
+
+def parse(text: Optional[str]) -> Schedule:
+    out: Schedule = {}
+    for line in (text or "").replace(",", "\n").splitlines():
+        parts = line.split()
+        if not parts or not parts[0].isdigit():
+            continue
+        next_at = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        attempts = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
+        out[str(int(parts[0]))] = [next_at, attempts]
+    return out
+
+
+def dump(ids, schedule: Schedule) -> str:
+    lines = []
+    for doc_id in sorted({int(i) for i in ids}):
+        next_at, attempts = (schedule or {}).get(str(doc_id)) or [0, 0]
+        lines.append(f"{doc_id} {int(next_at)} {int(attempts)}")
+    return ("\n".join(lines) + "\n") if lines else ""
+
+
+def ids_of(schedule: Schedule) -> List[int]:
+    return sorted(int(k) for k in schedule)
+
+
+def backoff_s(attempts: int) -> int:
+    return int(min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** max(0, min(int(attempts), 30)))))
+
+
+def still_draft(schedule: Schedule, doc_id: int, now: Optional[float] = None) -> None:
+    """Record one more 'still a draft' check -> next check is further out."""
+    now = int(now if now is not None else time.time())
+    _, attempts = schedule.get(str(int(doc_id))) or [0, 0]
+    attempts = int(attempts) + 1
+    schedule[str(int(doc_id))] = [now + backoff_s(attempts), attempts]
+
+
+def add(schedule: Schedule, doc_id: int, now: Optional[float] = None) -> None:
+    """Newly deferred draft: first re-check after the base backoff."""
+    if str(int(doc_id)) in schedule:
+        return
+    now = int(now if now is not None else time.time())
+    schedule[str(int(doc_id))] = [now + backoff_s(0), 0]
+
+
+def due(schedule: Schedule, budget: int, now: Optional[float] = None) -> Tuple[List[int], int]:
+    """Ids whose next_check_at has passed, oldest id first, at most `budget`.
+    Returns (ids_to_check, total_due)."""
+    now = now if now is not None else time.time()
+    ready = sorted(int(k) for k, (next_at, _) in schedule.items() if int(next_at) <= now)
+    return ready[:max(0, int(budget))], len(ready)
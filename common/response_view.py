@@ -0,0 +1,77 @@
+"""
+Response projection for /run and /debug.
+
+  view=summary   SUMMARY_KEYS only: status, the picked document and its outcome, the
+                 cursor; in batch mode the per-document results without their traces
+  view=full      the whole ctx (process-local "__" keys are already gone)
+  fields=a,b,c   exactly these top-level ctx keys (overrides view)
+
+Both come from the query string or the JSON body ({"view": "full"}). /run defaults
+to summary, /debug to full.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+VIEWS = ("summary", "full")
+
+SUMMARY_KEYS = (
+    "status",
+    "error",
+    "outcome",
+    "coalesced",
+    "idle",
+    "next_document_id",
+    "picked_by",
+    "doc_status",
+    "worker_status_code",
+    "github_finalize_ack",
+    "last_processed_id",
+    "cursor_advanced_to",
+    "documents",
+    "documents_processed",
+    "batch_stop_reason",
+    "batch_elapsed_s",
+)
+
+
+def parse_fields(raw: Any) -> Optional[List[str]]:
+    """"a, b" or ["a", "b"] -> ["a", "b"]; None/empty -> None."""
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    if not isinstance(raw, (list, tuple)):
+        return None
+    out = [str(f).strip() for f in raw if str(f).strip()]
+    return out or None
+
+
+def from_request(args, payload: Dict[str, Any], default_view: str) -> Tuple[str, Optional[List[str]]]:
+    """(view, fields) from query args, else the JSON body; both removed from payload."""
+    body_view = payload.pop("view", None)
+    body_fields = payload.pop("fields", None)
+    view = (args.get("view") or body_view or default_view or "full").strip().lower()
+    fields = parse_fields(args.get("fields") if args.get("fields") is not None else body_fields)
+    return view, fields
+
+
+def needs_any(view: str, fields: Optional[List[str]], keys: Iterable[str]) -> bool:
+    """Whether the response will include any of `keys` (so they must stay on ctx)."""
+    if fields is not None:
+        return any(k in fields for k in keys)
+    return view == "full"
+
+
+def project(ctx: Dict[str, Any], view: str, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    if fields is not None:
+        return {k: ctx[k] for k in fields if k in ctx}
+    if view == "full":
+        return ctx
+    out = {k: ctx[k] for k in SUMMARY_KEYS if k in ctx}
+    if isinstance(out.get("documents"), list):
+        out["documents"] = [
+            {k: v for k, v in d.items() if k != "_trace"} if isinstance(d, dict) else d
+            for d in out["documents"]
+        ]
+    if isinstance(ctx.get("pending_list"), list):
+        out["pending_count"] = len(ctx["pending_list"])
+    return out
@@ -0,0 +1,163 @@
+"""
+Single-flight lease for pipeline runs.
+
+The scheduler and the Mozello webhook trigger /run independently. Without a lock
+two runs list sales, pick the same document, call the worker twice and race on
+the state commit. runner.run_pipeline takes this lease first; a trigger that finds
+it held does not run the pipeline (see runner for join / "coalesced").
+
+One SQLite row per lease name: holder, fencing token, expiry. Every acquire bumps
+the token, so a run whose lease expired and was taken over can tell: renew() and
+is_current() fail for a superseded token and step_08 refuses to write state with it.
+The row lives on local disk, so the lease covers the workers and threads of one
+instance; across instances the state commit's CAS on the GitHub ref still applies.
+A lease whose holder process on this host is gone (worker killed, OOM) is taken
+over at once instead of blocking every trigger until it expires.
+
+Env:
+  RUN_LEASE         1 (default) / 0 to disable
+  RUN_LEASE_PATH    sqlite file (default <LOCAL_DATA_DIR>/run_lease.sqlite3)
+  RUN_LEASE_TTL_S   lease lifetime without renewal (default 360, ~3x the longest step:
+                    the worker call times out at 120 s); the runner renews after every step
+"""
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from common.local_db import connect, data_path
+
+TTL_S = float(os.getenv("RUN_LEASE_TTL_S") or 360)
+
+_init_lock = threading.Lock()
+_initialized_path: Optional[str] = None
+
+
+def enabled() -> bool:
+    return (os.getenv("RUN_LEASE") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def _path() -> str:
+    return os.getenv("RUN_LEASE_PATH") or data_path("run_lease.sqlite3")
+
+
+def _conn():
+    global _initialized_path
+    path = _path()
+    conn = connect(path)
+    if _initialized_path != path:
+        with _init_lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lease ("
+                " name TEXT PRIMARY KEY, holder TEXT, token INTEGER NOT NULL,"
+                " acquired_at REAL, expires_at REAL NOT NULL)"
+            )
+            _initialized_path = path
+    return conn
+
+
+def _holder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _holder_dead(holder_id: Optional[str]) -> bool:
+    """Holder is a process on this host that no longer exists."""
+    try:
+        host, pid, _ = (holder_id or "").rsplit(":", 2)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname() or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False  # exists, owned by someone else
+    return False
+
+
+def acquire(name: str = "run", ttl_s: Optional[float] = None) -> Optional[int]:
+    """Take the lease; returns the new fencing token, or None while someone else holds it.
+    A holder on this host whose pid is gone loses the lease before its expiry."""
+    now = time.time()
+    ttl = TTL_S if ttl_s is None else ttl_s
+    conn = _conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT holder, token, expires_at FROM lease WHERE name = ?", (name,)).fetchone()
+        if row and row[0] and row[2] > now and not _holder_dead(row[0]):
+            conn.execute("COMMIT")
+            return None
+        token = (row[1] if row else 0) + 1
+        conn.execute(
+            "INSERT INTO lease (name, holder, token, acquired_at, expires_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, token = excluded.token,"
+            " acquired_at = excluded.acquired_at, expires_at = excluded.expires_at",
+            (name, _holder_id(), token, now, now + ttl),
+        )
+        conn.execute("COMMIT")
+        return token
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def renew(token: int, name: str = "run", ttl_s: Optional[float] = None) -> bool:
+    """Extend the lease; False if token was superseded (someone acquired after expiry)."""
+    ttl = TTL_S if ttl_s is None else ttl_s
+    conn = _conn()
+    try:
+        cur = conn.execute(
+            "UPDATE lease SET expires_at = ? WHERE name = ? AND token = ? AND holder IS NOT NULL",
+            (time.time() + ttl, name, int(token)),
+        )
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+def is_current(token: Optional[int], name: str = "run") -> bool:
+    if token is None:
+        return True  # run without a lease (RUN_LEASE=0)
+    conn = _conn()
+    try:
+        row = conn.execute("SELECT token, holder FROM lease WHERE name = ?", (name,)).fetchone()
+        return bool(row and row[0] == int(token) and row[1])
+    finally:
+        conn.close()
+
+
+def release(token: int, name: str = "run") -> None:
+    conn = _conn()
+    try:
+        conn.execute(
+            "UPDATE lease SET holder = NULL, expires_at = 0 WHERE name = ? AND token = ?",
+            (name, int(token)),
+        )
+    finally:
+        conn.close()
+
+
+def holder(name: str = "run") -> Optional[Dict[str, Any]]:
+    """Current holder (for the "coalesced" response), None when free."""
+    conn = _conn()
+    try:
+        row = conn.execute(
+            "SELECT holder, token, acquired_at, expires_at FROM lease WHERE name = ?", (name,)
+        ).fetchone()
+    finally:
+        conn.close()
+    now = time.time()
+    if not row or not row[0] or row[3] <= now:
+        return None
+    return {
+        "holder": row[0],
+        "token": row[1],
+        "held_s": round(now - (row[2] or now), 1),
+        "expires_in_s": round(row[3] - now, 1),
+    }
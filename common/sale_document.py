@@ -0,0 +1,203 @@
+"""
+Parse-once view of a PayTraq sale XML.
+
+The same sale used to be parsed by step_02 (status/ref/date), step_03 (status),
+step_04 (fields, line items) and step_06 (ref). SaleDocument parses it once and
+exposes those lazily; SaleDocument.from_ctx() keeps the instance on ctx so every
+later step of the run reuses the same tree.
+"""
+import xml.etree.ElementTree as ET
+from functools import cached_property
+from typing import Any, Dict, List, Optional, Tuple
+
+# Process-local ctx key (runner strips "__" keys before the ctx is returned as JSON).
+CTX_KEY = "__sale_doc"
+
+
+def text(v: Optional[str]) -> Optional[str]:
+    if v is None:
+        return None
+    t = v.strip()
+    return t if t != "" else None
+
+
+# flatten_xml output shapes:
+#   tuples   [(path, value), ...]
+#   dicts    [{"field": path, "value": value}, ...]   (what extract_all / the worker get)
+#   columns  {"paths": [...], "values": [...]}
+SHAPES = ("tuples", "dicts", "columns")
+
+_TEXT = object()  # stack marker: emit the parent's own text after its children
+
+
+def flatten_xml(elem: ET.Element, prefix: str = "", shape: str = "tuples"):
+    """Leaf values of elem, depth-first in document order.
+
+    Repeated sibling tags get an index (LineItem[0], LineItem[1], ...), attributes
+    come out as path@name and the text of an element that also has children as
+    path#text. Iterative: a stack of (element, path) frames instead of recursion,
+    paths built once per element, no intermediate lists."""
+    if shape not in SHAPES:
+        raise ValueError(f"unknown shape: {shape}")
+    paths: List[str] = []
+    values: List[str] = []
+    add_path = paths.append
+    add_value = values.append
+
+    stack: List[Tuple[Any, Any]] = [(elem, prefix)]
+    pop = stack.pop
+    push = stack.append
+    extend = stack.extend
+    while stack:
+        node, path = pop()
+        if node is _TEXT:
+            add_path(path[0])
+            add_value(path[1])
+            continue
+
+        if node.attrib:
+            for k, v in node.attrib.items():
+                if v is not None and str(v).strip() != "":
+                    add_path(f"{path}@{k}" if path else f"@{k}")
+                    add_value(str(v))
+
+        val = node.text
+        if val is not None:
+            val = val.strip() or None
+
+        children = list(node)
+        if not children:
+            if val is not None:
+                add_path(path or node.tag)
+                add_value(val)
+            continue
+
+        if val is not None:
+            push((_TEXT, (f"{path}#text" if path else f"{node.tag}#text", val)))
+
+        base = f"{path}/" if path else ""
+        if len(children) == 1:
+            push((children[0], base + children[0].tag))
+            continue
+        counts: Dict[str, int] = {}
+        for ch in children:
+            counts[ch.tag] = counts.get(ch.tag, 0) + 1
+        if len(counts) == len(children):
+            frames = [(ch, base + ch.tag) for ch in children]
+        else:
+            seen: Dict[str, int] = {}
+            frames = []
+            for ch in children:
+                tag = ch.tag
+                if counts[tag] > 1:
+                    idx = seen.get(tag, 0)
+                    seen[tag] = idx + 1
+                    frames.append((ch, f"{base}{tag}[{idx}]"))
+                else:
+                    frames.append((ch, base + tag))
+        extend(reversed(frames))  # last child first -> popped in document order
+
+    if shape == "tuples":
+        return list(zip(paths, values))
+    if shape == "dicts":
+        return [{"field": k, "value": v} for k, v in zip(paths, values)]
+    return {"paths": paths, "values": values}
+
+
+def _find_text(elem: ET.Element, path: str) -> Optional[str]:
+    el = elem.find(path)
+    return text(el.text) if el is not None else None
+
+
+def parse_line_items(root: ET.Element, flatten: bool = True) -> List[Dict[str, Any]]:
+    """LineItem rows; flatten=False leaves out the full "_flat" field list."""
+    items: List[Dict[str, Any]] = []
+    for li in root.iterfind("./LineItems/LineItem"):
+        row: Dict[str, Any] = {}
+        if flatten:
+            row["_flat"] = flatten_xml(li, "LineItem", "dicts")
+        row["item_code"] = _find_text(li, "./Item/ItemCode")
+        row["item_name"] = _find_text(li, "./Item/ItemName")
+        row["qty"] = _find_text(li, "./Qty")
+        row["price"] = _find_text(li, "./Price")
+        row["line_total"] = _find_text(li, "./LineTotal")
+        row["tax"] = _find_text(li, "./TaxKey/TaxKeyName")
+        items.append(row)
+    return items
+
+
+class SaleDocument:
+    def __init__(self, xml_text: str):
+        self.xml = xml_text or ""
+        self.parse_error: Optional[str] = None
+
+    @classmethod
+    def from_ctx(cls, ctx: dict) -> Optional["SaleDocument"]:
+        """The SaleDocument for ctx["paytraq_full_xml"], parsed at most once per run."""
+        xml_text = ctx.get("paytraq_full_xml")
+        if not xml_text or not isinstance(xml_text, str):
+            return None
+        doc = ctx.get(CTX_KEY)
+        if isinstance(doc, cls) and (doc.xml is xml_text or doc.xml == xml_text):
+            return doc
+        doc = cls(xml_text)
+        ctx[CTX_KEY] = doc
+        return doc
+
+    def attach(self, ctx: dict) -> "SaleDocument":
+        """Make this (already parsed) document the run's current sale."""
+        ctx["paytraq_full_xml"] = self.xml
+        ctx[CTX_KEY] = self
+        return self
+
+    @cached_property
+    def root(self) -> Optional[ET.Element]:
+        try:
+            return ET.fromstring(self.xml)
+        except Exception as e:
+            self.parse_error = type(e).__name__
+            return None
+
+    def _header(self, name: str) -> Optional[str]:
+        if self.root is None:
+            return None
+        el = self.root.find(f"./Header/Document/{name}")
+        if el is None or not el.text:
+            return None
+        return text(el.text)
+
+    @cached_property
+    def document_id(self) -> Optional[int]:
+        t = self._header("DocumentID")
+        return int(t) if t and t.isdigit() else None
+
+    @cached_property
+    def status(self) -> Optional[str]:
+        """Lowercased DocumentStatus ('draft', 'wait_payment', 'paid', 'voided', ...)."""
+        t = self._header("DocumentStatus")
+        return t.lower() if t else None
+
+    @cached_property
+    def ref(self) -> Optional[str]:
+        return self._header("DocumentRef")
+
+    @cached_property
+    def date(self) -> Optional[str]:
+        return self._header("DocumentDate")
+
+    @cached_property
+    def client_id(self) -> Optional[str]:
+        return self._header("Client/ClientID")
+
+    @cached_property
+    def fields(self) -> List[Tuple[str, str]]:
+        return flatten_xml(self.root, "Sale") if self.root is not None else []
+
+    @cached_property
+    def field_rows(self) -> List[Dict[str, str]]:
+        """fields as [{"field", "value"}] (extract_all's sale_fields)."""
+        return flatten_xml(self.root, "Sale", "dicts") if self.root is not None else []
+
+    @cached_property
+    def line_items(self) -> List[Dict[str, Any]]:
+        return parse_line_items(self.root) if self.root is not None else []
@@ -0,0 +1,67 @@
+"""
+Streaming reader for PayTraq /api/sales list pages.
+
+A list page can hold hundreds of <Sale> headers; only DocumentID (and, for the
+pending re-check, DocumentStatus) is needed. A pull parser walks the page once
+and clears every finished <Sale>, so no full tree is built regardless of page
+size, and the ids land in a compact sorted array('q') that step_02 searches with
+bisect.
+"""
+import xml.etree.ElementTree as ET
+from array import array
+from typing import Dict, Iterable, Iterator, Union
+
+_Body = Union[str, bytes]
+
+# The page is fed to the pull parser in slices of this size (no second full copy).
+_FEED_CHUNK = 64 * 1024
+
+
+def _elements(xml_body: _Body) -> Iterator[ET.Element]:
+    """Yield elements as they END; each finished <Sale> is cleared right after its
+    consumer has looked at it, so only one record's subtree is alive at a time."""
+    parser = ET.XMLPullParser(events=("end",))
+    body = xml_body or ""
+    for off in range(0, len(body), _FEED_CHUNK):
+        parser.feed(body[off:off + _FEED_CHUNK])
+        for _, el in parser.read_events():
+            yield el
+            if el.tag == "Sale":
+                el.clear()
+    parser.close()
+    for _, el in parser.read_events():
+        yield el
+
+
+def _is_doc_id(tag: str) -> bool:
+    return tag == "DocumentID" or tag.lower() == "documentid"
+
+
+def sorted_ids(ids: Iterable[int]) -> array:
+    """Compact ascending, de-duplicated array('q'); no copy-sort if already ascending."""
+    arr = ids if isinstance(ids, array) else array("q", ids)
+    if all(arr[i] < arr[i + 1] for i in range(len(arr) - 1)):
+        return arr
+    return array("q", sorted(set(arr)))
+
+
+def document_ids(xml_body: _Body) -> array:
+    """All DocumentIDs of a list page as sorted array('q'). Raises ET.ParseError on bad XML."""
+    ids = array("q")
+    for el in _elements(xml_body):
+        if _is_doc_id(el.tag) and el.text:
+            t = el.text.strip()
+            if t.isdigit():
+                ids.append(int(t))
+    return sorted_ids(ids)
+
+
+def document_statuses(xml_body: _Body) -> Dict[int, str]:
+    """{DocumentID: lowercased DocumentStatus} for each <Document> header ('' if missing)."""
+    out: Dict[int, str] = {}
+    for el in _elements(xml_body):
+        if el.tag == "Document":
+            t = (el.findtext("DocumentID") or "").strip()
+            if t.isdigit():
+                out[int(t)] = (el.findtext("DocumentStatus") or "").strip().lower()
+    return out
@@ -0,0 +1,347 @@
+"""
+State store for the pipeline cursor files:
+  state/last_processed_id.txt, state/in_progress_id.txt, state/pending_draft_ids.txt
+
+Keys are the repo paths, values the file text, so every backend is interchangeable
+and GitHub can mirror a local backend 1:1.
+
+Env:
+  STATE_BACKEND         github (default) | sqlite | file
+  STATE_DB_PATH         sqlite file (default <LOCAL_DATA_DIR>/state.sqlite3)
+  STATE_DIR             file backend root (default <LOCAL_DATA_DIR>/state_files)
+  STATE_GITHUB_MIRROR   1 -> local writes are pushed to GitHub asynchronously,
+                        and a missing local key is seeded once from GitHub
+  STATE_MIRROR_RETRY_S  first retry delay of a failed mirror push (2); doubles up to
+                        STATE_MIRROR_RETRY_MAX_S (300)
+"""
+import atexit
+import base64
+import fcntl
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional, Tuple
+
+from common import github_api, http_client
+from common.local_db import connect, data_path
+
+# (text or None, status, error body). status mirrors HTTP: 200 found, 404 missing.
+ReadResult = Tuple[Optional[str], int, Any]
+
+
+class StateStore(ABC):
+    name = "base"
+
+    def check(self) -> Optional[str]:
+        """Error message if the backend can't be used (e.g. missing credentials)."""
+        return None
+
+    @abstractmethod
+    def read(self, path: str) -> ReadResult:
+        ...
+
+    @abstractmethod
+    def write(self, path: str, text: str, message: str = "") -> Tuple[Any, Any]:
+        """Returns (status, error). status is 200/201 on success."""
+
+    def write_many(self, files: Dict[str, str], message: str = "", rebuild=None) -> Dict[str, Any]:
+        """rebuild: see github_api.commit_files; only the GitHub backend can lose a race
+        (local backends write under the run lease in one transaction)."""
+        return {path: self.write(path, text, message)[0] for path, text in files.items()}
+
+
+class GitHubStateStore(StateStore):
+    """Files in the GitHub repo. Single-file writes use the Contents API; multi-file
+    writes go through the Git Data API as one commit."""
+
+    name = "github"
+    last_commit: Optional[Dict[str, Any]] = None
+
+    def _token(self) -> Optional[str]:
+        return os.getenv("GITHUB_TOKEN")
+
+    def _headers(self) -> dict:
+        return github_api.headers(self._token() or "")
+
+    def _url(self, path: str) -> str:
+        return github_api.repo_url(f"/contents/{path}")
+
+    def check(self) -> Optional[str]:
+        return None if self._token() else "Missing env: GITHUB_TOKEN"
+
+    def read(self, path: str) -> ReadResult:
+        r = http_client.get(self._url(path), headers=self._headers(), timeout=20)
+        if r.status_code == 404:
+            return None, 404, None
+        data = r.json() or {}
+        if "content" not in data:
+            return None, r.status_code, data
+        return base64.b64decode(data["content"]).decode().strip(), r.status_code, None
+
+    def _get_sha(self, path: str):
+        r = http_client.get(self._url(path), headers=self._headers(), timeout=20)
+        if r.status_code == 404:
+            return None, 404, None
+        data = r.json() or {}
+        sha = data.get("sha")
+        if not sha:
+            return None, r.status_code, data
+        return sha, r.status_code, None
+
+    def write(self, path: str, text: str, message: str = ""):
+        sha, st, err = self._get_sha(path)
+        if st not in (200, 404):
+            return st, err
+        payload = {
+            "message": github_api.commit_message(message or f"state: update {path}"),
+            "content": base64.b64encode(text.encode("utf-8")).decode("utf-8"),
+        }
+        if sha:
+            payload["sha"] = sha
+        r = http_client.put(self._url(path), headers=self._headers(), json=payload, timeout=30)
+        return r.status_code, (None if r.status_code in (200, 201) else (r.text or "")[:500])
+
+    def write_many(self, files: Dict[str, str], message: str = "", rebuild=None) -> Dict[str, Any]:
+        """All files in ONE commit (Git Data API, CAS on the branch ref). With `rebuild`
+        a lost race recomputes the files from the new head instead of re-sending them."""
+        if len(files) == 1 and rebuild is None:
+            return super().write_many(files, message)
+        st, info = github_api.commit_files(self._token() or "", files, message or "state: update", rebuild=rebuild)
+        self.last_commit = info
+        return {path: st for path in files}
+
+
+class SqliteStateStore(StateStore):
+    """Local SQLite table path -> text. Each write is one fsync'd transaction."""
+
+    name = "sqlite"
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("STATE_DB_PATH") or data_path("state.sqlite3")
+        conn = connect(self.path)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " path TEXT PRIMARY KEY, content TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        finally:
+            conn.close()
+
+    def read(self, path: str) -> ReadResult:
+        conn = connect(self.path)
+        try:
+            row = conn.execute("SELECT content FROM state WHERE path = ?", (path,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None, 404, None
+        return (row[0] or "").strip(), 200, None
+
+    def write(self, path: str, text: str, message: str = ""):
+        self.write_many({path: text}, message)
+        return 200, None
+
+    def write_many(self, files: Dict[str, str], message: str = "", rebuild=None) -> Dict[str, Any]:
+        conn = connect(self.path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            for path, text in files.items():
+                conn.execute(
+                    "INSERT INTO state(path, content, updated_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(path) DO UPDATE SET content = excluded.content,"
+                    " updated_at = excluded.updated_at",
+                    (path, text, now),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return {path: 200 for path in files}
+
+
+class FileStateStore(StateStore):
+    """Plain files under STATE_DIR. Writes: flock + tmp file + fsync + atomic rename."""
+
+    name = "file"
+
+    def __init__(self, root: Optional[str] = None):
+        self.root = root or os.getenv("STATE_DIR") or data_path("state_files")
+        os.makedirs(self.root, exist_ok=True)
+        self._lock_path = os.path.join(self.root, ".lock")
+
+    def _file(self, path: str) -> str:
+        return os.path.join(self.root, path.replace("/", "__"))
+
+    def read(self, path: str) -> ReadResult:
+        try:
+            with open(self._file(path), "r", encoding="utf-8") as f:
+                return f.read().strip(), 200, None
+        except FileNotFoundError:
+            return None, 404, None
+
+    def write(self, path: str, text: str, message: str = ""):
+        self.write_many({path: text}, message)
+        return 200, None
+
+    def write_many(self, files: Dict[str, str], message: str = "", rebuild=None) -> Dict[str, Any]:
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                for path, text in files.items():
+                    target = self._file(path)
+                    tmp = f"{target}.tmp.{os.getpid()}.{threading.get_ident()}"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.write(text)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, target)
+                dfd = os.open(self.root, os.O_RDONLY)
+                try:
+                    os.fsync(dfd)
+                finally:
+                    os.close(dfd)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return {path: 200 for path in files}
+
+
+MIRROR_RETRY_S = float(os.getenv("STATE_MIRROR_RETRY_S") or 2)
+MIRROR_RETRY_MAX_S = float(os.getenv("STATE_MIRROR_RETRY_MAX_S") or 300)
+
+
+class GitHubMirror:
+    """Background pusher: latest text per path is written to GitHub off the hot path.
+    A failed push goes back into the queue (unless a newer value for that path arrived
+    meanwhile) and is retried with exponential backoff: GitHub seeds fresh containers,
+    so a dropped push would hand them a stale cursor."""
+
+    def __init__(self, github: GitHubStateStore):
+        self.github = github
+        self._pending: Dict[str, Tuple[str, str]] = {}
+        self._inflight = False
+        self._retry_at = 0.0
+        self._retry_s = 0.0
+        self._cv = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self.last_error: Optional[str] = None
+
+    def submit(self, files: Dict[str, str], message: str):
+        with self._cv:
+            for path, text in files.items():
+                self._pending[path] = (text, message)  # coalesce: only the newest value matters
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="state-github-mirror", daemon=True)
+                self._thread.start()
+            self._cv.notify_all()
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                while not self._pending or self._retry_at > time.monotonic():
+                    self._cv.wait(max(0.0, self._retry_at - time.monotonic()) if self._pending else None)
+                batch = dict(self._pending)
+                self._pending.clear()
+                self._inflight = True
+            files = {path: text for path, (text, _) in batch.items()}
+            messages = sorted({message for _, message in batch.values() if message})
+            try:
+                statuses = self.github.write_many(files, "; ".join(messages) or "state: mirror")
+                bad = {p: st for p, st in statuses.items() if st not in (200, 201)}
+                self.last_error = f"mirror write failed: {bad}" if bad else None
+            except Exception as e:
+                bad = dict.fromkeys(batch, 0)
+                self.last_error = f"{type(e).__name__}: {e}"
+            with self._cv:
+                for path in bad:
+                    self._pending.setdefault(path, batch[path])  # a newer submit wins
+                if bad:
+                    self._retry_s = min(MIRROR_RETRY_MAX_S, self._retry_s * 2 if self._retry_s else MIRROR_RETRY_S)
+                    self._retry_at = time.monotonic() + self._retry_s
+                else:
+                    self._retry_s = self._retry_at = 0.0
+                self._inflight = False
+                self._cv.notify_all()
+
+    def flush(self, timeout_s: float = 30.0) -> bool:
+        """Wait until everything submitted so far has been pushed. False on timeout,
+        including while a failed push is still waiting for its retry."""
+        deadline = time.monotonic() + timeout_s
+        with self._cv:
+            while self._pending or self._inflight:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cv.wait(left)
+        return True
+
+
+class MirroredStateStore(StateStore):
+    """Local backend is the source of truth; GitHub is an optional async mirror and the
+    one-time seed for keys the local store has never seen (first start on a new disk)."""
+
+    def __init__(self, local: StateStore, mirror: Optional[GitHubMirror]):
+        self.local = local
+        self.mirror = mirror
+        self.name = local.name + ("+github_mirror" if mirror else "")
+
+    def read(self, path: str) -> ReadResult:
+        text, st, err = self.local.read(path)
+        if st != 404 or self.mirror is None or not self.mirror.github._token():
+            return text, st, err
+        gtext, gst, gerr = self.mirror.github.read(path)
+        if gst == 200 and gtext is not None:
+            self.local.write(path, gtext)
+        return gtext, gst, gerr
+
+    def write(self, path: str, text: str, message: str = ""):
+        st, err = self.local.write(path, text, message)
+        if self.mirror is not None:
+            self.mirror.submit({path: text}, message)
+        return st, err
+
+    def write_many(self, files: Dict[str, str], message: str = "", rebuild=None) -> Dict[str, Any]:
+        out = self.local.write_many(files, message)
+        if self.mirror is not None and files:
+            self.mirror.submit(files, message)
+        return out
+
+
+_store: Optional[StateStore] = None
+_store_lock = threading.Lock()
+
+
+def _build() -> StateStore:
+    backend = (os.getenv("STATE_BACKEND") or "github").strip().lower()
+    if backend == "github":
+        return GitHubStateStore()
+    if backend == "sqlite":
+        local: StateStore = SqliteStateStore()
+    elif backend == "file":
+        local = FileStateStore()
+    else:
+        raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+    mirror = None
+    if (os.getenv("STATE_GITHUB_MIRROR") or "").strip().lower() in ("1", "true", "yes"):
+        mirror = GitHubMirror(GitHubStateStore())
+        atexit.register(mirror.flush)
+    return MirroredStateStore(local, mirror)
+
+
+def get_store() -> StateStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _build()
+    return _store
+
+
+def flush_mirror(timeout_s: float = 30.0) -> bool:
+    """Wait for the async GitHub mirror (if any) to push what it has queued."""
+    store = _store
+    mirror = getattr(store, "mirror", None)
+    return mirror.flush(timeout_s) if mirror is not None else True
@@ -0,0 +1,172 @@
+"""
+Durable priority queue of sale ids announced by POST /webhook/sale.
+
+When the queue has due entries, step_01 skips the /api/sales call (the listing is
+still fetched lazily if step_02 later needs the forward scan) and step_02 picks
+from here before pending drafts and the forward cursor: highest priority first,
+then the oldest id.
+
+A webhook pick never moves the forward cursor: the announced id may be ahead of
+documents that are not processed yet. Acked webhook ids above the cursor are kept
+in state/webhook_done_ids.txt (GitHub state, committed together with the rest of
+the state); the forward scan steps over them without fetching or resending them
+and moves the cursor past them. Ids at or below the cursor are pruned from it.
+A claimed id that is already at/below the cursor (and not a pending draft) or
+already in that file is dropped without processing.
+
+claim() pushes the entry's next attempt out (WEBHOOK_QUEUE_RETRY_S * 2^attempts)
+before the run processes it, so a document that keeps failing cannot block the
+queue; step_08 removes it once acked (or deferred as a draft). Entries that were
+claimed WEBHOOK_QUEUE_MAX_ATTEMPTS times are dropped; the forward scan or the
+pending list still cover them.
+
+Env:
+  WEBHOOK_QUEUE               1 (default) / 0 to disable
+  WEBHOOK_QUEUE_PATH          sqlite file (default <LOCAL_DATA_DIR>/webhook_queue.sqlite3)
+  WEBHOOK_QUEUE_RETRY_S       first retry delay after a failed attempt (60)
+  WEBHOOK_QUEUE_MAX_ATTEMPTS  claims before an entry is dropped (5)
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from common.local_db import connect, data_path
+
+DONE_STATE_PATH = "state/webhook_done_ids.txt"
+
+RETRY_S = int(os.getenv("WEBHOOK_QUEUE_RETRY_S") or 60)
+MAX_ATTEMPTS = int(os.getenv("WEBHOOK_QUEUE_MAX_ATTEMPTS") or 5)
+
+_init_lock = threading.Lock()
+_initialized_path: Optional[str] = None
+
+
+def parse_done(text: Optional[str]) -> List[int]:
+    """state/webhook_done_ids.txt -> sorted ids (one per line)."""
+    return sorted({int(t) for t in (text or "").replace(",", "\n").split() if t.isdigit()})
+
+
+def dump_done(ids: Iterable[int]) -> str:
+    return "".join(f"{i}\n" for i in sorted({int(i) for i in ids}))
+
+
+def enabled() -> bool:
+    return (os.getenv("WEBHOOK_QUEUE") or "1").strip().lower() not in ("0", "false", "no")
+
+
+def _path() -> str:
+    return os.getenv("WEBHOOK_QUEUE_PATH") or data_path("webhook_queue.sqlite3")
+
+
+def _conn():
+    global _initialized_path
+    path = _path()
+    conn = connect(path)
+    if _initialized_path != path:
+        with _init_lock:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS queue ("
+                " doc_id INTEGER PRIMARY KEY, priority INTEGER NOT NULL DEFAULT 0,"
+                " enqueued_at REAL NOT NULL, not_before REAL NOT NULL DEFAULT 0,"
+                " attempts INTEGER NOT NULL DEFAULT 0, source TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS queue_due ON queue (not_before)")
+            _initialized_path = path
+    return conn
+
+
+def push(doc_ids: Iterable[int], priority: int = 0, source: str = "webhook") -> int:
+    """Enqueue (or re-announce) ids. A re-announced id becomes due now and keeps the
+    higher priority. Returns the number of ids written."""
+    now = time.time()
+    rows = [(int(d), int(priority), now, source) for d in doc_ids]
+    if not rows:
+        return 0
+    conn = _conn()
+    try:
+        conn.executemany(
+            "INSERT INTO queue (doc_id, priority, enqueued_at, not_before, attempts, source)"
+            " VALUES (?, ?, ?, 0, 0, ?)"
+            " ON CONFLICT(doc_id) DO UPDATE SET priority = MAX(priority, excluded.priority),"
+            " not_before = 0, source = excluded.source",
+            rows,
+        )
+    finally:
+        conn.close()
+    return len(rows)
+
+
+def due_count(now: Optional[float] = None) -> int:
+    now = now if now is not None else time.time()
+    conn = _conn()
+    try:
+        return conn.execute(
+            "SELECT COUNT(*) FROM queue WHERE not_before <= ? AND attempts < ?", (now, MAX_ATTEMPTS)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def claim(now: Optional[float] = None) -> Optional[int]:
+    """Next due id (priority desc, id asc); its next attempt is pushed out before it is
+    returned. Drops entries that used up WEBHOOK_QUEUE_MAX_ATTEMPTS. None when nothing is due."""
+    now = now if now is not None else time.time()
+    conn = _conn()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM queue WHERE attempts >= ?", (MAX_ATTEMPTS,))
+        row = conn.execute(
+            "SELECT doc_id, attempts FROM queue WHERE not_before <= ?"
+            " ORDER BY priority DESC, doc_id ASC LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE queue SET attempts = attempts + 1, not_before = ? WHERE doc_id = ?",
+                (now + RETRY_S * (2 ** row[1]), row[0]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return int(row[0]) if row is not None else None
+
+
+def peek(now: Optional[float] = None) -> Optional[int]:
+    """Same pick as claim() without touching the entry (/debug, skip_state_update runs)."""
+    now = now if now is not None else time.time()
+    conn = _conn()
+    try:
+        row = conn.execute(
+            "SELECT doc_id FROM queue WHERE not_before <= ? AND attempts < ?"
+            " ORDER BY priority DESC, doc_id ASC LIMIT 1",
+            (now, MAX_ATTEMPTS),
+        ).fetchone()
+    finally:
+        conn.close()
+    return int(row[0]) if row is not None else None
+
+
+def done(doc_id: int) -> int:
+    conn = _conn()
+    try:
+        n = conn.execute("DELETE FROM queue WHERE doc_id = ?", (int(doc_id),)).rowcount or 0
+    finally:
+        conn.close()
+    return n
+
+
+def stats(now: Optional[float] = None) -> Dict[str, int]:
+    now = now if now is not None else time.time()
+    conn = _conn()
+    try:
+        size, due = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(not_before <= ? AND attempts < ?), 0) FROM queue",
+            (now, MAX_ATTEMPTS),
+        ).fetchone()
+    finally:
+        conn.close()
+    return {"size": int(size), "due": int(due)}
@@ -0,0 +1,233 @@
+"""
+End-to-end throughput benchmark of run_pipeline against local stand-ins.
+
+Starts FakePayTraq, FakeWorker (devtools.fake_paytraq) and FakeGitHub
+(devtools.fake_github) on 127.0.0.1, points the service at them and drives
+runner.run_pipeline through these scenarios, each on fresh state:
+
+  normal    single /run calls, one booked document each (forward cursor)
+  override  /run {"document_ref": ...} for random documents (ref scan + index)
+  pending   deferred drafts in state/pending_draft_ids.txt, half of them booked
+  batch     /run {"max_documents": B} until idle
+
+Reported per scenario: documents/s, p50/p99 run latency, calls per document
+(PayTraq / GitHub / worker) and the worker payload bytes.
+
+    python -m devtools.bench_pipeline
+    python -m devtools.bench_pipeline --docs 200 --latency-ms 20 --paytraq-error-rate 0.02 \\
+        --line-items 40 --scenarios normal,batch --json
+
+Nothing leaves the machine: PayTraq, GitHub and the worker are all local.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+CURSOR_START = 1000
+SCENARIOS = ("normal", "override", "pending", "batch")
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+class _Env:
+    """Fresh fakes + local data paths for one scenario."""
+
+    def __init__(self, args, name: str):
+        from devtools.fake_github import FakeGitHub
+        from devtools.fake_paytraq import FakePayTraq, FakeWorker
+
+        latency_s = args.latency_ms / 1000.0
+        self.paytraq = FakePayTraq(line_items=args.line_items, latency_s=latency_s,
+                                   error_rate=args.paytraq_error_rate, seed=args.seed)
+        self.worker = FakeWorker(latency_s=latency_s, error_rate=args.worker_error_rate, seed=args.seed)
+        self.github = FakeGitHub()
+        self.github.latency_s = latency_s
+        data = tempfile.mkdtemp(prefix=f"bench-{name}-")
+        os.environ.update({
+            "PAYTRAQ_BASE_URL": self.paytraq.start(),
+            "WORKER_URL": self.worker.start(),
+            "GITHUB_API_URL": self.github.start(),
+            "DEDUPE_LEDGER_PATH": os.path.join(data, "dedupe_ledger.sqlite3"),
+            "CLIENT_CACHE_PATH": os.path.join(data, "client_cache.sqlite3"),
+            "DOC_INDEX_PATH": os.path.join(data, "doc_index.sqlite3"),
+            "JOURNAL_DIR": os.path.join(data, "journal"),
+            "RUN_LEASE_PATH": os.path.join(data, "run_lease.sqlite3"),
+            "WEBHOOK_QUEUE_PATH": os.path.join(data, "webhook_queue.sqlite3"),
+        })
+
+    def calls(self) -> Dict[str, int]:
+        return {
+            "paytraq": sum(self.paytraq.calls.values()),
+            "github": sum(self.github.calls.values()),
+            "worker": self.worker.calls.get("process", 0),
+        }
+
+    def stop(self):
+        for fake in (self.paytraq, self.worker, self.github):
+            fake.stop()
+
+
+def _configure_process(args) -> None:
+    """Env the steps read at import time; must run before `runner` is imported."""
+    os.environ["PAYTRAQ_BASE_URL"] = "http://127.0.0.1:9"  # replaced per scenario
+    os.environ.setdefault("PAYTRAQ_API_KEY", "bench")
+    os.environ.setdefault("PAYTRAQ_API_TOKEN", "bench")
+    os.environ.setdefault("GITHUB_TOKEN", "bench")
+    os.environ["STATE_BACKEND"] = "github"
+    os.environ["STATE_GITHUB_MIRROR"] = "0"
+    os.environ["ARTIFACT_SINK"] = "github" if args.artifacts else "none"
+    os.environ.setdefault("HTTP_BACKOFF_S", "0.05")
+    if args.payload_mode:
+        os.environ["WORKER_PAYLOAD_MODE"] = args.payload_mode
+
+
+def _base_urls_changed() -> None:
+    """Step modules keep PAYTRAQ_BASE_URL / WORKER_URL as module constants."""
+    from steps import (step_01_fetch_sales_list, step_02_pick_next_doc, step_03_fetch_full_document,
+                       step_04_extract_client_data, step_06_call_worker)
+
+    base = os.environ["PAYTRAQ_BASE_URL"]
+    for mod in (step_01_fetch_sales_list, step_02_pick_next_doc, step_03_fetch_full_document,
+                step_04_extract_client_data):
+        mod.PAYTRAQ_BASE_URL = base
+    step_06_call_worker.WORKER_URL = os.environ["WORKER_URL"]
+
+
+def _drive(env: _Env, payloads) -> Dict[str, Any]:
+    import runner
+
+    latencies: List[float] = []
+    outcomes: Dict[str, int] = {}
+    docs = 0
+    started = time.perf_counter()
+    for payload in payloads:
+        t0 = time.perf_counter()
+        ctx = runner.run_pipeline(payload)
+        latencies.append(time.perf_counter() - t0)
+        if "documents" in ctx:
+            results = [d["status"] for d in ctx["documents"]]
+        elif ctx.get("idle"):
+            results = []
+        else:
+            status = runner._doc_result(ctx, [])["status"]
+            if status == "not_acked" and ctx.get("skip_state_update") and ctx.get("worker_status_code") == 200:
+                status = "ok"  # step_08 skipped -> no ack computed
+            results = [status]
+        for st in results:
+            outcomes[st] = outcomes.get(st, 0) + 1
+        docs += len(results)
+        if "documents" in ctx and not results:
+            break  # batch caught up
+    wall = time.perf_counter() - started
+    calls = env.calls()
+    per_doc = {k: round(v / docs, 2) if docs else None for k, v in calls.items()}
+    return {
+        "runs": len(latencies),
+        "documents": docs,
+        "outcomes": outcomes,
+        "wall_s": round(wall, 3),
+        "docs_per_s": round(docs / wall, 2) if wall else None,
+        "run_p50_ms": round(_pct(latencies, 50) * 1000, 1),
+        "run_p99_ms": round(_pct(latencies, 99) * 1000, 1),
+        "calls": calls,
+        "calls_per_doc": per_doc,
+        "worker_bytes": env.worker.bytes_received,
+        "worker_payload_versions": dict(env.worker.payload_versions),
+    }
+
+
+def _ids(args) -> range:
+    return range(CURSOR_START + 1, CURSOR_START + 1 + args.docs)
+
+
+def scenario_normal(args, env: _Env):
+    env.paytraq.add_sales(_ids(args), "paid")
+    env.github.seed({"state/last_processed_id.txt": str(CURSOR_START)})
+    return _drive(env, ({} for _ in range(args.docs)))
+
+
+def scenario_override(args, env: _Env):
+    env.paytraq.add_sales(_ids(args), "paid")
+    env.github.seed({"state/last_processed_id.txt": str(CURSOR_START)})
+    rnd = random.Random(args.seed)
+    picks = rnd.sample(list(_ids(args)), min(args.override_runs, args.docs))
+    # skip_state_update: an override would otherwise move the cursor past the other picks
+    return _drive(env, ({"document_ref": f"ALE {i}", "date_from": "2026-01-01", "date_to": "2026-01-31",
+                         "skip_state_update": True} for i in picks))
+
+
+def scenario_pending(args, env: _Env):
+    ids = list(_ids(args))
+    env.paytraq.add_sales(ids, "draft")
+    for i in ids[::2]:
+        env.paytraq.set_status(i, "paid")
+    env.github.seed({
+        "state/last_processed_id.txt": str(ids[-1]),
+        "state/pending_draft_ids.txt": "".join(f"{i}\n" for i in ids),
+    })
+    return _drive(env, ({} for _ in range(len(ids[::2]) + 1)))
+
+
+def scenario_batch(args, env: _Env):
+    env.paytraq.add_sales(_ids(args), "paid")
+    env.github.seed({"state/last_processed_id.txt": str(CURSOR_START)})
+    n_runs = args.docs // max(1, args.batch_size) + 2
+    return _drive(env, ({"max_documents": args.batch_size} for _ in range(n_runs)))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--docs", type=int, default=50, help="documents per scenario")
+    ap.add_argument("--batch-size", type=int, default=25, help="max_documents per batch run")
+    ap.add_argument("--override-runs", type=int, default=10)
+    ap.add_argument("--latency-ms", type=float, default=5.0, help="added to every fake request")
+    ap.add_argument("--paytraq-error-rate", type=float, default=0.0)
+    ap.add_argument("--worker-error-rate", type=float, default=0.0)
+    ap.add_argument("--line-items", type=int, default=5, help="line items per sale XML")
+    ap.add_argument("--payload-mode", choices=("raw", "structured"), default=None)
+    ap.add_argument("--artifacts", action="store_true", help="also commit debug artifacts to the fake GitHub")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args(argv)
+
+    _configure_process(args)
+    results: Dict[str, Any] = {}
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        fn = globals().get(f"scenario_{name}")
+        if fn is None:
+            print(f"unknown scenario: {name}", file=sys.stderr)
+            return 2
+        env = _Env(args, name)
+        _base_urls_changed()
+        try:
+            results[name] = fn(args, env)
+        finally:
+            from common import artifacts
+            artifacts.shutdown(timeout_s=10.0)
+            env.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print(f"{'scenario':<10} {'docs':>5} {'docs/s':>8} {'p50 ms':>8} {'p99 ms':>8}  calls/doc (paytraq/github/worker)  outcomes")
+    for name, r in results.items():
+        cpd = r["calls_per_doc"]
+        print(f"{name:<10} {r['documents']:>5} {r['docs_per_s'] or 0:>8} {r['run_p50_ms']:>8} {r['run_p99_ms']:>8}"
+              f"  {cpd['paytraq']}/{cpd['github']}/{cpd['worker']:<28}  {r['outcomes']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,332 @@
+"""
+In-memory fake of the GitHub REST endpoints this service uses, for offline runs.
+
+Covers the Contents API (GET/PUT file) and the Git Data API (refs, commits, trees,
+blobs) with real fast-forward semantics on `PATCH git/refs` (force=false -> 422 when
+the new commit does not descend from the current head), so CAS retries can be
+exercised locally.
+
+    python -m devtools.fake_github --port 8765        # serve
+    python -m devtools.fake_github --selfcheck        # commit state through it and verify
+
+Point the service at it with GITHUB_API_URL=http://127.0.0.1:8765 GITHUB_TOKEN=x.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse, unquote
+
+
+def _sha(kind: str, data: bytes) -> str:
+    return hashlib.sha1(kind.encode() + b"\0" + data).hexdigest()
+
+
+class FakeRepo:
+    def __init__(self, branch: str = "main"):
+        self.lock = threading.RLock()
+        self.branch = branch
+        self.blobs: Dict[str, bytes] = {}
+        self.trees: Dict[str, Dict[str, str]] = {}
+        self.commits: Dict[str, dict] = {}
+        self.refs: Dict[str, str] = {}
+        root_tree = self._put_tree({})
+        self.refs[branch] = self._put_commit("initial", root_tree, [])
+        self.commit_count = 0  # commits created after the initial one
+
+    def _put_blob(self, data: bytes) -> str:
+        sha = _sha("blob", data)
+        self.blobs[sha] = data
+        return sha
+
+    def _put_tree(self, entries: Dict[str, str]) -> str:
+        sha = _sha("tree", json.dumps(sorted(entries.items())).encode())
+        self.trees[sha] = dict(entries)
+        return sha
+
+    def _put_commit(self, message: str, tree: str, parents: List[str]) -> str:
+        sha = _sha("commit", json.dumps([message, tree, parents, len(self.commits)]).encode())
+        self.commits[sha] = {"message": message, "tree": tree, "parents": list(parents)}
+        return sha
+
+    def head_files(self, branch: Optional[str] = None) -> Dict[str, bytes]:
+        with self.lock:
+            tree = self.trees[self.commits[self.refs[branch or self.branch]]["tree"]]
+            return {p: self.blobs[s] for p, s in tree.items()}
+
+    def _descends(self, sha: str, ancestor: str) -> bool:
+        stack = [sha]
+        while stack:
+            cur = stack.pop()
+            if cur == ancestor:
+                return True
+            stack.extend(self.commits.get(cur, {}).get("parents", []))
+        return False
+
+
+class FakeGitHub:
+    def __init__(self, owner: str = "AlendaSIA", repo: str = "Jaunais_step0-trigger", branch: str = "main"):
+        self.owner = owner
+        self.repo_name = repo
+        self.repo = FakeRepo(branch)
+        self.calls: Counter = Counter()
+        self.latency_s = 0.0  # added to every request (benchmarks)
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    # ---- lifecycle ----
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        fake = self
+
+        class Handler(_Handler):
+            gh = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-github", daemon=True).start()
+        return self.url
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # ---- helpers for checks ----
+    def files(self) -> Dict[str, str]:
+        return {p: b.decode("utf-8", "replace") for p, b in self.repo.head_files().items()}
+
+    def seed(self, files: Dict[str, str], message: str = "seed"):
+        r = self.repo
+        with r.lock:
+            head = r.refs[r.branch]
+            entries = dict(r.trees[r.commits[head]["tree"]])
+            for p, text in files.items():
+                entries[p] = r._put_blob(text.encode("utf-8"))
+            r.refs[r.branch] = r._put_commit(message, r._put_tree(entries), [head])
+
+
+class _Handler(BaseHTTPRequestHandler):
+    gh: FakeGitHub
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, obj) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(n) or b"{}") if n else {}
+
+    def _route(self, method: str):
+        if self.gh.latency_s:
+            time.sleep(self.gh.latency_s)
+        path = unquote(urlparse(self.path).path)
+        prefix = f"/repos/{self.gh.owner}/{self.gh.repo_name}"
+        if not path.startswith(prefix):
+            self.gh.calls[(method, "other")] += 1
+            return self._send(404, {"message": "Not Found"})
+        rest = path[len(prefix):]
+        repo = self.gh.repo
+        body = self._body() if method in ("POST", "PUT", "PATCH") else {}
+
+        with repo.lock:
+            if rest == "" and method == "GET":
+                self.gh.calls[(method, "repo")] += 1
+                return self._send(200, {"full_name": f"{self.gh.owner}/{self.gh.repo_name}",
+                                        "default_branch": repo.branch})
+
+            m = re.match(r"^/contents/(.+)$", rest)
+            if m:
+                self.gh.calls[(method, "contents")] += 1
+                return self._contents(method, m.group(1), body, parse_qs(urlparse(self.path).query).get("ref", [None])[0])
+
+            m = re.match(r"^/git/refs?/heads/(.+)$", rest)
+            if m:
+                self.gh.calls[(method, "git/refs")] += 1
+                br = m.group(1)
+                if method == "GET":
+                    if br not in repo.refs:
+                        return self._send(404, {"message": "Not Found"})
+                    return self._send(200, {"ref": f"refs/heads/{br}", "object": {"sha": repo.refs[br], "type": "commit"}})
+                if method == "PATCH":
+                    new = body.get("sha")
+                    if new not in repo.commits:
+                        return self._send(422, {"message": "Object does not exist"})
+                    if not body.get("force") and not repo._descends(new, repo.refs.get(br, "")):
+                        return self._send(422, {"message": "Update is not a fast forward"})
+                    repo.refs[br] = new
+                    repo.commit_count += 1
+                    return self._send(200, {"ref": f"refs/heads/{br}", "object": {"sha": new, "type": "commit"}})
+
+            m = re.match(r"^/git/commits(?:/([0-9a-f]+))?$", rest)
+            if m:
+                self.gh.calls[(method, "git/commits")] += 1
+                if method == "GET":
+                    c = repo.commits.get(m.group(1) or "")
+                    if c is None:
+                        return self._send(404, {"message": "Not Found"})
+                    return self._send(200, {"sha": m.group(1), "message": c["message"], "tree": {"sha": c["tree"]},
+                                            "parents": [{"sha": p} for p in c["parents"]]})
+                if method == "POST":
+                    if body.get("tree") not in repo.trees:
+                        return self._send(422, {"message": "Tree does not exist"})
+                    sha = repo._put_commit(body.get("message") or "", body["tree"], body.get("parents") or [])
+                    return self._send(201, {"sha": sha})
+
+            if rest == "/git/trees" and method == "POST":
+                self.gh.calls[(method, "git/trees")] += 1
+                entries = dict(repo.trees.get(body.get("base_tree") or "", {}))
+                for e in body.get("tree") or []:
+                    if "content" in e:
+                        entries[e["path"]] = repo._put_blob(e["content"].encode("utf-8"))
+                    elif e.get("sha"):
+                        entries[e["path"]] = e["sha"]
+                    else:
+                        entries.pop(e["path"], None)
+                return self._send(201, {"sha": repo._put_tree(entries)})
+
+            if rest == "/git/blobs" and method == "POST":
+                self.gh.calls[(method, "git/blobs")] += 1
+                raw = body.get("content") or ""
+                data = base64.b64decode(raw) if body.get("encoding") == "base64" else raw.encode("utf-8")
+                return self._send(201, {"sha": repo._put_blob(data)})
+
+        self.gh.calls[(method, "other")] += 1
+        return self._send(404, {"message": "Not Found"})
+
+    def _contents(self, method: str, path: str, body: dict, ref: Optional[str] = None):
+        repo = self.gh.repo
+        head = repo.refs[repo.branch]
+        entries = dict(repo.trees[repo.commits[head]["tree"]])
+        if method == "GET":
+            if ref:
+                c = repo.commits.get(repo.refs.get(ref, ref))
+                if c is None:
+                    return self._send(404, {"message": "No commit found for the ref"})
+                entries = repo.trees[c["tree"]]
+            if path not in entries:
+                return self._send(404, {"message": "Not Found"})
+            data = repo.blobs[entries[path]]
+            return self._send(200, {"path": path, "sha": entries[path], "encoding": "base64",
+                                    "content": base64.b64encode(data).decode("ascii")})
+        if method == "PUT":
+            if path in entries and body.get("sha") != entries[path]:
+                code = 409 if body.get("sha") else 422
+                return self._send(code, {"message": "sha mismatch" if body.get("sha") else "\"sha\" wasn't supplied."})
+            existed = path in entries
+            entries[path] = repo._put_blob(base64.b64decode(body.get("content") or ""))
+            commit = repo._put_commit(body.get("message") or "", repo._put_tree(entries), [head])
+            repo.refs[repo.branch] = commit
+            repo.commit_count += 1
+            return self._send(200 if existed else 201, {"content": {"path": path, "sha": entries[path]},
+                                                         "commit": {"sha": commit}})
+        return self._send(405, {"message": "Method Not Allowed"})
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_PUT(self):
+        self._route("PUT")
+
+    def do_PATCH(self):
+        self._route("PATCH")
+
+
+def _selfcheck() -> int:
+    fake = FakeGitHub()
+    os.environ["GITHUB_API_URL"] = fake.start()
+    os.environ.setdefault("GITHUB_TOKEN", "offline")
+    os.environ["GITHUB_OWNER"], os.environ["GITHUB_REPO"] = fake.owner, fake.repo_name
+
+    from common import github_api
+    from common.state_store import GitHubStateStore
+
+    fake.seed({"state/last_processed_id.txt": "100", "state/in_progress_id.txt": "101"})
+    before = fake.repo.commit_count
+    store = GitHubStateStore()
+    statuses = store.write_many({
+        "state/last_processed_id.txt": "101",
+        "state/in_progress_id.txt": "0",
+        "state/pending_draft_ids.txt": "95\n",
+    }, "state: selfcheck")
+    files = fake.files()
+    assert all(st == 201 for st in statuses.values()), statuses
+    assert fake.repo.commit_count - before == 1, "expected exactly one commit"
+    assert files["state/last_processed_id.txt"] == "101" and files["state/in_progress_id.txt"] == "0"
+    assert store.read("state/pending_draft_ids.txt")[0] == "95"
+
+    # CAS: a head that moves between our read and the ref update must not be overwritten.
+    real_post = github_api.http_client.post
+
+    def racing_post(url, **kw):
+        r = real_post(url, **kw)
+        if url.endswith("/git/commits") and not racing_post.done:
+            racing_post.done = True
+            fake.seed({"state/other.txt": "x"}, "concurrent writer")
+        return r
+
+    racing_post.done = False
+    github_api.http_client.post = racing_post
+    try:
+        st, info = github_api.commit_files("offline", {"state/last_processed_id.txt": "102"}, "state: cas")
+    finally:
+        github_api.http_client.post = real_post
+    files = fake.files()
+    assert st == 201 and info["attempts"] == 2, (st, info)
+    assert files["state/other.txt"] == "x" and files["state/last_processed_id.txt"] == "102"
+
+    # With a rebuild callback the lost race is recomputed from the new head (or refused).
+    racing_post.done = False
+    github_api.http_client.post = racing_post
+    try:
+        st, info = github_api.commit_files(
+            "offline", {"state/last_processed_id.txt": "103"}, "state: cas rebuild",
+            rebuild=lambda read: None if read("state/other.txt")[0] == "x" else {},
+        )
+    finally:
+        github_api.http_client.post = real_post
+    assert st == 409 and fake.files()["state/last_processed_id.txt"] == "102", (st, info)
+
+    fake.stop()
+    print("fake_github selfcheck OK", dict(fake.calls))
+    return 0
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--selfcheck", action="store_true")
+    args = ap.parse_args()
+    if args.selfcheck:
+        return _selfcheck()
+    fake = FakeGitHub()
+    print(f"fake GitHub on {fake.start(args.host, args.port)}")
+    threading.Event().wait()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
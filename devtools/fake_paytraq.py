@@ -0,0 +1,204 @@
+"""
+Local stand-ins for PayTraq and the worker, for offline runs and benchmarks.
+
+FakePayTraq serves the endpoints the steps use:
+  GET /api/sales?id_after=&page=        100 headers per page, ID ascending
+  GET /api/sale/{id}                    full sale XML (line_items lines each)
+  GET /api/client/{id}, /api/client/{contacts|shippingAddresses|banks}/{id}
+FakeWorker answers POST /process like the real worker ({"status": "created", "_trace": [...]}),
+including gzip-compressed (payload_version 2) bodies.
+
+Both take latency_s (added per request) and error_rate (share of requests answered
+503 / 500) so retries and failures can be exercised.
+
+    fake = FakePayTraq(); os.environ["PAYTRAQ_BASE_URL"] = fake.start()
+    fake.add_sales(range(1001, 1101), status="paid")
+"""
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Optional
+from urllib.parse import parse_qs, urlparse
+
+SALES_PAGE_SIZE = 100
+
+
+def sale_xml(doc_id: int, status: str, line_items: int = 3, client_id: int = 700001) -> str:
+    lines = "".join(
+        "<LineItem><LineItemID>{n}</LineItemID><Item><ItemID>{item}</ItemID><ItemCode>SKU-{item}</ItemCode>"
+        "<ItemName>Item {item} description text</ItemName><ItemType>1</ItemType></Item>"
+        "<Qty>{qty}</Qty><Price>{price}</Price><Discount>0.00</Discount><LineTotal>{total}</LineTotal>"
+        "<TaxKey><TaxKeyID>1</TaxKeyID><TaxKeyName>PVN 21%</TaxKeyName></TaxKey>"
+        "<Comment></Comment></LineItem>".format(
+            n=doc_id * 100 + i, item=1000 + i, qty=1 + i % 3, price="12.50", total=f"{12.5 * (1 + i % 3):.2f}"
+        )
+        for i in range(line_items)
+    )
+    return (
+        "<Sale><Header><Document>"
+        f"<DocumentID>{doc_id}</DocumentID><DocumentDate>2026-01-{doc_id % 28 + 1:02d}</DocumentDate>"
+        f"<DocumentRef>ALE {doc_id}</DocumentRef><DocumentType>sale</DocumentType>"
+        f"<DocumentStatus>{status}</DocumentStatus>"
+        f"<Client><ClientID>{client_id}</ClientID><ClientName>Client {client_id}</ClientName></Client>"
+        "</Document><SaleType>sales_invoice</SaleType><Operation>sell_goods</Operation>"
+        "<Total>100.00</Total><Currency>EUR</Currency><Comment>M-0000-0000, Payment Gateway</Comment>"
+        f"</Header><LineItems>{lines}</LineItems></Sale>"
+    )
+
+
+class _Server(ABC):
+    name = "fake"
+
+    def __init__(self, latency_s: float = 0.0, error_rate: float = 0.0, seed: int = 1):
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+        self._rnd = random.Random(seed)
+        self._rnd_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        fake = self
+
+        class Handler(_Handler):
+            srv = fake
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name=self.name, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def should_fail(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._rnd_lock:
+            return self._rnd.random() < self.error_rate
+
+    @abstractmethod
+    def handle(self, method: str, path: str, query: Dict[str, str], body: bytes, headers) -> tuple:
+        """-> (status, content_type, body bytes)."""
+
+
+class FakePayTraq(_Server):
+    name = "fake-paytraq"
+
+    def __init__(self, line_items: int = 3, **kw):
+        super().__init__(**kw)
+        self.line_items = line_items
+        self.lock = threading.Lock()
+        self.sales: Dict[int, str] = {}  # id -> status
+
+    def add_sales(self, ids: Iterable[int], status: str = "paid") -> None:
+        with self.lock:
+            for i in ids:
+                self.sales[int(i)] = status
+
+    def set_status(self, doc_id: int, status: str) -> None:
+        with self.lock:
+            self.sales[int(doc_id)] = status
+
+    def handle(self, method, path, query, body, headers):
+        if self.should_fail():
+            self.calls["error"] += 1
+            return 503, "text/plain", b"Service Unavailable"
+        if path == "/api/sales":
+            self.calls["sales"] += 1
+            after = int(query.get("id_after") or 0)
+            page = int(query.get("page") or 0)
+            with self.lock:
+                ids = sorted(i for i in self.sales if i > after)[page * SALES_PAGE_SIZE:(page + 1) * SALES_PAGE_SIZE]
+                rows = [(i, self.sales[i]) for i in ids]
+            xml = "<Sales>" + "".join(
+                f"<Sale><Header><Document><DocumentID>{i}</DocumentID><DocumentDate>2026-01-{i % 28 + 1:02d}</DocumentDate>"
+                f"<DocumentRef>ALE {i}</DocumentRef><DocumentStatus>{st}</DocumentStatus></Document></Header></Sale>"
+                for i, st in rows
+            ) + "</Sales>"
+            return 200, "application/xml", xml.encode()
+        m = re.match(r"^/api/sale/(\d+)$", path)
+        if m:
+            self.calls["sale"] += 1
+            with self.lock:
+                st = self.sales.get(int(m.group(1)))
+            if st is None:
+                return 404, "text/plain", b"Not Found"
+            return 200, "application/xml", sale_xml(int(m.group(1)), st, self.line_items).encode()
+        m = re.match(r"^/api/client/(?:(contacts|shippingAddresses|banks)/)?(\d+)$", path)
+        if m:
+            self.calls["client/" + (m.group(1) or "client")] += 1
+            cid = m.group(2)
+            return 200, "application/xml", (
+                f"<Client><ClientID>{cid}</ClientID><Name>Client {cid}</Name><Email>c{cid}@example.com</Email></Client>"
+            ).encode()
+        self.calls["other"] += 1
+        return 404, "text/plain", b"Not Found"
+
+
+class FakeWorker(_Server):
+    name = "fake-worker"
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.payload_versions: Counter = Counter()
+        self.bytes_received = 0
+
+    def handle(self, method, path, query, body, headers):
+        if method != "POST" or path.rstrip("/") != "/process":
+            self.calls["other"] += 1
+            return 404, "application/json", b"{}"
+        self.calls["process"] += 1
+        self.bytes_received += len(body)
+        if self.should_fail():
+            self.calls["error"] += 1
+            return 500, "application/json", json.dumps({"status": "error"}).encode()
+        if (headers.get("Content-Encoding") or "").lower() == "gzip":
+            body = gzip.decompress(body)
+        payload = json.loads(body or b"{}")
+        self.payload_versions[payload.get("payload_version") or 1] += 1
+        doc_id = (payload.get("document") or {}).get("id")
+        out = {"status": "created", "deal_id": doc_id, "_trace": [{"step": "upsert_deal", "ok": True}]}
+        return 200, "application/json", json.dumps(out).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    srv: _Server
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, *args):
+        pass
+
+    def _serve(self, method: str):
+        if self.srv.latency_s:
+            time.sleep(self.srv.latency_s)
+        u = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(u.query).items()}
+        n = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(n) if n else b""
+        code, ctype, data = self.srv.handle(method, u.path, query, body, self.headers)
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_POST(self):
+        self._serve("POST")
@@ -0,0 +1,183 @@
+"""
+Offline replay of the recorded state/debug corpus through the sale-XML hot path.
+
+For every state/debug/sales_<id>.xml that has a matching extract_all_<id>.json it
+parses the XML once (SaleDocument), flattens the sale fields, builds the line
+items and reads the status/ref/date/client helpers. It then compares the result
+with what step_04 stored in that JSON. No network is involved. Pairs whose
+TimeStamps/Updated differ (the XML was re-saved after the document changed) are
+counted as stale instead of compared.
+
+Reported: documents, mismatches (first few shown), per-document cost of parse /
+fields / line items / helpers (mean, p50, p99 in ms) and, with --memory, the
+tracemalloc peak. Exit code 1 when any document mismatches, so it doubles as the
+regression check for changes to sale_document / step_04.
+
+    python -m devtools.replay_debug_corpus
+    python -m devtools.replay_debug_corpus --limit 500 --memory --json
+    python -m devtools.replay_debug_corpus --full-step     # whole step_04.run, client fetch off
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+DEFAULT_DIR = os.path.join("state", "debug")
+PHASES = ("parse", "fields", "line_items", "helpers")
+UPDATED_FIELD = "Sale/Header/TimeStamps/Updated"
+STALE = "stale"
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def _pairs(corpus: str, limit: Optional[int]):
+    out = []
+    for xml_path in sorted(glob.glob(os.path.join(corpus, "sales_*.xml"))):
+        m = re.search(r"sales_(\d+)\.xml$", xml_path)
+        json_path = os.path.join(corpus, f"extract_all_{m.group(1)}.json") if m else ""
+        if m and os.path.exists(json_path):
+            out.append((int(m.group(1)), xml_path, json_path))
+            if limit and len(out) >= limit:
+                break
+    return out
+
+
+def _updated(fields: List[Dict[str, Any]]) -> Optional[str]:
+    for row in fields:
+        if row.get("field") == UPDATED_FIELD:
+            return row.get("value")
+    return None
+
+
+def _replay_one(doc_id: int, xml: str, expected: Dict[str, Any], timings: Dict[str, List[float]]) -> List[str]:
+    from common.sale_document import SaleDocument
+
+    problems: List[str] = []
+    t0 = time.perf_counter()
+    doc = SaleDocument(xml)
+    root = doc.root
+    t1 = time.perf_counter()
+    if root is None:
+        return [f"parse error: {doc.parse_error}"]
+    fields = doc.field_rows
+    t2 = time.perf_counter()
+    line_items = doc.line_items
+    t3 = time.perf_counter()
+    helpers = (doc.document_id, doc.status, doc.ref, doc.date, doc.client_id)
+    t4 = time.perf_counter()
+
+    for name, a, b in (("parse", t0, t1), ("fields", t1, t2), ("line_items", t2, t3), ("helpers", t3, t4)):
+        timings[name].append((b - a) * 1000)
+
+    if _updated(fields) != _updated(expected.get("sale_fields") or []):
+        # sales_<id>.xml was re-saved after the document changed (e.g. a draft got booked);
+        # the extract is from the older version, so there is nothing to compare.
+        return [STALE]
+    if fields != expected.get("sale_fields"):
+        problems.append(f"sale_fields differ ({len(fields)} vs {len(expected.get('sale_fields') or [])})")
+    if line_items != expected.get("line_items"):
+        problems.append(f"line_items differ ({len(line_items)} vs {len(expected.get('line_items') or [])})")
+    if str(helpers[0]) != str(doc_id) or str(expected.get("document_id")) != str(doc_id):
+        problems.append(f"document_id {helpers[0]!r}")
+    if (helpers[4] or None) != (expected.get("client_id") or None):
+        problems.append(f"client_id {helpers[4]!r} vs {expected.get('client_id')!r}")
+    return problems
+
+
+def _replay_full_step(doc_id: int, xml: str, timings: Dict[str, List[float]]) -> List[str]:
+    from steps import step_04_extract_client_data
+
+    t0 = time.perf_counter()
+    ctx = step_04_extract_client_data.run({"next_document_id": doc_id, "paytraq_full_xml": xml})
+    timings["step_04"].append((time.perf_counter() - t0) * 1000)
+    return [ctx["error"]] if ctx.get("error") else []
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dir", default=DEFAULT_DIR, help="corpus directory (state/debug)")
+    ap.add_argument("--limit", type=int, default=0, help="replay at most N documents")
+    ap.add_argument("--memory", action="store_true", help="track peak memory with tracemalloc (slower)")
+    ap.add_argument("--full-step", action="store_true", help="time step_04.run instead of the parse phases")
+    ap.add_argument("--show", type=int, default=5, help="mismatches to print")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args(argv)
+
+    if args.full_step:
+        # No PayTraq credentials -> step_04 skips the client fetch; no artifacts either.
+        for k in ("PAYTRAQ_API_KEY", "PAYTRAQ_API_TOKEN", "PAYTRAQ_KEY", "PAYTRAQ_TOKEN"):
+            os.environ.pop(k, None)
+        os.environ["ARTIFACT_SINK"] = "none"
+
+    pairs = _pairs(args.dir, args.limit)
+    if not pairs:
+        print(f"no sales_<id>.xml + extract_all_<id>.json pairs under {args.dir}", file=sys.stderr)
+        return 2
+
+    timings: Dict[str, List[float]] = {p: [] for p in PHASES + ("step_04",)}
+    mismatches: List[Dict[str, Any]] = []
+    stale = 0
+    if args.memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for doc_id, xml_path, json_path in pairs:
+        with open(xml_path, encoding="utf-8") as f:
+            xml = f.read()
+        if args.full_step:
+            problems = _replay_full_step(doc_id, xml, timings)
+        else:
+            with open(json_path, encoding="utf-8") as f:
+                expected = json.load(f)
+            problems = _replay_one(doc_id, xml, expected, timings)
+        if problems == [STALE]:
+            stale += 1
+        elif problems:
+            mismatches.append({"doc_id": doc_id, "problems": problems})
+    wall = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if args.memory else None
+    if args.memory:
+        tracemalloc.stop()
+
+    report: Dict[str, Any] = {
+        "documents": len(pairs),
+        "mismatches": len(mismatches),
+        "stale_pairs": stale,
+        "wall_s": round(wall, 3),
+        "docs_per_s": round(len(pairs) / wall, 1) if wall else None,
+        "peak_mem_kib": round(peak / 1024, 1) if peak is not None else None,
+        "phases_ms": {
+            name: {
+                "mean": round(sum(v) / len(v), 4),
+                "p50": round(_pct(v, 50), 4),
+                "p99": round(_pct(v, 99), 4),
+                "total": round(sum(v), 1),
+            }
+            for name, v in timings.items() if v
+        },
+        "examples": mismatches[:args.show],
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"documents {report['documents']}  mismatches {report['mismatches']}  stale {stale}  "
+              f"wall {report['wall_s']}s  {report['docs_per_s']} docs/s"
+              + (f"  peak {report['peak_mem_kib']} KiB" if peak is not None else ""))
+        for name, st in report["phases_ms"].items():
+            print(f"  {name:<11} mean {st['mean']:.4f} ms  p50 {st['p50']:.4f}  p99 {st['p99']:.4f}  total {st['total']} ms")
+        for ex in report["examples"]:
+            print(f"  mismatch {ex['doc_id']}: {'; '.join(ex['problems'])}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,26 @@
+# Picked up automatically by gunicorn (./gunicorn.conf.py) next to the Dockerfile CMD.
+
+# worker_exit drain budgets (seconds), in the order they run.
+_JOBS_DRAIN_S = 60.0
+_ARTIFACTS_DRAIN_S = 25.0
+_MIRROR_DRAIN_S = 5.0
+
+# gunicorn kills a stopping worker after graceful_timeout (default 30 s), which would
+# cut the drains above short: leave room for all of them.
+graceful_timeout = int(_JOBS_DRAIN_S + _ARTIFACTS_DRAIN_S + _MIRROR_DRAIN_S) + 10
+# A sync /run blocks on the worker POST (up to 120 s) and a coalesced trigger waits
+# for the running one (RUN_JOIN_WAIT_S, 900 s); the 30 s default would kill both.
+timeout = 900
+
+
+def worker_exit(server, worker):
+    # Debug artifacts / state mirror are written by background threads; don't lose
+    # what is still queued when gunicorn recycles or stops the worker.
+    from common import artifacts, http_client, jobs, state_store
+
+    # Let queued /run?async=1 jobs finish first; they produce artifacts / state writes.
+    jobs.shutdown(timeout_s=_JOBS_DRAIN_S)
+    artifacts.shutdown(timeout_s=_ARTIFACTS_DRAIN_S)
+    state_store.flush_mirror(timeout_s=_MIRROR_DRAIN_S)
+    # Nothing uses the pooled connections after the drains.
+    http_client.close_all()
@@ -1,5 +1,9 @@
-from flask import Flask, request, jsonify
-from runner import run_pipeline, list_steps
+import hmac
+import os
+
+from flask import Flask, Response, request, jsonify
+from runner import RELEASABLE_KEYS, run_pipeline, list_steps
+from common import client_cache, jobs, journal, metrics, response_view, webhook_queue
 
 app = Flask(__name__)
 
@@ -14,16 +18,44 @@ def root():
     return jsonify({"ok": True}), 200
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.get("/steps")
 def steps():
     return jsonify({"steps": list_steps()}), 200
 
 
+def _run_view(payload: dict, default_view: str):
+    # ?view=summary|full, ?fields=a,b (or the same keys in the JSON body)
+    view, fields = response_view.from_request(request.args, payload, default_view)
+    if view not in response_view.VIEWS:
+        return jsonify({"status": "error", "error": f"Unknown view '{view}' (summary|full)"}), 200
+    release = not response_view.needs_any(view, fields, RELEASABLE_KEYS)
+
+    # ?async=1: queue the run and answer at once; poll GET /jobs/<id> for the result.
+    is_async = request.args.get("async") or payload.pop("async", None)
+    if str(is_async).strip().lower() in ("1", "true", "yes"):
+        def job():
+            ctx = run_pipeline(payload, release_blobs=release)
+            return response_view.project(ctx, view, fields), ctx.get("_trace")
+
+        try:
+            rec = jobs.submit(job, kind="debug" if payload.get("_debug") else "run")
+        except jobs.QueueFull as e:
+            return jsonify({"status": "error", "error": str(e)}), 429
+        return jsonify({"status": "queued", "job_id": rec["job_id"], "job_url": f"/jobs/{rec['job_id']}"}), 202
+
+    ctx = run_pipeline(payload, release_blobs=release)
+    return jsonify(response_view.project(ctx, view, fields)), 200
+
+
 @app.post("/run")
 def run():
     payload = request.get_json(silent=True) or {}
-    ctx = run_pipeline(payload)
-    return jsonify(ctx), 200
+    return _run_view(payload, "summary")
 
 
 @app.post("/debug")
@@ -33,8 +65,73 @@ def debug():
     if not payload.get("step"):
         return jsonify({"status": "error", "error": "Missing 'step' in payload"}), 200
     payload["_debug"] = True
-    ctx = run_pipeline(payload)
-    return jsonify(ctx), 200
+    return _run_view(payload, "full")
+
+
+def _webhook_doc_ids(payload: dict):
+    raw = payload.get("document_ids")
+    if raw is None:
+        raw = [payload.get("document_id") or payload.get("DocumentID") or payload.get("id")]
+    if not isinstance(raw, list):
+        raw = [raw]
+    return [int(str(x).strip()) for x in raw if x is not None and str(x).strip().isdigit()]
+
+
+@app.post("/webhook/sale")
+def webhook_sale():
+    # {"document_id": 17075092} / {"document_ids": [...]}, optional "priority" (higher first).
+    # ?run=1 also queues an async /run, which drains the queue first.
+    secret = os.getenv("WEBHOOK_SECRET") or ""
+    if secret and not hmac.compare_digest(request.headers.get("X-Webhook-Secret", ""), secret):
+        return jsonify({"status": "error", "error": "Bad webhook secret"}), 403
+    payload = request.get_json(silent=True) or {}
+    doc_ids = _webhook_doc_ids(payload)
+    if not doc_ids:
+        return jsonify({"status": "error", "error": "Missing numeric 'document_id'"}), 400
+    if not webhook_queue.enabled():
+        return jsonify({"status": "error", "error": "Webhook queue disabled (WEBHOOK_QUEUE=0)"}), 503
+    try:
+        priority = int(payload.get("priority") or 0)
+    except Exception:
+        priority = 0
+    webhook_queue.push(doc_ids, priority=priority, source=str(payload.get("source") or "webhook"))
+    out = {"status": "queued", "document_ids": doc_ids, "queue": webhook_queue.stats()}
+
+    if str(request.args.get("run") or payload.get("run") or "").strip().lower() in ("1", "true", "yes"):
+        def job():
+            ctx = run_pipeline({}, release_blobs=True)
+            return response_view.project(ctx, "summary"), ctx.get("_trace")
+
+        try:
+            out["job_id"] = jobs.submit(job, kind="webhook")["job_id"]
+        except jobs.QueueFull as e:
+            out["job_error"] = str(e)
+    return jsonify(out), 202
+
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id: str):
+    rec = jobs.get(job_id)
+    if rec is None:
+        return jsonify({"status": "error", "error": "Unknown or expired job", "job_id": job_id}), 404
+    return jsonify(rec), 200
+
+
+@app.post("/cache/client/invalidate")
+def invalidate_client_cache():
+    # {"client_id": "1069114"} -> one client; {} -> whole client cache
+    payload = request.get_json(silent=True) or {}
+    client_id = payload.get("client_id")
+    removed = client_cache.invalidate(str(client_id) if client_id is not None else None)
+    return jsonify({"status": "ok", "removed": removed, "stats": client_cache.stats()}), 200
+
+
+@app.get("/journal/<int:doc_id>")
+def journal_lookup(doc_id: int):
+    # ?limit=N -> only the newest N records
+    limit = request.args.get("limit", type=int)
+    records = journal.lookup(doc_id, limit=limit)
+    return jsonify({"status": "ok", "doc_id": doc_id, "count": len(records), "records": records}), 200
 
 
 if __name__ == "__main__":
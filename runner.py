@@ -1,5 +1,10 @@
-from typing import Any, Dict, List, Tuple, Callable
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple, Callable, Optional
 
+from common import journal, metrics, run_lease
 from steps import (
     step_00_read_state,
     step_01_fetch_sales_list,
@@ -22,6 +27,54 @@ STEPS: List[Tuple[str, StepFn]] = [
     ("08_finalize_state", step_08_finalize_state.run),
 ]
 
+# Batch mode: 00..01 run once per invocation, 02..08 once per document.
+RUN_STEPS = STEPS[:2]
+DOC_STEPS = STEPS[2:]
+
+# Hard upper bound for /run {"max_documents": N} so one call can't run forever.
+MAX_DOCUMENTS_CAP = 500
+
+# Run-level keys that a document iteration may change and the next one must see
+# (in-memory cursor, pending list, deferred state-write markers).
+_BATCH_CARRY_KEYS = (
+    "last_processed_id",
+    "in_progress_id",
+    "pending_list",
+    "pending_schedule",
+    "pending_ready",
+    "state_pending_orig",
+    "webhook_done",
+    "state_webhook_done_orig",
+    "state_cursor_staged",
+    "state_clear_in_progress",
+    "__lease_renewed_at",
+)
+
+# Large ctx values no later step reads, dropped right after the named step when the
+# response won't include them (run_pipeline(..., release_blobs=True)). Keeps a batch
+# of documents from holding every sale XML / worker response until the end.
+RELEASE_AFTER: Dict[str, Tuple[str, ...]] = {
+    "06_call_worker": ("paytraq_full_xml", "worker_response_text", "__sale_doc", "__extract_all"),
+    "08_finalize_state": ("worker_response_json",),
+}
+RELEASABLE_KEYS = tuple(k for keys in RELEASE_AFTER.values() for k in keys if not k.startswith("__"))
+
+# Single flight (common/run_lease): one pipeline run at a time. A trigger identical to
+# a run already in flight in this process waits for it and gets its result
+# (coalesced="joined"); any other overlapping trigger returns at once with
+# status "coalesced" instead of listing / fetching / calling the worker again.
+RUN_JOIN_WAIT_S = float(os.getenv("RUN_JOIN_WAIT_S") or 900)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+
+
+_flights: Dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
 
 def list_steps() -> List[str]:
     return [name for name, _ in STEPS]
@@ -39,45 +92,346 @@ def _merge_payload_into_ctx(ctx: Dict[str, Any], payload: Dict[str, Any]) -> Dic
     return ctx
 
 
-def run_pipeline(payload: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    /run:
-      payload = {}  -> pilns pipeline
-    /debug:
-      payload = {"step":"02_pick_next_doc"} -> palaidīs 00..02
-    """
-    payload = payload or {}
-    debug_step = payload.get("step")
-
-    ctx: Dict[str, Any] = {}
-    ctx = _merge_payload_into_ctx(ctx, payload)
-
-    trace = []
-    for name, fn in STEPS:
+def _run_steps(ctx: Dict[str, Any], steps, trace: list, debug_step: Optional[str] = None):
+    """Run `steps` in order. Returns (ctx, stopped) where stopped=True means a step
+    errored / halted the pipeline (or the debug step was reached)."""
+    for name, fn in steps:
         ctx["current_step"] = name
-        try:
-            ctx = fn(ctx) or ctx
-            trace.append({"step": name, "ok": True})
-        except Exception as e:
+        t0 = time.perf_counter()
+        entry: Dict[str, Any] = {"step": name, "ok": True}
+        failed = False
+        with metrics.http_scope() as http:
+            try:
+                ctx = fn(ctx) or ctx
+            except Exception as e:
+                ctx["status"] = "error"
+                ctx["error"] = str(e)
+                entry.update(ok=False, error=str(e))
+                failed = True
+        entry["duration_ms"] = _ms_since(t0)
+        if http.calls:
+            entry["http"] = http.calls
+        metrics.observe_step(name, entry["duration_ms"] / 1000.0)
+        trace.append(entry)
+        if ctx.get("__release_blobs"):
+            for k in RELEASE_AFTER.get(name, ()):
+                ctx.pop(k, None)
+        if not _renew_lease(ctx):
             ctx["status"] = "error"
-            ctx["error"] = str(e)
-            trace.append({"step": name, "ok": False, "error": str(e)})
-            break
+            ctx["error"] = f"Run lease lost (token {ctx.get('run_lease_token')} superseded)"
+            return ctx, True
+        if failed:
+            return ctx, True
 
         # Zapier-stils: steps var uzlikt error/halt_pipeline bez exception
         if ctx.get("error"):
             ctx["status"] = ctx.get("status") or "error"
-            break
+            return ctx, True
         if ctx.get("halt_pipeline"):
             ctx["status"] = ctx.get("status") or "ok"
-            break
+            return ctx, True
 
         # DEBUG: ja prasīts konkrēts solis, apstājies uz tā
         if debug_step and name == debug_step:
             ctx["status"] = ctx.get("status") or "ok"
+            return ctx, True
+    return ctx, False
+
+
+def _renew_lease(ctx: Dict[str, Any]) -> bool:
+    """Keep the run lease alive between steps (every TTL/3). False once it was taken over."""
+    token = ctx.get("run_lease_token")
+    if token is None:
+        return True
+    now = time.monotonic()
+    if now - ctx.get("__lease_renewed_at", now) < run_lease.TTL_S / 3:
+        return True
+    try:
+        ok = run_lease.renew(token)
+    except Exception:
+        return True  # lease db trouble: step_08 re-checks before writing state
+    ctx["__lease_renewed_at"] = now
+    return ok
+
+
+def _ms_since(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000, 1)
+
+
+def _record_document(doc_ctx: Dict[str, Any], res: Dict[str, Any], cursor_before: Any = None) -> None:
+    if res.get("status") != "idle":
+        metrics.observe_document(res.get("status") or "unknown")
+    _journal(doc_ctx, res, cursor_before)
+
+
+def _journal(doc_ctx: Dict[str, Any], res: Dict[str, Any], cursor_before: Any = None) -> None:
+    """One journal record per processed document (best effort, never fails the run)."""
+    if not res.get("document_id") or res.get("status") == "idle" or not journal.enabled():
+        return
+    try:
+        journal.append({
+            "doc_id": int(res["document_id"]),
+            "picked_by": res.get("picked_by"),
+            "status": res.get("status"),
+            "batch": bool(doc_ctx.get("defer_state_writes")),
+            "steps": {t["step"]: t.get("duration_ms") for t in res.get("_trace") or [] if "step" in t},
+            "worker_status_code": doc_ctx.get("worker_status_code"),
+            "worker_payload_version": doc_ctx.get("worker_payload_version"),
+            "error": doc_ctx.get("error"),
+            "state": {
+                "cursor_before": cursor_before if cursor_before is not None else doc_ctx.get("github_state_last_processed_id"),
+                "cursor_after": doc_ctx.get("cursor_advanced_to") or doc_ctx.get("last_processed_id"),
+                "ack": doc_ctx.get("github_finalize_ack"),
+                "last_status": doc_ctx.get("github_finalize_last_status"),
+                "clear_status": doc_ctx.get("github_finalize_clear_status"),
+                "pending_status": doc_ctx.get("github_finalize_pending_status"),
+                "commit_files": doc_ctx.get("state_commit_files"),
+                "pending_drops": doc_ctx.get("pending_drops") or None,
+            },
+        })
+    except Exception as e:
+        doc_ctx["journal_error"] = str(e)
+
+
+def _drop_private(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Keys starting with "__" hold process-local objects (parsed XML etc.) shared
+    between steps; they never leave the runner."""
+    for k in [k for k in ctx if k.startswith("__")]:
+        ctx.pop(k, None)
+    return ctx
+
+
+def _batch_limits(payload: Dict[str, Any]):
+    """(max_documents, time_budget_s) from payload, or (None, None) for a classic single run."""
+    max_docs = payload.get("max_documents")
+    budget = payload.get("time_budget_s")
+    if max_docs is None and budget is None:
+        return None, None
+    try:
+        max_docs = int(max_docs) if max_docs is not None else MAX_DOCUMENTS_CAP
+    except Exception:
+        max_docs = 1
+    max_docs = max(1, min(max_docs, MAX_DOCUMENTS_CAP))
+    try:
+        budget = float(budget) if budget is not None else None
+    except Exception:
+        budget = None
+    return max_docs, budget
+
+
+def _doc_result(doc_ctx: Dict[str, Any], trace: list) -> Dict[str, Any]:
+    if doc_ctx.get("error"):
+        outcome = "error"
+    elif doc_ctx.get("idle"):
+        outcome = "idle"
+    elif doc_ctx.get("worker_skipped_draft"):
+        outcome = "draft_deferred"
+    elif doc_ctx.get("worker_not_modified") and doc_ctx.get("github_finalize_ack"):
+        outcome = "not_modified"
+    elif doc_ctx.get("github_finalize_ack"):
+        outcome = "ok"
+    else:
+        outcome = "not_acked"
+    return {
+        "document_id": doc_ctx.get("next_document_id"),
+        "picked_by": doc_ctx.get("picked_by"),
+        "status": outcome,
+        "worker_status_code": doc_ctx.get("worker_status_code"),
+        "error": doc_ctx.get("error"),
+        "_trace": trace,
+    }
+
+
+def _flush_pending(ctx: Dict[str, Any], trace: list) -> None:
+    """Stopped before step 08 (idle, error): persist step_02's pending schedule changes
+    and the cursor move past webhook-acked ids."""
+    had_error = bool(ctx.get("error"))
+    try:
+        step_08_finalize_state.flush_stopped_run(ctx)
+    except Exception as e:
+        trace.append({"step": "08_flush_pending", "ok": False, "error": str(e)})
+        return
+    if ctx.get("state_commit_files"):
+        trace.append({"step": "08_flush_pending", "ok": True, "files": ctx["state_commit_files"]})
+    if ctx.get("error") and not had_error:
+        ctx["status"] = "error"
+
+
+def _run_batch(ctx: Dict[str, Any], max_docs: int, budget_s: Optional[float]) -> Dict[str, Any]:
+    """
+    Batch catch-up: 00 (state read) and 01 (sales list) once, then 02..08 per document
+    with the cursor kept in memory. step_08 only stages state changes; they are written
+    once at the end by step_08_finalize_state.flush_deferred_state.
+    """
+    started = time.monotonic()
+    trace: list = []
+
+    # Manual overrides pin exactly one document; there is nothing to loop over.
+    if ctx.get("document_id") or ctx.get("override_document_id") or ctx.get("force_document_id"):
+        max_docs = 1
+
+    ctx["defer_state_writes"] = True
+    ctx, stopped = _run_steps(ctx, RUN_STEPS, trace)
+    results: List[Dict[str, Any]] = []
+    stop_reason = "error" if stopped else "max_documents"
+
+    while not stopped and len(results) < max_docs:
+        if budget_s is not None and results and (time.monotonic() - started) >= budget_s:
+            stop_reason = "time_budget"
+            break
+
+        cursor_before = ctx.get("last_processed_id")
+        doc_ctx = dict(ctx)
+        doc_trace: list = []
+        doc_ctx, _ = _run_steps(doc_ctx, DOC_STEPS, doc_trace)
+
+        for k in _BATCH_CARRY_KEYS:
+            if k in doc_ctx:
+                ctx[k] = doc_ctx[k]
+
+        res = _doc_result(doc_ctx, doc_trace)
+        _record_document(doc_ctx, res, cursor_before)
+        if res["status"] == "idle":
+            stop_reason = "idle"
+            break
+        results.append(res)
+        # Anything not acked (or a draft deferral) would be re-picked forever; stop and
+        # let the next run retry it, exactly like a single run would.
+        if res["status"] not in ("ok", "not_modified", "draft_deferred"):
+            stop_reason = res["status"]
             break
 
+    trace.append({"batch": True, "documents": len(results), "stop_reason": stop_reason})
+    try:
+        step_08_finalize_state.flush_deferred_state(ctx)
+        trace.append({"step": "08_flush_state", "ok": True})
+    except Exception as e:
+        ctx["error"] = str(e)
+        trace.append({"step": "08_flush_state", "ok": False, "error": str(e)})
+
+    ctx["documents"] = results
+    ctx["documents_processed"] = len(results)
+    ctx["batch_stop_reason"] = stop_reason
+    ctx["batch_elapsed_s"] = round(time.monotonic() - started, 3)
+    ctx["_trace"] = trace
+    if ctx.get("error"):
+        ctx["status"] = "error"
+    elif any(r["status"] == "error" for r in results):
+        ctx["status"] = "partial"
+    ctx.setdefault("status", "ok")
+    if ctx["status"] in ("error", "partial"):
+        metrics.observe_run("batch", ctx["status"])
+    else:
+        metrics.observe_run("batch", "ok" if results else "idle")
+    return _drop_private(ctx)
+
+
+def _run_mode(payload: Dict[str, Any]) -> Optional[str]:
+    if payload.get("step"):
+        return None  # /debug runs are not counted
+    return "batch" if _batch_limits(payload)[0] is not None else "single"
+
+
+def _coalesced(payload: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        held_by = run_lease.holder()
+    except Exception:
+        held_by = None
+    mode = _run_mode(payload)
+    if mode:
+        metrics.observe_run(mode, "coalesced")
+    return {"status": "coalesced", "coalesced": True, "run_lease": held_by, "_trace": []}
+
+
+def _join(flight: _Flight, payload: Dict[str, Any]) -> Dict[str, Any]:
+    if not flight.done.wait(RUN_JOIN_WAIT_S) or flight.result is None:
+        return _coalesced(payload)
+    mode = _run_mode(payload)
+    if mode:
+        metrics.observe_run(mode, "joined")
+    return dict(flight.result, coalesced="joined")
+
+
+def run_pipeline(payload: Dict[str, Any], release_blobs: bool = False) -> Dict[str, Any]:
+    """
+    /run:
+      payload = {}  -> pilns pipeline
+      payload = {"max_documents": 50, "time_budget_s": 240} -> batch (02..08 cilpā)
+    /debug:
+      payload = {"step":"02_pick_next_doc"} -> palaidīs 00..02
+    release_blobs=True: drop RELEASE_AFTER keys once no later step needs them.
+
+    Runs under the single-flight lease (see RUN_JOIN_WAIT_S / common.run_lease).
+    """
+    payload = payload or {}
+    if not run_lease.enabled():
+        return _run_pipeline(payload, release_blobs, None)
+
+    key = json.dumps([payload, release_blobs], sort_keys=True, default=str)
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            leader = False
+        else:
+            leader = True
+            flight = _flights[key] = _Flight()
+    if not leader:
+        return _join(flight, payload)
+
+    try:
+        try:
+            token = run_lease.acquire()
+        except Exception as e:
+            # Lease db unavailable: run unfenced rather than not at all.
+            flight.result = _run_pipeline(payload, release_blobs, None)
+            flight.result["run_lease_error"] = str(e)
+            return flight.result
+        if token is None:
+            flight.result = _coalesced(payload)
+            return flight.result
+        try:
+            flight.result = _run_pipeline(payload, release_blobs, token)
+        finally:
+            try:
+                run_lease.release(token)
+            except Exception:
+                pass  # expires after RUN_LEASE_TTL_S
+        return flight.result
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def _run_pipeline(payload: Dict[str, Any], release_blobs: bool, lease_token: Optional[int]) -> Dict[str, Any]:
+    debug_step = payload.get("step")
+
+    ctx: Dict[str, Any] = {}
+    ctx = _merge_payload_into_ctx(ctx, payload)
+    ctx.pop("run_lease_token", None)
+    if debug_step:
+        ctx["__debug_step"] = debug_step  # step_02 only peeks the webhook queue
+    if lease_token is not None:
+        ctx["run_lease_token"] = lease_token
+        ctx["__lease_renewed_at"] = time.monotonic()
+    if release_blobs:
+        ctx["__release_blobs"] = True
+
+    max_docs, budget_s = _batch_limits(payload)
+    if max_docs is not None and not debug_step:
+        return _run_batch(ctx, max_docs, budget_s)
+
+    trace: list = []
+    ctx, _ = _run_steps(ctx, STEPS, trace, debug_step)
+    if not debug_step and not any(t.get("step") == "08_finalize_state" for t in trace):
+        _flush_pending(ctx, trace)
+    if not debug_step:
+        res = _doc_result(ctx, trace)
+        _record_document(ctx, res)
+        metrics.observe_run("single", res["status"])
+        ctx["outcome"] = res["status"]
+
     ctx["_trace"] = trace
     if "status" not in ctx:
         ctx["status"] = "ok"
-    return ctx
+    return _drop_private(ctx)
@@ -1,19 +1,85 @@
 import os
-import requests
-import xml.etree.ElementTree as ET
+from common import http_client, sales_list, webhook_queue
 
-PAYTRAQ_BASE_URL = "https://go.paytraq.com"
+PAYTRAQ_BASE_URL = os.getenv("PAYTRAQ_BASE_URL", "https://go.paytraq.com").rstrip("/")
+
+# /api/sales is paged; pages are fetched lazily (only when step_02 runs out of ids),
+# at most this many per run.
+SALES_LIST_MAX_PAGES = int(os.getenv("SALES_LIST_MAX_PAGES") or 50)
+
+PAGES_CTX_KEY = "__sales_pages"
+# Listed ids as a compact sorted array('q') (process-local, never returned as JSON).
+IDS_CTX_KEY = "__sales_ids"
 
 
 def _extract_document_ids(xml_text: str):
-    root = ET.fromstring(xml_text)
-    ids = []
-    for el in root.iter():
-        if el.tag.lower() == "documentid" and el.text:
-            t = el.text.strip()
-            if t.isdigit():
-                ids.append(int(t))
-    return sorted(set(ids))
+    return sales_list.document_ids(xml_text)
+
+
+def _iter_sales_pages(params: dict, stats: dict):
+    """Lazily yield (status_code, ids, body_snippet) per /api/sales page, page 0, 1, ...
+    Stops after an empty or non-200 page. `stats` (pages, bytes) is updated in place so
+    every ctx copy that holds it sees the totals."""
+    for page in range(SALES_LIST_MAX_PAGES):
+        params = dict(params, page=page)
+        r = http_client.get(f"{PAYTRAQ_BASE_URL}/api/sales", params=params, timeout=30)
+        stats["pages"] += 1
+        stats["bytes"] += len(r.content or b"")
+        if r.status_code != 200:
+            yield r.status_code, sales_list.sorted_ids(()), (r.text or "")[:500]
+            return
+        ids = _extract_document_ids(r.text)
+        if not ids:
+            return
+        yield r.status_code, ids, ""
+    stats["truncated"] = True
+
+
+def sales_ids(ctx: dict):
+    """Listed ids (sorted array('q')) for step_02. A plain `sales_ids` list given in the
+    payload (debug/tests) is converted once."""
+    ids = ctx.get(IDS_CTX_KEY)
+    if ids is None and isinstance(ctx.get("sales_ids"), list):
+        ids = sales_list.sorted_ids(int(i) for i in ctx["sales_ids"])
+        ctx[IDS_CTX_KEY] = ids
+    return ids
+
+
+def more_sales_ids(ctx: dict) -> bool:
+    """Pull the next /api/sales page into ctx["__sales_ids"] (same array object, kept
+    sorted). False when the listing is exhausted or failed; a failed page also sets
+    ctx["error"], so the caller can't mistake a 429/5xx for "caught up"."""
+    pages = ctx.get(PAGES_CTX_KEY)
+    if pages is None:
+        return False
+    for sc, ids, snippet in pages:
+        if sc != 200:
+            ctx["paytraq_sales_page_error"] = {"status_code": sc, "body_snippet": snippet}
+            ctx["error"] = f"PayTraq /api/sales page returned {sc}"
+            break
+        known = ctx[IDS_CTX_KEY]
+        last = known[-1] if known else None
+        fresh = [i for i in ids if last is None or i > last]
+        if fresh:
+            known.extend(fresh)
+            ctx["sales_count"] = len(known)
+            ctx["sales_ids_last20"] = known[-20:].tolist()
+            return True
+    ctx[PAGES_CTX_KEY] = None
+    return False
+
+
+def _webhook_work_due(ctx: dict) -> int:
+    """Due /webhook/sale ids, when step_02 will take its normal path (no ref/date override)."""
+    if not webhook_queue.enabled():
+        return 0
+    if any(ctx.get(k) for k in ("document_ref", "doc_ref", "override_document_ref", "date", "override_date",
+                                "date_from", "date_to")):
+        return 0
+    try:
+        return webhook_queue.due_count()
+    except Exception:
+        return 0
 
 
 def run(ctx: dict):
@@ -21,7 +87,7 @@ def run(ctx: dict):
     override_id = ctx.get("document_id") or ctx.get("override_document_id") or ctx.get("force_document_id")
     if override_id is not None:
         ctx["sales_count"] = 0
-        ctx["sales_ids"] = []
+        ctx[IDS_CTX_KEY] = sales_list.sorted_ids(())
         ctx["sales_ids_last20"] = []
         ctx["paytraq_sales_skipped"] = True
         return ctx
@@ -49,25 +115,40 @@ def run(ctx: dict):
         "APIKey": key,
         "APIToken": token,
         "id_after": last_processed_id,
-        "page": 0,
     }
     if date_from:
         params["date_from"] = str(date_from)
 
-    url = f"{PAYTRAQ_BASE_URL}/api/sales"
-    r = requests.get(url, params=params, timeout=30)
-
+    stats = {"pages": 0, "bytes": 0, "truncated": False}
     ctx["paytraq_auth_used"] = "query_id_after"
     ctx["paytraq_sales_params"] = {k: v for k, v in params.items() if k not in ("APIKey", "APIToken")}
-    ctx["paytraq_sales_status_code"] = r.status_code
+    ctx["paytraq_sales_pages"] = stats
+
+    pages = _iter_sales_pages(params, stats)
+
+    # Webhook-announced ids are waiting: step_02 takes those first, so don't list now.
+    # The listing stays available lazily (more_sales_ids) for when the queue runs dry.
+    webhook_due = _webhook_work_due(ctx)
+    if webhook_due:
+        ctx["webhook_queue_due"] = webhook_due
+        ctx["paytraq_sales_deferred"] = True
+        ctx[PAGES_CTX_KEY] = pages
+        ctx[IDS_CTX_KEY] = sales_list.sorted_ids(())
+        ctx["sales_count"] = 0
+        ctx["sales_ids_last20"] = []
+        return ctx
+
+    # Only page 0 now; step_02 pulls further pages via more_sales_ids() when it needs them.
+    sc, ids, snippet = next(pages, (200, sales_list.sorted_ids(()), ""))
+    ctx["paytraq_sales_status_code"] = sc
 
-    if r.status_code != 200:
+    if sc != 200:
         ctx["error"] = "PayTraq /api/sales returned non-200"
-        ctx["paytraq_body_snippet"] = (r.text or "")[:500]
+        ctx["paytraq_body_snippet"] = snippet
         return ctx
 
-    ids = _extract_document_ids(r.text)
+    ctx[PAGES_CTX_KEY] = pages if ids else None
     ctx["sales_count"] = len(ids)
-    ctx["sales_ids"] = ids               # pilnais saraksts 02 solim (ID asc)
-    ctx["sales_ids_last20"] = ids[-20:]  # debugam
+    ctx[IDS_CTX_KEY] = ids                        # pilnais saraksts 02 solim (ID asc), papildinās pa lapām
+    ctx["sales_ids_last20"] = ids[-20:].tolist()  # debugam
     return ctx
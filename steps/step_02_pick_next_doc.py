@@ -1,8 +1,14 @@
 import os
 import re
-import base64
-import requests
+import threading
+from common import doc_index, http_client, metrics, pending_queue, sales_list, webhook_queue
+from common.sale_document import SaleDocument
+from common.state_store import get_store
+from steps import step_01_fetch_sales_list, step_08_finalize_state
 import xml.etree.ElementTree as ET
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 GITHUB_STATE_URL = os.getenv("GITHUB_STATE_URL")
@@ -11,68 +17,158 @@ PAYTRAQ_BASE_URL = os.getenv("PAYTRAQ_BASE_URL", "https://go.paytraq.com").rstri
 PAYTRAQ_API_KEY = os.getenv("PAYTRAQ_API_KEY")
 PAYTRAQ_API_TOKEN = os.getenv("PAYTRAQ_API_TOKEN")
 
-DEFAULT_OWNER = "AlendaSIA"
-DEFAULT_REPO = "Jaunais_step0-trigger"
 STATE_PENDING_PATH = "state/pending_draft_ids.txt"
 
-# How many pending drafts to re-check per run (bounds PayTraq calls even if the
-# pending list ever grows). Oldest ids are checked first.
-PENDING_SCAN_CAP = 30
+# How many DUE pending drafts to re-check per run (bounds PayTraq calls even if the
+# pending list ever grows). Oldest due ids are checked first, in parallel.
+PENDING_SCAN_CAP = int(os.getenv("PENDING_RECHECK_BUDGET") or 30)
+PENDING_RECHECK_CONCURRENCY = int(os.getenv("PENDING_RECHECK_CONCURRENCY") or 6)
+# Due pending ids are first resolved from /api/sales list calls (id_after = oldest
+# unresolved id - 1); at most this many calls per run, per-id fetches only for what
+# the list didn't cover.
+PENDING_LIST_MAX_PAGES = int(os.getenv("PENDING_LIST_MAX_PAGES") or 3)
+
+# document_ref/date override scan: parallel PayTraq fetches, how many more ids may wait
+# queued behind them (cancelled unsent once a match is found), and a hard cap on how
+# many ids one run may fetch.
+OVERRIDE_SCAN_CONCURRENCY = int(os.getenv("OVERRIDE_SCAN_CONCURRENCY") or 6)
+OVERRIDE_SCAN_LOOKAHEAD = int(os.getenv("OVERRIDE_SCAN_LOOKAHEAD") or 2)
+OVERRIDE_SCAN_MAX_IDS = int(os.getenv("OVERRIDE_SCAN_MAX_IDS") or 500)
+
+_OVERRIDE_POOL: Optional[ThreadPoolExecutor] = None
+_OVERRIDE_POOL_LOCK = threading.Lock()
 
 # Statuses that mean the deferred draft will never become a real order → drop it.
 _TERMINAL_STATUSES = ("voided", "cancelled", "canceled", "deleted")
 
 
-def _repo_full() -> str:
-    return f"{os.getenv('GITHUB_OWNER') or DEFAULT_OWNER}/{os.getenv('GITHUB_REPO') or DEFAULT_REPO}"
-
-
-def _gh_read_text(path: str):
-    token = os.getenv("GITHUB_TOKEN")
-    if not token:
-        return None
-    url = f"https://api.github.com/repos/{_repo_full()}/contents/{path}"
+def _load_pending_schedule():
+    """Read state/pending_draft_ids.txt -> {"<id>": [next_check_at, attempts]}."""
     try:
-        r = requests.get(
-            url,
-            headers={"Authorization": f"token {token}", "Accept": "application/vnd.github+json"},
-            timeout=20,
-        )
+        txt, _, _ = get_store().read(STATE_PENDING_PATH)
     except Exception:
-        return None
-    if r.status_code != 200:
-        return None
-    data = r.json() or {}
-    if "content" not in data:
-        return None
-    try:
-        return base64.b64decode(data["content"]).decode().strip()
-    except Exception:
-        return None
+        txt = None
+    return pending_queue.parse(txt)
 
 
-def _load_pending_ids():
-    """Read state/pending_draft_ids.txt -> sorted unique list[int] (asc)."""
-    txt = _gh_read_text(STATE_PENDING_PATH)
-    if not txt:
-        return []
-    out = []
-    for line in txt.replace(",", "\n").splitlines():
-        line = line.strip()
-        if line.isdigit():
-            out.append(int(line))
-    return sorted(set(out))
-
+def _fetch_pending_docs(pids):
+    """Concurrent GET /api/sale/{id} for the due pending ids -> {id: (status_code, SaleDocument|None)}."""
+    def one(pid):
+        sc, sale_xml = _paytraq_sale_xml_by_id(pid)
+        if sc != 200:
+            return sc, None
+        doc = SaleDocument(sale_xml)
+        doc_index.record(doc, pid)
+        return sc, doc
+
+    out = {}
+    if not pids:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, min(PENDING_RECHECK_CONCURRENCY, len(pids))),
+                            thread_name_prefix="pending-recheck") as pool:
+        futures = {pid: pool.submit(metrics.propagate(one), pid) for pid in pids}
+        for pid, fut in futures.items():
+            try:
+                out[pid] = fut.result()
+            except Exception:
+                out[pid] = (0, None)
+    return out
+
+
+def _statuses_from_sales_xml(sales_xml: str) -> dict:
+    """/api/sales list page -> {DocumentID: lowercased DocumentStatus} (status may be '')."""
+    try:
+        return sales_list.document_statuses(sales_xml)
+    except ET.ParseError:
+        return {}
+
+
+def _pending_statuses_from_list(pids, stats: dict) -> dict:
+    """Resolve DocumentStatus of the due pending ids from the sales LIST: each call asks
+    for id_after = (oldest id still unresolved) - 1, so sparse pending ids don't walk
+    the pages in between. Returns {id: status} for the ids the list covered with a
+    status; the rest fall back to per-id fetches."""
+    want = {int(p) for p in pids}
+    found = {}
+    unresolved = sorted(want)
+    for call in range(max(0, PENDING_LIST_MAX_PAGES)):
+        if not unresolved:
+            break
+        params = {"APIKey": PAYTRAQ_API_KEY, "APIToken": PAYTRAQ_API_TOKEN, "id_after": unresolved[0] - 1}
+        try:
+            r = http_client.get(f"{PAYTRAQ_BASE_URL}/api/sales", params=params, timeout=40)
+        except Exception:
+            break
+        stats["list_pages"] = call + 1
+        if r.status_code != 200:
+            break
+        listed = _statuses_from_sales_xml(r.text)
+        if not any(listed.values()):
+            break  # empty, or this account's list carries no DocumentStatus: fetch per id
+        found.update({i: st for i, st in listed.items() if i in want and st})
+        # ids up to the last listed one are settled (found, or not in the list -> per-id)
+        unresolved = [i for i in unresolved if i > max(listed)]
+    return found
+
+
+def _recheck_pending(ctx: dict, schedule: dict):
+    """Re-check the pending drafts that are DUE (next_check_at passed), concurrently and
+    within the run's budget. Updates `schedule` in place (backoff / drops) and returns
+    (picked_id, SaleDocument|None) for the oldest one that is ready, else (None, None)."""
+    # Batch: ids found ready by an earlier iteration are picked without another fetch.
+    ready_left = [int(p) for p in (ctx.get("pending_ready") or []) if str(int(p)) in schedule]
+    if ready_left:
+        ctx["pending_ready"] = ready_left[1:]
+        return ready_left[0], None
 
-def _doc_status_from_sale_xml(sale_xml: str):
     try:
-        root = ET.fromstring(sale_xml)
+        budget = int(ctx.get("pending_recheck_budget") or PENDING_SCAN_CAP)
     except Exception:
-        return None
-    el = root.find("./Header/Document/DocumentStatus")
-    if el is None or not el.text:
-        return None
-    return el.text.strip().lower()
+        budget = PENDING_SCAN_CAP
+    to_check, total_due = pending_queue.due(schedule, budget)
+    stats = {"pending": len(schedule), "due": total_due, "checked": len(to_check), "budget": budget,
+             "list_pages": 0, "from_list": 0, "fetched": 0,
+             "still_draft": 0, "dropped": 0, "ready": 0, "errors": 0}
+    ctx["pending_recheck"] = stats
+
+    # Status from the list first; full GET /api/sale/{id} only where the list had none.
+    # The picked one is fetched in full by step_03 anyway.
+    results = {pid: (200, None, st) for pid, st in _pending_statuses_from_list(to_check, stats).items()}
+    stats["from_list"] = len(results)
+    missing = [pid for pid in to_check if pid not in results]
+    stats["fetched"] = len(missing)
+    for pid, (sc_p, doc_p) in _fetch_pending_docs(missing).items():
+        results[pid] = (sc_p, doc_p, doc_p.status if doc_p is not None else None)
+
+    drops = list(ctx.get("pending_drops") or [])
+    ready = []
+    for pid, (sc_p, doc_p, st_p) in sorted(results.items()):
+        if sc_p == 404:
+            drops.append(pid)  # gone/deleted from PayTraq
+            continue
+        if st_p is None:
+            stats["errors"] += 1  # transient PayTraq error: keep it due, try next run
+            continue
+        if st_p == "draft":
+            pending_queue.still_draft(schedule, pid)  # not ready; check again later (backoff)
+            stats["still_draft"] += 1
+            continue
+        if st_p in _TERMINAL_STATUSES:
+            drops.append(pid)  # will never become a real order
+            continue
+        # READY: booked (or any non-draft, non-terminal)
+        ready.append((pid, doc_p))
+
+    for pid in drops:
+        schedule.pop(str(int(pid)), None)
+    ctx["pending_drops"] = drops
+    stats["dropped"] = len(drops)
+    stats["ready"] = len(ready)
+    if not ready:
+        return None, None
+    if ctx.get("defer_state_writes"):
+        ctx["pending_ready"] = [pid for pid, _ in ready[1:]]
+    return ready[0]
 
 
 def _github_headers():
@@ -85,7 +181,7 @@ def _github_headers():
 def _github_get_state():
     if not GITHUB_STATE_URL or not GITHUB_TOKEN:
         return None, None
-    r = requests.get(GITHUB_STATE_URL, headers=_github_headers(), timeout=20)
+    r = http_client.get(GITHUB_STATE_URL, headers=_github_headers(), timeout=20)
     return r.status_code, r.text
 
 
@@ -96,61 +192,213 @@ def _github_put_state(last_processed_id: int, in_progress_id: Optional[int]):
         "last_processed_id": last_processed_id,
         "in_progress_id": in_progress_id,
     }
-    r = requests.put(GITHUB_STATE_URL, json=payload, headers=_github_headers(), timeout=20)
+    r = http_client.put(GITHUB_STATE_URL, json=payload, headers=_github_headers(), timeout=20)
     return r.status_code, r.text
 
 
 def _paytraq_sales_list():
     url = f"{PAYTRAQ_BASE_URL}/api/sales"
     params = {"APIKey": PAYTRAQ_API_KEY, "APIToken": PAYTRAQ_API_TOKEN}
-    r = requests.get(url, params=params, timeout=40)
+    r = http_client.get(url, params=params, timeout=40)
     return r.status_code, r.text
 
 
 def _paytraq_sale_xml_by_id(doc_id: int):
     url = f"{PAYTRAQ_BASE_URL}/api/sale/{doc_id}"
     params = {"APIKey": PAYTRAQ_API_KEY, "APIToken": PAYTRAQ_API_TOKEN}
-    r = requests.get(url, params=params, timeout=60)
+    r = http_client.get(url, params=params, timeout=60)
     return r.status_code, r.text
 
 
 def _extract_doc_id_from_sales_xml(sales_xml: str):
     try:
-        root = ET.fromstring(sales_xml)
-    except Exception:
-        return []
+        return sales_list.document_ids(sales_xml)
+    except ET.ParseError:
+        return sales_list.sorted_ids(())
+
+
+def _override_match(ref, dd, want_ref, date_from, date_to) -> bool:
+    ref_ok = True
+    if want_ref:
+        ref_ok = (ref == want_ref)
+
+    date_ok = True
+    if date_from and date_to and dd:
+        date_ok = (date_from <= dd <= date_to)
+    elif date_from and dd:
+        date_ok = (dd >= date_from)
+    elif date_to and dd:
+        date_ok = (dd <= date_to)
+    elif (date_from or date_to) and not dd:
+        date_ok = False
+
+    return ref_ok and date_ok
 
-    ids = []
-    for el in root.findall(".//DocumentID"):
-        if el is not None and el.text:
-            t = el.text.strip()
-            if t.isdigit():
-                ids.append(int(t))
-    return ids
 
+def _fetch_sale_doc(doc_id: int):
+    sc, sale_xml = _paytraq_sale_xml_by_id(doc_id)
+    if sc != 200:
+        return None
+    doc = SaleDocument(sale_xml)
+    doc_index.record(doc, doc_id)
+    return doc
+
+
+def _override_pool() -> ThreadPoolExecutor:
+    global _OVERRIDE_POOL
+    if _OVERRIDE_POOL is None:
+        with _OVERRIDE_POOL_LOCK:
+            if _OVERRIDE_POOL is None:
+                _OVERRIDE_POOL = ThreadPoolExecutor(max_workers=max(1, OVERRIDE_SCAN_CONCURRENCY),
+                                                    thread_name_prefix="override-scan")
+    return _OVERRIDE_POOL
+
+
+def _fetch_first_match(scan: dict, to_fetch, want_ref, date_from, date_to, max_ids: int):
+    """Fetch `to_fetch` (ascending) on the shared pool -> (doc_id, SaleDocument) of the
+    first that matches, or (None, None). Updates `scan` in place."""
+    budget = max(0, max_ids - scan["fetched"])
+    if len(to_fetch) > budget:
+        scan["truncated"] = True
+        to_fetch = to_fetch[:budget]
+    if not to_fetch:
+        return None, None
 
-def _doc_ref_from_sale_xml(sale_xml: str):
+    pool = _override_pool()
+    depth = max(1, OVERRIDE_SCAN_CONCURRENCY) + max(0, OVERRIDE_SCAN_LOOKAHEAD)
+    inflight = deque()
+    submitted = 0
+    try:
+        while True:
+            while submitted < len(to_fetch) and len(inflight) < depth:
+                doc_id = to_fetch[submitted]
+                inflight.append((doc_id, pool.submit(metrics.propagate(_fetch_sale_doc), doc_id)))
+                submitted += 1
+            if not inflight:
+                break
+            doc_id, fut = inflight.popleft()
+            try:
+                doc = fut.result()
+            except Exception:
+                doc = None
+            if doc is not None and _override_match(doc.ref, doc.date, want_ref, date_from, date_to):
+                # every lower id is resolved and didn't match -> this one wins
+                return doc_id, doc
+    finally:
+        cancelled = sum(1 for _, rest in inflight if rest.cancel())
+        scan["cancelled"] += cancelled
+        scan["fetched"] += submitted - cancelled
+    return None, None
+
+
+def _scan_override_ids(ctx: dict, scan: dict, ids, want_ref, date_from, date_to, max_ids: int):
+    """One batch of listed ids (ascending) -> (doc_id, SaleDocument) of the oldest match,
+    or (None, None). The index names the first candidate (doc_index.first_match); only
+    it and the ids below it that the index can't rule out are fetched. Updates `scan`."""
+    ordered = list(ids)
+    if not ordered:
+        return None, None
+    known = doc_index.lookup(ordered)
+    scan["ids"] += len(ordered)
+    scan["indexed"] += len(known)
+    pos = 0
+    while pos < len(ordered):
+        rest = ordered[pos:]
+        cand = doc_index.first_match(want_ref, date_from, date_to, rest[0], rest[-1], rest)
+        below = rest[:rest.index(cand)] if cand is not None else rest
+        to_fetch = [d for d in below if (known.get(d) or {}).get("status") in (None, "draft")]
+        scan["skipped_by_index"] += len(below) - len(to_fetch)
+        if cand is not None:
+            scan["index_candidates"] += 1
+            to_fetch.append(cand)  # verify: the index may be stale
+        doc_id, doc = _fetch_first_match(scan, to_fetch, want_ref, date_from, date_to, max_ids)
+        if doc_id is not None or cand is None or scan["truncated"]:
+            return doc_id, doc
+        pos += len(below) + 1  # candidate didn't verify: look past it
+    return None, None
+
+
+def _pick_override_match(ctx: dict, ids, want_ref, date_from, date_to):
+    """OLDEST id whose DocumentRef/DocumentDate matches -> (doc_id, SaleDocument) or (None, None).
+
+    1) The local doc index names the first indexed match (ref / date indexes); ids
+       below it that the index knows NOT to match are dropped without a PayTraq call,
+       the candidate and the unknown ids below it are fetched to verify (drafts are
+       never trusted from the index: their date/ref can still change).
+    2) Fetches run in ascending order on a shared pool of
+       OVERRIDE_SCAN_CONCURRENCY threads, with OVERRIDE_SCAN_LOOKAHEAD more ids queued
+       behind them. Results are consumed in id order, so as soon as the lowest unresolved
+       id matches it wins; queued ids are cancelled before they are sent.
+    3) No match on the listed ids: the next /api/sales page is pulled (up to
+       SALES_LIST_MAX_PAGES) and scanned the same way.
+    4) At most OVERRIDE_SCAN_MAX_IDS ids are fetched per run (ctx override_scan_max_ids).
+       scan["fetched"] counts requests actually sent (running ones finish in the pool).
+    """
     try:
-        root = ET.fromstring(sale_xml)
+        max_ids = int(ctx.get("override_scan_max_ids") or OVERRIDE_SCAN_MAX_IDS)
     except Exception:
-        return None
-    el = root.find("./Header/Document/DocumentRef")
-    if el is None or not el.text:
-        return None
-    t = el.text.strip()
-    return t if t else None
+        max_ids = OVERRIDE_SCAN_MAX_IDS
+    scan = {"ids": 0, "indexed": 0, "skipped_by_index": 0, "index_candidates": 0, "fetched": 0,
+            "cancelled": 0, "pages": 1, "truncated": False}
+    ctx["override_scan"] = scan
+    start = 0
+    while True:
+        batch, start = ids[start:], len(ids)
+        doc_id, doc = _scan_override_ids(ctx, scan, batch, want_ref, date_from, date_to, max_ids)
+        if doc_id is not None:
+            return doc_id, doc
+        if scan["truncated"] or not step_01_fetch_sales_list.more_sales_ids(ctx):
+            return None, None
+        scan["pages"] += 1
+
+
+def _webhook_done_ids(ctx: dict):
+    """Ids acked via the webhook queue (state/webhook_done_ids.txt), read on first use
+    per run (batch: per batch) and only when the queue is enabled: most runs never
+    claim a webhook id nor reach a forward pick, and skip the state read."""
+    if "state_webhook_done_orig" not in ctx:
+        if not webhook_queue.enabled():
+            return []
+        try:
+            txt, _, _ = get_store().read(webhook_queue.DONE_STATE_PATH)
+        except Exception:
+            txt = None
+        ctx["webhook_done"] = webhook_queue.parse_done(txt)
+        ctx["state_webhook_done_orig"] = webhook_queue.dump_done(ctx["webhook_done"])
+    return ctx.get("webhook_done") or []
 
 
-def _doc_date_from_sale_xml(sale_xml: str):
+def _webhook_stale(ctx: dict, doc_id: int, schedule: dict) -> bool:
+    """Claimed id that needs no run: already acked via the queue, or behind the cursor
+    (the forward scan sent it) and not a pending draft."""
+    if doc_id in _webhook_done_ids(ctx):
+        return True
     try:
-        root = ET.fromstring(sale_xml)
-    except Exception:
+        cursor = int(ctx.get("last_processed_id"))
+    except (TypeError, ValueError):
+        return False
+    return doc_id <= cursor and str(doc_id) not in schedule
+
+
+def _claim_webhook_doc(ctx: dict, schedule: dict) -> Optional[int]:
+    """Next due id from the /webhook/sale queue (None when empty / disabled).
+    Stale ids are dropped on the way. /debug and skip_state_update runs only peek,
+    so they don't use up the entry's attempts."""
+    if not webhook_queue.enabled():
         return None
-    el = root.find("./Header/Document/DocumentDate")
-    if el is None or not el.text:
+    read_only = bool(ctx.get("__debug_step") or ctx.get("skip_state_update"))
+    try:
+        while True:
+            wid = webhook_queue.peek() if read_only else webhook_queue.claim()
+            if wid is None or not _webhook_stale(ctx, wid, schedule):
+                return wid
+            ctx.setdefault("webhook_dropped", []).append(wid)
+            if read_only:
+                return None
+            webhook_queue.done(wid)
+    except Exception as e:
+        ctx["webhook_queue_error"] = str(e)
         return None
-    t = el.text.strip()
-    return t if t else None
 
 
 def _set_idle(ctx: dict, picked_by: str):
@@ -171,9 +419,10 @@ def run(ctx: dict):
 
     Desired behavior:
       - Process OLDEST -> NEWEST.
-      - Normal mode: next_id = min([id for id in sales_ids if id > last_processed_id])
+      - Normal mode: next_id = smallest listed id > last_processed_id (bisect on the sorted ids)
       - Override by date/doc_ref: pick OLDEST match (min id) so date start walks forward.
       - Override by document_id (FAST PATH): do NOT scan all docs; just set next_document_id directly.
+      - Webhook queue (/webhook/sale) first, then pending drafts, then the forward scan.
       - If nothing new: return status=ok + idle=true (no pipeline error).
     """
     override_ref = ctx.get("document_ref") or ctx.get("doc_ref") or ctx.get("override_document_ref")
@@ -202,7 +451,8 @@ def run(ctx: dict):
 
     # Sales list
     # Preferred: use IDs already fetched in step_01_fetch_sales_list (which uses id_after => ID asc).
-    ids = ctx.get("sales_ids") if isinstance(ctx.get("sales_ids"), list) else None
+    # Sorted array('q'); candidates are found with bisect.
+    ids = step_01_fetch_sales_list.sales_ids(ctx)
     if ids is None:
         sc, sales_xml = _paytraq_sales_list()
         ctx["paytraq_sales_status_code"] = sc
@@ -210,8 +460,9 @@ def run(ctx: dict):
             ctx["_trace"] = (ctx.get("_trace") or []) + [{"step02": f"paytraq sales list error {sc}"}]
             return ctx
         ids = _extract_doc_id_from_sales_xml(sales_xml)
+        ctx[step_01_fetch_sales_list.IDS_CTX_KEY] = ids
         ctx["sales_count"] = len(ids)
-        ctx["sales_ids"] = ids[:100]  # debug visibility (order as received)
+        ctx["sales_ids_last20"] = ids[-20:].tolist()  # debug visibility
     else:
         # Keep debug fields consistent
         ctx["sales_count"] = len(ids)
@@ -231,40 +482,16 @@ def run(ctx: dict):
             date_from = override_date
             date_to = override_date
 
-        matches = {}  # doc_id -> sale_xml
-        for doc_id in ids:
-            sc2, sale_xml = _paytraq_sale_xml_by_id(int(doc_id))
-            if sc2 != 200:
-                continue
-
-            ref = _doc_ref_from_sale_xml(sale_xml)
-            dd = _doc_date_from_sale_xml(sale_xml)
-
-            ref_ok = True
-            if want_ref:
-                ref_ok = (ref == want_ref)
-
-            date_ok = True
-            if date_from and date_to and dd:
-                date_ok = (date_from <= dd <= date_to)
-            elif date_from and dd:
-                date_ok = (dd >= date_from)
-            elif date_to and dd:
-                date_ok = (dd <= date_to)
-            elif (date_from or date_to) and not dd:
-                date_ok = False
-
-            if ref_ok and date_ok:
-                matches[int(doc_id)] = sale_xml
-
-        if not matches:
+        chosen_id, chosen_doc = _pick_override_match(ctx, ids, want_ref, date_from, date_to)
+        if chosen_id is None:
+            if ctx.get("paytraq_sales_page_error"):
+                return ctx
             return _set_idle(ctx, picked_by="override_ref_or_date")
 
-        chosen_id = min(matches.keys())  # OLDEST match
         ctx["has_next_document"] = True
         ctx["next_document_id"] = int(chosen_id)
         ctx["picked_by"] = "override_ref_or_date"
-        ctx["paytraq_full_xml"] = matches[chosen_id]
+        chosen_doc.attach(ctx)
 
         if not skip_state_update:
             ctx["in_progress_id"] = int(chosen_id)
@@ -276,35 +503,47 @@ def run(ctx: dict):
     # state/pending_draft_ids.txt. Re-check them oldest-first: as soon as one is no
     # longer a draft, process it now so it links/dedups correctly. Terminal ones
     # (voided/deleted) are dropped. This never blocks the forward cursor.
-    pending_ids = _load_pending_ids()
-    ctx["pending_list"] = pending_ids
-    pending_drops = []
-    if pending_ids:
-        for pid in pending_ids[:PENDING_SCAN_CAP]:
-            sc_p, sale_xml_p = _paytraq_sale_xml_by_id(int(pid))
-            if sc_p != 200:
-                pending_drops.append(int(pid))  # gone/deleted from PayTraq
-                continue
-            st_p = _doc_status_from_sale_xml(sale_xml_p)
-            if st_p == "draft":
-                continue  # still not ready; leave it pending
-            if st_p in _TERMINAL_STATUSES:
-                pending_drops.append(int(pid))  # will never become a real order
-                continue
-            # READY: booked (or any non-draft, non-terminal) → process this one now.
-            ctx["pending_drops"] = pending_drops
-            ctx["has_next_document"] = True
-            ctx["next_document_id"] = int(pid)
-            ctx["picked_by"] = "pending_draft_ready"
-            ctx["paytraq_full_xml"] = sale_xml_p
-            if not skip_state_update:
-                ctx["in_progress_id"] = int(pid)
-            return ctx
-    ctx["pending_drops"] = pending_drops
+    # Each pending id carries next_check_at/attempts (exponential backoff), so only due
+    # ones are fetched, concurrently and within PENDING_RECHECK_BUDGET per run.
+    # Batch mode (runner loops 02..08): the schedule is loaded once and kept in ctx.
+    batch = bool(ctx.get("defer_state_writes"))
+    if batch and isinstance(ctx.get("pending_schedule"), dict):
+        schedule = ctx["pending_schedule"]
+    else:
+        schedule = _load_pending_schedule()
+        ctx["pending_schedule"] = schedule
+        ctx["state_pending_orig"] = pending_queue.dump(pending_queue.ids_of(schedule), schedule)
+
+    # ---- WEBHOOK QUEUE: ids announced by /webhook/sale go before everything else ----
+    # Never moves the cursor (step_08). An acked id is written to state/webhook_done_ids.txt
+    # and the forward scan steps over it later instead of sending it again.
+    wid = _claim_webhook_doc(ctx, schedule)
+    if wid is not None:
+        ctx["has_next_document"] = True
+        ctx["next_document_id"] = wid
+        ctx["picked_by"] = "webhook_queue"
+        if not skip_state_update:
+            ctx["in_progress_id"] = wid
+        return ctx
+
+    pid, doc_p = _recheck_pending(ctx, schedule)
+    ctx["pending_list"] = pending_queue.ids_of(schedule)
+    if pid is not None:
+        ctx["has_next_document"] = True
+        ctx["next_document_id"] = int(pid)
+        ctx["picked_by"] = "pending_draft_ready"
+        if doc_p is not None:
+            doc_p.attach(ctx)
+        if not skip_state_update:
+            ctx["in_progress_id"] = int(pid)
+        return ctx
     # ---- end pending re-check → fall through to forward scan ----
 
     # Forward scan has nothing new (cursor already caught up). Pending was handled above.
-    if not ids:
+    # step_01 may have deferred the listing (webhook work was due): fetch it now.
+    if not ids and not step_01_fetch_sales_list.more_sales_ids(ctx):
+        if ctx.get("paytraq_sales_page_error"):
+            return ctx  # more_sales_ids set the error
         return _set_idle(ctx, picked_by="no_sales")
 
     # Normal mode: pick OLDEST doc newer than last_processed_id
@@ -321,13 +560,33 @@ def run(ctx: dict):
 
     if last_processed_id is None:
         # start from OLDEST if nothing set
-        next_id = min(int(d) for d in ids)
+        pos = 0
     else:
         # Even though step_01 uses id_after, keep this guard for safety.
-        candidates = [int(d) for d in ids if int(d) > int(last_processed_id)]
-        next_id = min(candidates) if candidates else None
+        pos = bisect_right(ids, last_processed_id)
+    # Listed ids used up (batch catch-up): pull the next /api/sales page lazily.
+    while pos >= len(ids) and step_01_fetch_sales_list.more_sales_ids(ctx):
+        pos = bisect_right(ids, last_processed_id) if last_processed_id is not None else 0
+    next_id = ids[pos] if pos < len(ids) else None
+
+    # Already acked through the webhook queue: step over them, the cursor moves past
+    # them in step_08 (or on the idle flush) without another worker call.
+    done = set(_webhook_done_ids(ctx)) if next_id is not None else set()
+    skipped = []
+    while next_id is not None and int(next_id) in done:
+        skipped.append(int(next_id))
+        pos += 1
+        while pos >= len(ids) and step_01_fetch_sales_list.more_sales_ids(ctx):
+            pass
+        next_id = ids[pos] if pos < len(ids) else None
+    if skipped:
+        ctx["webhook_done_skipped"] = skipped
+        if batch:
+            step_08_finalize_state.stage_cursor(ctx, skipped[-1])
 
     if not next_id:
+        if ctx.get("paytraq_sales_page_error"):
+            return ctx  # a later page failed: not caught up
         return _set_idle(ctx, picked_by="normal_after_last_processed")
 
     ctx["next_document_id"] = int(next_id)
@@ -1,65 +1,13 @@
 import os
-import base64
-import requests
-import xml.etree.ElementTree as ET
+from common import artifacts, doc_index, http_client
+from common.sale_document import SaleDocument
 
-PAYTRAQ_BASE_URL = "https://go.paytraq.com"
-REPO = "AlendaSIA/Jaunais_step0-trigger"
-
-
-def _doc_status(xml_text: str):
-    """Return lowercased DocumentStatus (e.g. 'draft', 'wait_payment', 'paid',
-    'voided') from a PayTraq sale XML, or None if it can't be parsed."""
-    if not xml_text or not isinstance(xml_text, str):
-        return None
-    try:
-        root = ET.fromstring(xml_text)
-    except Exception:
-        return None
-    el = root.find("./Header/Document/DocumentStatus")
-    if el is None or not el.text:
-        return None
-    return el.text.strip().lower()
-
-
-def _commit_message(message: str) -> str:
-    msg = (message or "").strip()
-    if msg.startswith("[skip ci]"):
-        return msg
-    return f"[skip ci] {msg}"
-
-
-def _github_get_sha(token: str, path: str):
-    url = f"https://api.github.com/repos/{REPO}/contents/{path}"
-    r = requests.get(url, headers={"Authorization": f"token {token}"}, timeout=20)
-    if r.status_code == 200:
-        return (r.json() or {}).get("sha")
-    return None
-
-
-def _github_put_file(token: str, path: str, content_bytes: bytes, message: str):
-    url = f"https://api.github.com/repos/{REPO}/contents/{path}"
-    payload = {
-        "message": _commit_message(message),
-        "content": base64.b64encode(content_bytes).decode("utf-8"),
-    }
-
-    sha = _github_get_sha(token, path)
-    if sha:
-        payload["sha"] = sha
-
-    r = requests.put(
-        url,
-        headers={"Authorization": f"token {token}"},
-        json=payload,
-        timeout=30,
-    )
-    return r.status_code, (r.text or "")[:500]
+PAYTRAQ_BASE_URL = os.getenv("PAYTRAQ_BASE_URL", "https://go.paytraq.com").rstrip("/")
 
 
 def _fetch_xml(path: str, key: str, token: str, timeout_s: int = 30):
     url = f"{PAYTRAQ_BASE_URL}{path}"
-    r = requests.get(url, params={"APIKey": key, "APIToken": token}, timeout=timeout_s)
+    r = http_client.get(url, params={"APIKey": key, "APIToken": token}, timeout=timeout_s)
     return r.status_code, (r.text or ""), path
 
 
@@ -105,22 +53,19 @@ def run(ctx: dict):
     # Draft-gate signal: a PayTraq document in 'draft' status is not yet committed
     # (no lines / no ProformaReference). Downstream steps must NOT hand it to the
     # worker, otherwise a reference-less twin deal is created. See step_06/step_08.
-    doc_status = _doc_status(xml_text)
+    doc = SaleDocument.from_ctx(ctx) if xml_text else None
+    doc_index.record(doc, int(doc_id))
+    doc_status = doc.status if doc is not None else None
     ctx["doc_status"] = doc_status
     ctx["doc_is_draft"] = (doc_status == "draft")
 
-    gh_token = os.getenv("GITHUB_TOKEN")
-    if gh_token:
+    if artifacts.enabled():
         path = f"state/debug/sales_{doc_id}.xml"
-        status_g, snippet = _github_put_file(
-            gh_token,
+        ctx["github_debug_xml_path"] = path
+        ctx["github_debug_xml_status"] = artifacts.put(
             path,
             xml_text.encode("utf-8"),
             message=f"debug: save PayTraq XML {doc_id} ({used_path})",
         )
-        ctx["github_debug_xml_path"] = path
-        ctx["github_debug_xml_status"] = status_g
-        if status_g not in (200, 201):
-            ctx["github_debug_xml_error_snippet"] = snippet
 
     return ctx
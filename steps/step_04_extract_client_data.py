@@ -1,124 +1,180 @@
 import os
 import json
-import base64
-import requests
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from common import artifacts, client_cache, http_client, metrics
+from common.sale_document import SaleDocument, flatten_xml, parse_line_items
 import xml.etree.ElementTree as ET
 from typing import Any, Dict, List, Tuple, Optional
 
-REPO = "AlendaSIA/Jaunais_step0-trigger"
 PAYTRAQ_BASE_URL = os.getenv("PAYTRAQ_BASE_URL", "https://go.paytraq.com")
 
-
-def _commit_message(message: str) -> str:
-    msg = (message or "").strip()
-    if msg.startswith("[skip ci]"):
-        return msg
-    return f"[skip ci] {msg}"
-
-
-def _github_get_sha(token: str, path: str) -> Optional[str]:
-    url = f"https://api.github.com/repos/{REPO}/contents/{path}"
-    r = requests.get(url, headers={"Authorization": f"token {token}"}, timeout=20)
-    if r.status_code == 200:
-        return (r.json() or {}).get("sha")
-    return None
-
-
-def _github_put_file(token: str, path: str, content_bytes: bytes, message: str) -> Tuple[int, str]:
-    url = f"https://api.github.com/repos/{REPO}/contents/{path}"
-    payload = {
-        "message": _commit_message(message),
-        "content": base64.b64encode(content_bytes).decode("utf-8"),
-    }
-    sha = _github_get_sha(token, path)
-    if sha:
-        payload["sha"] = sha
-
-    r = requests.put(
-        url,
-        headers={"Authorization": f"token {token}"},
-        json=payload,
-        timeout=30,
-    )
-    return r.status_code, (r.text or "")[:500]
-
-
-def _paytraq_get_xml(path: str, api_key: str, api_token: str) -> Tuple[int, str, str]:
+# /api/client, contacts, shippingAddresses, banks are fetched concurrently. Each call
+# is a query-auth GET plus, if that fails, a header-auth GET, CLIENT_FETCH_TIMEOUT_S
+# each at most. A request only gets the time left before CLIENT_FETCH_DEADLINE_S,
+# split over its HTTP_RETRIES retries (a timed-out GET is retried), and the header
+# fallback is skipped when none is left: a thread of the shared pool doesn't keep
+# running after its endpoint was reported as timed out.
+CLIENT_FETCH_WORKERS = int(os.getenv("CLIENT_FETCH_WORKERS") or 8)
+CLIENT_FETCH_TIMEOUT_S = float(os.getenv("CLIENT_FETCH_TIMEOUT_S") or 30)
+CLIENT_FETCH_DEADLINE_S = float(os.getenv("CLIENT_FETCH_DEADLINE_S") or 2 * CLIENT_FETCH_TIMEOUT_S + 5)
+# Below this many seconds left a request isn't started.
+_MIN_REQUEST_S = 1.0
+
+# Structured extract (sale_fields, line_items, client_bundle) handed to step_06.
+EXTRACT_CTX_KEY = "__extract_all"
+
+# Full field flattening (sale_fields, line item _flat, client {key}_fields) only feeds
+# the extract_all artifact and the structured worker payload. EXTRACT_FLATTEN:
+#   auto (default)  flatten when artifacts are enabled or WORKER_PAYLOAD_MODE=structured
+#   1 / 0           always / never
+EXTRACT_FLATTEN = (os.getenv("EXTRACT_FLATTEN") or "auto").strip().lower()
+
+_CLIENT_POOL: Optional[ThreadPoolExecutor] = None
+_CLIENT_POOL_LOCK = threading.Lock()
+
+
+def _time_left(deadline: Optional[float]) -> float:
+    """Per-attempt timeout for the next request: CLIENT_FETCH_TIMEOUT_S, cut so that all
+    its attempts fit before `deadline` (time.monotonic()); 0 when too little is left."""
+    if deadline is None:
+        return CLIENT_FETCH_TIMEOUT_S
+    left = deadline - time.monotonic()
+    if left < _MIN_REQUEST_S:
+        return 0.0
+    return min(CLIENT_FETCH_TIMEOUT_S, max(_MIN_REQUEST_S, left / (1 + max(0, http_client.RETRIES))))
+
+
+def _paytraq_get_xml(path: str, api_key: str, api_token: str,
+                     deadline: Optional[float] = None) -> Tuple[int, str, str]:
     url = f"{PAYTRAQ_BASE_URL}{path}"
     params = {"APIKey": api_key, "APIToken": api_token}
-    r = requests.get(url, params=params, timeout=30)
+    timeout = _time_left(deadline)
+    if not timeout:
+        return 0, "", "deadline"
+    r = http_client.get(url, params=params, timeout=timeout)
     if r.status_code == 200:
         return r.status_code, r.text, "query_normal"
 
+    timeout = _time_left(deadline)
+    if not timeout:
+        return r.status_code, r.text, "query_normal"  # no time left for the fallback
     headers = {"APIKey": api_key, "APIToken": api_token}
-    r2 = requests.get(url, headers=headers, timeout=30)
+    r2 = http_client.get(url, headers=headers, timeout=timeout)
     return r2.status_code, r2.text, "headers_fallback"
 
 
-def _text(v: Optional[str]) -> Optional[str]:
-    if v is None:
-        return None
-    t = v.strip()
-    return t if t != "" else None
-
-
-def _flatten_xml(elem: ET.Element, prefix: str = "") -> List[Tuple[str, str]]:
-    out: List[Tuple[str, str]] = []
-
-    if elem.attrib:
-        for k, v in elem.attrib.items():
-            if v is not None and str(v).strip() != "":
-                out.append((f"{prefix}@{k}" if prefix else f"@{k}", str(v)))
-
-    children = list(elem)
-    has_children = len(children) > 0
-    val = _text(elem.text)
-
-    if not has_children:
-        if val is not None:
-            out.append((prefix, val) if prefix else (elem.tag, val))
+def _cached_get_xml(client_id: Optional[str], key: str, path: str, api_key: str, api_token: str, use_cache: bool,
+                    deadline: Optional[float] = None):
+    """_paytraq_get_xml through the client cache -> (status, body, auth_used, 'hit'|'miss'|None)."""
+    if use_cache and client_id:
+        try:
+            hit = client_cache.get(client_id, key)
+        except Exception:
+            hit = None
+        if hit is not None:
+            return hit[0], hit[1], hit[2], "hit"
+    st, body, auth_used = _paytraq_get_xml(path, api_key, api_token, deadline)
+    if not use_cache or not client_id:
+        return st, body, auth_used, None
+    if st == 200 and body and body.lstrip().startswith("<"):
+        try:
+            client_cache.put(client_id, key, st, body, auth_used)
+        except Exception:
+            pass
+    return st, body, auth_used, "miss"
+
+
+def _flatten_needed(ctx: dict) -> bool:
+    if EXTRACT_FLATTEN in ("1", "true", "yes"):
+        return True
+    if EXTRACT_FLATTEN in ("0", "false", "no"):
+        return False
+    mode = (ctx.get("worker_payload_mode") or os.getenv("WORKER_PAYLOAD_MODE") or "raw").strip().lower()
+    return mode == "structured" or artifacts.enabled()
+
+
+def _client_endpoint_result(
+    key: str, path: str, api_key: str, api_token: str,
+    client_id: Optional[str] = None, use_cache: bool = False, flatten: bool = True,
+    deadline: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Fetch + flatten one client endpoint -> the `{key}_*` entries for client_bundle."""
+    out: Dict[str, Any] = {}
+    try:
+        st, body, auth_used, cache_state = _cached_get_xml(
+            client_id, key, path, api_key, api_token, use_cache, deadline
+        )
+    except Exception as e:
+        out[f"{key}_endpoint"] = path
+        out[f"{key}_status_code"] = 0
+        out[f"{key}_error"] = f"{type(e).__name__}: {e}"
         return out
-
-    counts: Dict[str, int] = {}
-    for ch in children:
-        counts[ch.tag] = counts.get(ch.tag, 0) + 1
-
-    seen: Dict[str, int] = {}
-    for ch in children:
-        idx = seen.get(ch.tag, 0)
-        seen[ch.tag] = idx + 1
-
-        tag_name = ch.tag
-        if counts.get(tag_name, 0) > 1:
-            tag_name = f"{tag_name}[{idx}]"
-
-        new_prefix = f"{prefix}/{tag_name}" if prefix else tag_name
-        out.extend(_flatten_xml(ch, new_prefix))
-
-    if val is not None:
-        out.append((f"{prefix}#text" if prefix else f"{elem.tag}#text", val))
-
+    out[f"{key}_endpoint"] = path
+    if cache_state:
+        out[f"{key}_cache"] = cache_state
+    out[f"{key}_status_code"] = st
+    out[f"{key}_auth_used"] = auth_used
+
+    if st == 200 and body and body.lstrip().startswith("<"):
+        if not flatten:
+            out[f"{key}_bytes"] = len(body)
+            return out
+        try:
+            rroot = ET.fromstring(body)
+            out[f"{key}_fields"] = flatten_xml(rroot, key, "dicts")
+        except Exception:
+            out[f"{key}_parse_error"] = True
+            out[f"{key}_body_snippet"] = (body or "")[:400]
+    else:
+        out[f"{key}_body_snippet"] = (body or "")[:400]
     return out
 
 
-def _parse_line_items(root: ET.Element) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
-    for li in root.findall("./LineItems/LineItem"):
-        flat = _flatten_xml(li, "LineItem")
-        row = {"_flat": [{"field": k, "value": v} for k, v in flat]}
-
-        def ft(p: str) -> Optional[str]:
-            el = li.find(p)
-            return _text(el.text) if el is not None else None
-
-        row["item_code"] = ft("./Item/ItemCode")
-        row["item_name"] = ft("./Item/ItemName")
-        row["qty"] = ft("./Qty")
-        row["price"] = ft("./Price")
-        row["line_total"] = ft("./LineTotal")
-        row["tax"] = ft("./TaxKey/TaxKeyName")
-        items.append(row)
-    return items
+def _client_pool() -> ThreadPoolExecutor:
+    global _CLIENT_POOL
+    if _CLIENT_POOL is None:
+        with _CLIENT_POOL_LOCK:
+            if _CLIENT_POOL is None:
+                _CLIENT_POOL = ThreadPoolExecutor(max_workers=CLIENT_FETCH_WORKERS, thread_name_prefix="client-fetch")
+    return _CLIENT_POOL
+
+
+def _fetch_client_bundle(
+    client_bundle: Dict[str, Any], endpoints: Dict[str, str], api_key: str, api_token: str,
+    use_cache: bool = False, flatten: bool = True,
+):
+    """All client endpoints in parallel, bounded by CLIENT_FETCH_DEADLINE_S overall.
+    Endpoints that miss the deadline are recorded with status 0 + `{key}_timeout`."""
+    started = time.monotonic()
+    deadline = started + CLIENT_FETCH_DEADLINE_S
+    client_id = client_bundle.get("client_id")
+    pool = _client_pool()
+    futures = {
+        key: pool.submit(
+            metrics.propagate(_client_endpoint_result), key, path, api_key, api_token, client_id, use_cache, flatten,
+            deadline,
+        )
+        for key, path in endpoints.items()
+    }
+    wait(list(futures.values()), timeout=CLIENT_FETCH_DEADLINE_S)
+
+    for key, path in endpoints.items():  # keep the bundle in endpoint order
+        fut = futures[key]
+        if fut.done():
+            client_bundle.update(fut.result())
+        else:
+            fut.cancel()
+            client_bundle[f"{key}_endpoint"] = path
+            client_bundle[f"{key}_status_code"] = 0
+            client_bundle[f"{key}_timeout"] = True
+    client_bundle["fetch_elapsed_ms"] = int((time.monotonic() - started) * 1000)
+    if use_cache:
+        states = [client_bundle.get(f"{key}_cache") for key in endpoints]
+        client_bundle["cache_hits"] = states.count("hit")
+        client_bundle["cache_misses"] = states.count("miss")
+        client_bundle["cache_totals"] = client_cache.stats()
 
 
 def run(ctx: dict):
@@ -134,21 +190,20 @@ def run(ctx: dict):
         ctx["error"] = "Missing ctx.paytraq_full_xml (run step 03 first)"
         return ctx
 
-    try:
-        root = ET.fromstring(sale_xml)
-    except Exception as e:
-        ctx["error"] = f"XML parse error: {type(e).__name__}"
+    doc = SaleDocument.from_ctx(ctx)
+    if doc.root is None:
+        ctx["error"] = f"XML parse error: {doc.parse_error}"
         ctx["sale_xml_snippet"] = (sale_xml or "")[:500]
         return ctx
 
-    sale_fields = _flatten_xml(root, "Sale")
-    sale_fields_kv = [{"field": k, "value": v} for k, v in sale_fields]
-    line_items = _parse_line_items(root)
-
-    client_id = None
-    el = root.find("./Header/Document/Client/ClientID")
-    if el is not None:
-        client_id = _text(el.text)
+    flatten = _flatten_needed(ctx)
+    if flatten:
+        sale_fields_kv = doc.field_rows
+        line_items = doc.line_items
+    else:
+        sale_fields_kv = []
+        line_items = parse_line_items(doc.root, flatten=False)
+    client_id = doc.client_id
 
     api_key = os.getenv("PAYTRAQ_API_KEY") or os.getenv("PAYTRAQ_KEY") or ""
     api_token = os.getenv("PAYTRAQ_API_TOKEN") or os.getenv("PAYTRAQ_TOKEN") or ""
@@ -162,22 +217,14 @@ def run(ctx: dict):
             "banks": f"/api/client/banks/{client_id}",
         }
 
-        for key, path in endpoints.items():
-            st, body, auth_used = _paytraq_get_xml(path, api_key, api_token)
-            client_bundle[f"{key}_endpoint"] = path
-            client_bundle[f"{key}_status_code"] = st
-            client_bundle[f"{key}_auth_used"] = auth_used
-
-            if st == 200 and body and body.lstrip().startswith("<"):
-                try:
-                    rroot = ET.fromstring(body)
-                    flat = _flatten_xml(rroot, key)
-                    client_bundle[f"{key}_fields"] = [{"field": k, "value": v} for k, v in flat]
-                except Exception:
-                    client_bundle[f"{key}_parse_error"] = True
-                    client_bundle[f"{key}_body_snippet"] = (body or "")[:400]
-            else:
-                client_bundle[f"{key}_body_snippet"] = (body or "")[:400]
+        # refresh_client_cache=true: drop this client's cached data and refetch it now.
+        use_cache = client_cache.enabled()
+        if use_cache and ctx.get("refresh_client_cache"):
+            try:
+                client_bundle["cache_invalidated"] = client_cache.invalidate(client_id)
+            except Exception:
+                pass
+        _fetch_client_bundle(client_bundle, endpoints, api_key, api_token, use_cache=use_cache, flatten=flatten)
     else:
         client_bundle["note"] = "Client fetch skipped (missing PAYTRAQ credentials or client_id)"
 
@@ -189,17 +236,19 @@ def run(ctx: dict):
         "client_bundle": client_bundle,
     }
 
+    # Full structured sale for step_06 (structured worker payload); process-local.
+    ctx[EXTRACT_CTX_KEY] = result
     ctx["extract_all"] = {
         "document_id": doc_id,
         "client_id": client_id,
-        "sale_field_count": len(sale_fields_kv),
+        "flattened": flatten,
+        "sale_field_count": len(sale_fields_kv) if flatten else None,
         "line_items_count": len(line_items),
         "client_bundle_keys": list(client_bundle.keys()),
         "sale_fields_preview_30": sale_fields_kv[:30],
     }
 
-    gh_token = os.getenv("GITHUB_TOKEN")
-    if gh_token:
+    if artifacts.enabled():
         json_path = f"state/debug/extract_all_{doc_id}.json"
         html_path = f"state/debug/extract_all_{doc_id}.html"
 
@@ -212,27 +261,13 @@ def run(ctx: dict):
             f"<pre>{pretty}</pre></body></html>"
         )
 
-        st1, sn1 = _github_put_file(
-            gh_token,
-            json_path,
-            pretty.encode("utf-8"),
-            f"debug: extract_all json {doc_id}",
-        )
-        st2, sn2 = _github_put_file(
-            gh_token,
-            html_path,
-            html.encode("utf-8"),
-            f"debug: extract_all html {doc_id}",
-        )
-
         ctx["github_extract_all_json_path"] = json_path
-        ctx["github_extract_all_json_status"] = st1
-        if st1 not in (200, 201):
-            ctx["github_extract_all_json_error_snippet"] = sn1
-
+        ctx["github_extract_all_json_status"] = artifacts.put(
+            json_path, pretty.encode("utf-8"), f"debug: extract_all json {doc_id}"
+        )
         ctx["github_extract_all_html_path"] = html_path
-        ctx["github_extract_all_html_status"] = st2
-        if st2 not in (200, 201):
-            ctx["github_extract_all_html_error_snippet"] = sn2
+        ctx["github_extract_all_html_status"] = artifacts.put(
+            html_path, html.encode("utf-8"), f"debug: extract_all html {doc_id}"
+        )
 
     return ctx
@@ -1,5 +1,5 @@
 import os
-import requests
+from common import http_client
 
 
 def run(ctx: dict):
@@ -23,7 +23,7 @@ def run(ctx: dict):
     print(f"PIPEDRIVE_API_TOKEN: {masked}")
 
     try:
-        r = requests.get(url, params={"api_token": token}, timeout=30)
+        r = http_client.get(url, params={"api_token": token}, timeout=30)
         print(f"HTTP: {r.status_code}")
 
         # Try JSON parse
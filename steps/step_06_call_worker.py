@@ -1,21 +1,37 @@
 import os
+import gzip
 import json
-import base64
-import requests
-import xml.etree.ElementTree as ET
+import threading
+import time
+from common import artifacts, dedupe_ledger, http_client
+from common.sale_document import SaleDocument
+from steps.step_04_extract_client_data import EXTRACT_CTX_KEY
 from typing import Any, Dict, Optional, Tuple, List
 
-REPO = "AlendaSIA/Jaunais_step0-trigger"
-
 WORKER_URL = (os.getenv("WORKER_URL", "") or "").strip()
-GITHUB_TOKEN = (os.getenv("GITHUB_TOKEN", "") or "").strip()
 
+# Payload protocol (version in X-Payload-Version; v2 also as top-level payload_version):
+#   raw        (v1, default) document.paytraq_full_xml, the worker parses the XML itself
+#   structured (v2)          document.sale = step_04's sale_fields / line_items /
+#                            client_bundle, gzip-compressed body; the raw XML only if
+#                            WORKER_INCLUDE_RAW_XML=1 (or ctx worker_include_raw_xml).
+# A worker that rejects v2 (415, or any 4xx carrying X-Payload-Version-Unsupported)
+# gets the raw payload again and v2 is not offered for WORKER_V2_RETRY_S. Other 4xx
+# are ordinary worker failures of that document.
+WORKER_PAYLOAD_MODE = (os.getenv("WORKER_PAYLOAD_MODE") or "raw").strip().lower()
+WORKER_GZIP = (os.getenv("WORKER_GZIP") or "1").strip() != "0"
+WORKER_INCLUDE_RAW_XML = (os.getenv("WORKER_INCLUDE_RAW_XML") or "0").strip() == "1"
+WORKER_V2_RETRY_S = float(os.getenv("WORKER_V2_RETRY_S") or 3600)
+
+PAYLOAD_VERSION_RAW = 1
+PAYLOAD_VERSION_STRUCTURED = 2
+_UNSUPPORTED_VERSION_HEADER = "X-Payload-Version-Unsupported"
 
-def _commit_message(message: str) -> str:
-    msg = (message or "").strip()
-    if msg.startswith("[skip ci]"):
-        return msg
-    return f"[skip ci] {msg}"
+# Automatic picks whose drafts are deferred instead of sent (see DRAFT GATE in run()).
+_DRAFT_GATED_PICKS = ("normal_after_last_processed", "pending_draft_ready", "webhook_queue")
+
+_v2_rejected_at: Optional[float] = None
+_v2_lock = threading.Lock()
 
 
 def _trace(ctx: Dict[str, Any], step: str, ok: bool, extra: Optional[Dict[str, Any]] = None) -> None:
@@ -25,33 +41,6 @@ def _trace(ctx: Dict[str, Any], step: str, ok: bool, extra: Optional[Dict[str, A
     ctx.setdefault("_trace", []).append(payload)
 
 
-def _github_get_sha(token: str, path: str) -> Optional[str]:
-    url = f"https://api.github.com/repos/{REPO}/contents/{path}"
-    r = requests.get(url, headers={"Authorization": f"token {token}"}, timeout=20)
-    if r.status_code == 200:
-        return (r.json() or {}).get("sha")
-    return None
-
-
-def _github_put_file(token: str, path: str, content_bytes: bytes, message: str) -> Tuple[int, str]:
-    url = f"https://api.github.com/repos/{REPO}/contents/{path}"
-    payload: Dict[str, Any] = {
-        "message": _commit_message(message),
-        "content": base64.b64encode(content_bytes).decode("utf-8"),
-    }
-    sha = _github_get_sha(token, path)
-    if sha:
-        payload["sha"] = sha
-
-    r = requests.put(
-        url,
-        headers={"Authorization": f"token {token}"},
-        json=payload,
-        timeout=30,
-    )
-    return r.status_code, (r.text or "")[:500]
-
-
 def _worker_process_url() -> str:
     if not WORKER_URL:
         return ""
@@ -61,20 +50,6 @@ def _worker_process_url() -> str:
     return base + "/process"
 
 
-def _extract_doc_ref_from_xml(xml: str) -> Optional[str]:
-    if not xml or not isinstance(xml, str):
-        return None
-    try:
-        root = ET.fromstring(xml)
-        el = root.find("./Header/Document/DocumentRef")
-        if el is not None and el.text:
-            t = el.text.strip()
-            return t if t else None
-    except Exception:
-        return None
-    return None
-
-
 def _flatten(obj: Any, prefix: str = "") -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     if isinstance(obj, dict):
@@ -97,6 +72,56 @@ def _flatten(obj: Any, prefix: str = "") -> List[Dict[str, Any]]:
     return out
 
 
+def _structured_enabled(ctx: Dict[str, Any]) -> bool:
+    mode = (ctx.get("worker_payload_mode") or WORKER_PAYLOAD_MODE or "raw").strip().lower()
+    if mode != "structured" or not isinstance(ctx.get(EXTRACT_CTX_KEY), dict):
+        return False
+    with _v2_lock:
+        return _v2_rejected_at is None or (time.monotonic() - _v2_rejected_at) >= WORKER_V2_RETRY_S
+
+
+def _v2_unsupported(r) -> bool:
+    """The worker refused the structured payload itself, not this document."""
+    if r.status_code == 415:
+        return True
+    if not 400 <= r.status_code < 500:
+        return False
+    flag = (r.headers.get(_UNSUPPORTED_VERSION_HEADER) or "").strip()
+    return bool(flag) and flag.lower() not in ("0", "false", "no")
+
+
+def _mark_v2_rejected() -> None:
+    global _v2_rejected_at
+    with _v2_lock:
+        _v2_rejected_at = time.monotonic()
+
+
+def _structured_document(ctx: Dict[str, Any], raw_doc: Dict[str, Any]) -> Dict[str, Any]:
+    extract = ctx.get(EXTRACT_CTX_KEY) or {}
+    doc = {k: v for k, v in raw_doc.items() if k != "paytraq_full_xml"}
+    doc["sale"] = {
+        "sale_fields": extract.get("sale_fields") or [],
+        "line_items": extract.get("line_items") or [],
+        "client_bundle": extract.get("client_bundle") or {},
+    }
+    if ctx.get("worker_include_raw_xml") or WORKER_INCLUDE_RAW_XML:
+        doc["paytraq_full_xml"] = raw_doc.get("paytraq_full_xml")
+    return doc
+
+
+def _post_payload(ctx: Dict[str, Any], process_url: str, payload: Dict[str, Any]):
+    """POST one payload; v2 goes gzip-compressed. Records sizes on ctx."""
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    version = payload.get("payload_version") or PAYLOAD_VERSION_RAW
+    headers = {"Content-Type": "application/json", "X-Payload-Version": str(version)}
+    ctx["worker_payload_bytes"] = len(body)
+    if version == PAYLOAD_VERSION_STRUCTURED and WORKER_GZIP:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    ctx["worker_payload_wire_bytes"] = len(body)
+    return http_client.post(process_url, data=body, headers=headers, timeout=120)
+
+
 def run(ctx: dict) -> dict:
     step_name = "06_call_worker"
     process_url = _worker_process_url()
@@ -113,20 +138,38 @@ def run(ctx: dict) -> dict:
 
     # DRAFT GATE: never send an un-committed PayTraq draft to the worker. A draft has
     # no LineItems / no ProformaReference yet, so the worker would create a reference-less
-    # twin deal. In the automatic flows (normal forward scan + pending re-check) we skip
+    # twin deal. In the automatic flows (forward scan, pending re-check, webhook queue) we skip
     # the worker; step_08 then defers the id to state/pending_draft_ids.txt and revisits it
     # once it becomes booked. Manual overrides (operator forced a specific doc) are exempt.
     picked_by = ctx.get("picked_by")
-    if ctx.get("doc_is_draft") and picked_by in ("normal_after_last_processed", "pending_draft_ready"):
+    if ctx.get("doc_is_draft") and picked_by in _DRAFT_GATED_PICKS:
         ctx["worker_skipped_draft"] = True
         ctx["worker_status_code"] = 0
         ctx["worker_response_text"] = f"skipped: DocumentStatus=draft (deferred), doc {doc_id}"
         _trace(ctx, step_name, True, {"skipped_draft": True, "doc_id": doc_id, "picked_by": picked_by})
         return ctx
 
+    # DEDUPE: this exact sale content was already acked by the worker → don't resend
+    # (every resend is Pipedrive traffic). step_08 treats it as an ack. force=true bypasses.
+    if doc_id and xml and dedupe_ledger.enabled():
+        try:
+            ctx["doc_hash"] = dedupe_ledger.canonical_hash(xml)
+            entry = None if ctx.get("force") else dedupe_ledger.is_acked(int(doc_id), ctx["doc_hash"])
+        except Exception as e:
+            entry = None
+            ctx["dedupe_ledger_error"] = str(e)
+        if entry is not None:
+            ctx["worker_not_modified"] = True
+            ctx["worker_status_code"] = 304
+            ctx["worker_response_text"] = f"not modified: doc {doc_id} already acked (worker_status={entry['worker_status']})"
+            ctx["worker_response_json"] = None
+            _trace(ctx, step_name, True, {"not_modified": True, "doc_id": doc_id, "acked_at": entry["acked_at"]})
+            return ctx
+
     document_ref = ctx.get("document_ref")
     if not document_ref:
-        document_ref = _extract_doc_ref_from_xml(xml)
+        doc = SaleDocument.from_ctx(ctx)
+        document_ref = doc.ref if doc is not None else None
 
     ref_clean = (document_ref or "").replace(" ", "").strip()
     deal_title = ref_clean or f"PT {doc_id}"
@@ -147,9 +190,18 @@ def run(ctx: dict) -> dict:
         }
     }
 
+    raw_payload = payload
+    if _structured_enabled(ctx):
+        payload = {
+            "payload_version": PAYLOAD_VERSION_STRUCTURED,
+            "document": _structured_document(ctx, raw_payload["document"]),
+        }
+    ctx["worker_payload_version"] = payload.get("payload_version") or PAYLOAD_VERSION_RAW
+
     if ctx.get("dump_worker_fields") is True:
         dump_payload = json.loads(json.dumps(payload))
-        dump_payload["document"]["paytraq_full_xml"] = f"<xml len={xml_len}>"
+        if "paytraq_full_xml" in dump_payload["document"]:
+            dump_payload["document"]["paytraq_full_xml"] = f"<xml len={xml_len}>"
 
         flat = _flatten(dump_payload, "")
         worker_fields = []
@@ -163,7 +215,14 @@ def run(ctx: dict) -> dict:
         ctx["worker_fields"] = worker_fields
 
     try:
-        r = requests.post(process_url, json=payload, timeout=120)
+        r = _post_payload(ctx, process_url, payload)
+        if payload is not raw_payload and _v2_unsupported(r):
+            # Worker doesn't speak v2 (yet): resend as raw and stop offering v2 for a while.
+            _mark_v2_rejected()
+            ctx["worker_payload_fallback"] = {"from_version": PAYLOAD_VERSION_STRUCTURED, "status_code": r.status_code}
+            payload = raw_payload
+            ctx["worker_payload_version"] = PAYLOAD_VERSION_RAW
+            r = _post_payload(ctx, process_url, payload)
         ctx["worker_status_code"] = r.status_code
         ctx["worker_response_text"] = (r.text or "")[:200000]
 
@@ -172,7 +231,7 @@ def run(ctx: dict) -> dict:
         except Exception:
             ctx["worker_response_json"] = None
 
-        if GITHUB_TOKEN and doc_id:
+        if doc_id and artifacts.enabled():
             out_path = f"state/debug/worker_{doc_id}.json"
             pretty = json.dumps(
                 {
@@ -181,6 +240,9 @@ def run(ctx: dict) -> dict:
                         "document_ref": document_ref,
                         "xml_len": xml_len,
                         "process_url": process_url,
+                        "payload_version": ctx.get("worker_payload_version"),
+                        "payload_bytes": ctx.get("worker_payload_bytes"),
+                        "payload_wire_bytes": ctx.get("worker_payload_wire_bytes"),
                     },
                     "payload_sent_to_worker_keys": list((payload.get("document") or {}).keys()),
                     "worker_response": ctx.get("worker_response_json"),
@@ -188,16 +250,10 @@ def run(ctx: dict) -> dict:
                 ensure_ascii=False,
                 indent=2,
             )
-            st, sn = _github_put_file(
-                GITHUB_TOKEN,
-                out_path,
-                pretty.encode("utf-8"),
-                f"debug: worker response {doc_id}",
-            )
             ctx["github_worker_json_path"] = out_path
-            ctx["github_worker_json_status"] = st
-            if st not in (200, 201):
-                ctx["github_worker_json_error_snippet"] = sn
+            ctx["github_worker_json_status"] = artifacts.put(
+                out_path, pretty.encode("utf-8"), f"debug: worker response {doc_id}"
+            )
 
         ok = (r.status_code < 300)
         _trace(ctx, step_name, ok, {"status_code": r.status_code, "process_url": process_url})
@@ -1,86 +1,30 @@
-import os
-import base64
-import requests
-
-DEFAULT_OWNER = "AlendaSIA"
-DEFAULT_REPO = "Jaunais_step0-trigger"
+from common import dedupe_ledger, pending_queue, run_lease, webhook_queue
+from common.state_store import get_store
 
 STATE_LAST_PATH = "state/last_processed_id.txt"
 STATE_INPROGRESS_PATH = "state/in_progress_id.txt"
 STATE_PENDING_PATH = "state/pending_draft_ids.txt"
+STATE_WEBHOOK_DONE_PATH = webhook_queue.DONE_STATE_PATH
 
 
-def _repo_full() -> str:
-    owner = os.getenv("GITHUB_OWNER") or DEFAULT_OWNER
-    repo = os.getenv("GITHUB_REPO") or DEFAULT_REPO
-    return f"{owner}/{repo}"
-
-
-def _headers(token: str) -> dict:
-    return {
-        "Authorization": f"token {token}",
-        "Accept": "application/vnd.github+json",
-    }
-
-
-def _commit_message(message: str) -> str:
-    msg = (message or "").strip()
-    if msg.startswith("[skip ci]"):
-        return msg
-    return f"[skip ci] {msg}"
-
-
-def _github_get_sha(token: str, path: str):
-    url = f"https://api.github.com/repos/{_repo_full()}/contents/{path}"
-    r = requests.get(url, headers=_headers(token), timeout=20)
-
-    if r.status_code == 404:
-        return None, 404, None
-
-    data = r.json() or {}
-    sha = data.get("sha")
-    if not sha:
-        return None, r.status_code, data
-
-    return sha, r.status_code, None
-
-
-def _github_put_text(token: str, path: str, text: str, message: str):
-    sha, st, err = _github_get_sha(token, path)
-    if st not in (200, 404):
-        return None, st, err
-
-    url = f"https://api.github.com/repos/{_repo_full()}/contents/{path}"
-    payload = {
-        "message": _commit_message(message),
-        "content": base64.b64encode(text.encode("utf-8")).decode("utf-8"),
-    }
-    if sha:
-        payload["sha"] = sha
-
-    r = requests.put(url, headers=_headers(token), json=payload, timeout=30)
-    return r.json() if r.content else None, r.status_code, None
-
-
-def _read_last_processed(token: str):
+def _read_last_processed(store):
     """Fresh read of the current forward cursor (int), or None if unavailable."""
-    url = f"https://api.github.com/repos/{_repo_full()}/contents/{STATE_LAST_PATH}"
     try:
-        r = requests.get(url, headers=_headers(token), timeout=20)
-        if r.status_code != 200:
+        raw, st, _ = store.read(STATE_LAST_PATH)
+        if st != 200 or raw is None:
             return None
-        data = r.json() or {}
-        raw = base64.b64decode(data.get("content") or "").decode().strip()
+        raw = raw.strip()
         return int(raw) if raw else None
     except Exception:
         return None
 
 
-def _advance_cursor(token: str, ctx: dict, new_id, note: str = ""):
+def _advance_cursor(store, ctx: dict, changes: dict, new_id, note: str = ""):
     """Monotonic forward cursor: NEVER move last_processed_id backwards.
 
     Root-cause guard for the 'booking an old draft rolls the cursor back' bug:
-    under concurrent /run executions (scheduler + Mozello webhook, no lock) a
+    under concurrent /run executions (scheduler + Mozello webhook; now serialized
+    by the run lease, but a lease can expire or be disabled) a
     stale in_progress_id could be written as the cursor, dropping it to an old
     draft's id and forcing step0 to re-process every later order one-by-one.
     We only ever advance; any id <= the current cursor is ignored.
@@ -92,7 +36,7 @@ def _advance_cursor(token: str, ctx: dict, new_id, note: str = ""):
         return
 
     floor = 0
-    for cand in (_read_last_processed(token), ctx.get("github_state_last_processed_id")):
+    for cand in (_read_last_processed(store), ctx.get("github_state_last_processed_id")):
         try:
             if cand is not None and int(cand) > floor:
                 floor = int(cand)
@@ -104,13 +48,156 @@ def _advance_cursor(token: str, ctx: dict, new_id, note: str = ""):
         ctx["cursor_rollback_prevented"] = {"attempted": new_id, "floor": floor}
         return
 
-    _, st_last, _ = _github_put_text(
-        token,
-        STATE_LAST_PATH,
-        str(new_id),
-        message=f"state: set last_processed_id={new_id}{note}",
+    changes[STATE_LAST_PATH] = (str(new_id), f"set last_processed_id={new_id}{note}")
+    ctx["cursor_advanced_to"] = new_id
+
+
+def _pending_change(ctx: dict, changes: dict):
+    """Stage state/pending_draft_ids.txt if the schedule (ids, next_check_at, attempts)
+    differs from what step_02 loaded. Nothing loaded (override picks) -> never written."""
+    if "state_pending_orig" not in ctx:
+        return
+    schedule = ctx.get("pending_schedule") or {}
+    new_pending = pending_queue.ids_of(schedule)
+    body = pending_queue.dump(new_pending, schedule)
+    if body != (ctx.get("state_pending_orig") or ""):
+        changes[STATE_PENDING_PATH] = (body, f"pending_draft_ids -> {new_pending}")
+
+
+def _cursor_floor(ctx: dict, changes: dict) -> int:
+    """Cursor after this commit: the staged write, else what the run started from."""
+    floor = 0
+    for cand in ((changes.get(STATE_LAST_PATH) or (None,))[0],
+                 ctx.get("github_state_last_processed_id"), ctx.get("cursor_advanced_to")):
+        try:
+            if cand is not None and int(cand) > floor:
+                floor = int(cand)
+        except Exception:
+            pass
+    return floor
+
+
+def _webhook_done_change(ctx: dict, changes: dict):
+    """Stage state/webhook_done_ids.txt: ids acked via the webhook queue that the cursor
+    hasn't passed yet (the forward scan skips them). Call after the cursor change is staged."""
+    if "state_webhook_done_orig" not in ctx:
+        return
+    floor = _cursor_floor(ctx, changes)
+    done = [i for i in (ctx.get("webhook_done") or []) if int(i) > floor]
+    ctx["webhook_done"] = done
+    body = webhook_queue.dump_done(done)
+    if body != (ctx.get("state_webhook_done_orig") or ""):
+        changes[STATE_WEBHOOK_DONE_PATH] = (body, f"webhook_done_ids -> {done}")
+
+
+def _mark_webhook_done(ctx: dict, doc_id):
+    """Webhook pick finished (acked or deferred as a draft): remember it for the forward scan."""
+    done = list(ctx.get("webhook_done") or [])
+    if int(doc_id) not in done:
+        done.append(int(doc_id))
+    ctx["webhook_done"] = sorted(done)
+
+
+_STATUS_KEYS = {
+    STATE_PENDING_PATH: "github_finalize_pending_status",
+    STATE_WEBHOOK_DONE_PATH: "github_finalize_webhook_done_status",
+    STATE_LAST_PATH: "github_finalize_last_status",
+    STATE_INPROGRESS_PATH: "github_finalize_clear_status",
+}
+
+
+def _int_or_zero(text) -> int:
+    try:
+        return int((text or "").strip() or 0)
+    except ValueError:
+        return 0
+
+
+def _rebuild_on_head(ctx: dict, changes: dict):
+    """Callback for a lost ref race (github_api.commit_files): another writer committed
+    state since we read it. Redo our changes against its files: the cursor stays the
+    max of both, the pending schedule gets only our adds/drops/reschedules, the
+    webhook-done ids are merged. Files that end up identical to the head are left out;
+    a head we can't read aborts the commit (None) instead of replaying stale text."""
+    def rebuild(read):
+        heads = {}
+        wanted = set(changes)
+        if STATE_WEBHOOK_DONE_PATH in changes:
+            wanted.add(STATE_LAST_PATH)
+        for path in wanted:
+            text, st = read(path)
+            if st not in (200, 404):
+                return None
+            heads[path] = text or ""
+        out = {}
+
+        floor = _int_or_zero(heads.get(STATE_LAST_PATH))
+        if STATE_LAST_PATH in changes:
+            ours = _int_or_zero(changes[STATE_LAST_PATH][0])
+            if ours > floor:
+                out[STATE_LAST_PATH] = str(ours)
+                floor = ours
+            else:
+                ctx["cursor_rollback_prevented"] = {"attempted": ours, "floor": floor}
+
+        if STATE_INPROGRESS_PATH in changes and _int_or_zero(heads[STATE_INPROGRESS_PATH]):
+            out[STATE_INPROGRESS_PATH] = changes[STATE_INPROGRESS_PATH][0]
+
+        if STATE_PENDING_PATH in changes:
+            orig = pending_queue.parse(ctx.get("state_pending_orig"))
+            ours = ctx.get("pending_schedule") or {}
+            merged = pending_queue.parse(heads[STATE_PENDING_PATH])
+            for k in set(orig) - set(ours):
+                merged.pop(k, None)  # processed / dropped by this run
+            for k, v in ours.items():
+                if [int(x) for x in orig.get(k) or []] != [int(x) for x in v]:
+                    merged[k] = v  # added or re-scheduled by this run
+            ctx["pending_schedule"] = merged
+            ctx["pending_list"] = pending_queue.ids_of(merged)
+            body = pending_queue.dump(ctx["pending_list"], merged)
+            if body.strip() != heads[STATE_PENDING_PATH].strip():
+                out[STATE_PENDING_PATH] = body
+
+        if STATE_WEBHOOK_DONE_PATH in changes:
+            merged = set(webhook_queue.parse_done(heads[STATE_WEBHOOK_DONE_PATH]))
+            merged.update(int(i) for i in ctx.get("webhook_done") or [])
+            ctx["webhook_done"] = sorted(i for i in merged if i > floor)
+            body = webhook_queue.dump_done(ctx["webhook_done"])
+            if body.strip() != heads[STATE_WEBHOOK_DONE_PATH].strip():
+                out[STATE_WEBHOOK_DONE_PATH] = body
+
+        ctx["state_commit_rebuilt"] = sorted(out)
+        return out
+
+    return rebuild
+
+
+def _commit_state(store, ctx: dict, changes: dict):
+    """Write every changed state file at once: ONE commit on GitHub (Git Data API,
+    CAS on the ref), one transaction locally. Cursor and in_progress can no longer
+    be observed half-updated. `changes` is path -> (text, message note); a lost CAS
+    is retried with _rebuild_on_head."""
+    if not changes:
+        return
+    # Fencing: a run whose lease expired and was taken over must not write state.
+    token = ctx.get("run_lease_token")
+    try:
+        current = run_lease.is_current(token)
+    except Exception:
+        current = True
+    if not current:
+        ctx["error"] = f"Run lease lost (token {token} superseded); state not written"
+        ctx["state_commit_skipped"] = sorted(changes)
+        return
+    notes = [note for _, note in changes.values()]
+    statuses = store.write_many(
+        {path: text for path, (text, _) in changes.items()},
+        message="state: " + "; ".join(notes),
+        rebuild=_rebuild_on_head(ctx, changes),
     )
-    ctx["github_finalize_last_status"] = st_last
+    for path, st in statuses.items():
+        ctx[_STATUS_KEYS[path]] = st
+    ctx["state_commit_files"] = sorted(changes)
 
 
 def _worker_all_steps_ok(ctx: dict) -> bool:
@@ -142,69 +229,208 @@ def _worker_all_steps_ok(ctx: dict) -> bool:
     return True
 
 
+def _record_ack(ctx: dict):
+    doc_id = ctx.get("next_document_id")
+    doc_hash = ctx.get("doc_hash")
+    if not doc_id or not doc_hash or not dedupe_ledger.enabled():
+        return
+    wrj = ctx.get("worker_response_json") or {}
+    try:
+        dedupe_ledger.record_ack(int(doc_id), doc_hash, (wrj.get("status") or None))
+        ctx["dedupe_ledger_recorded"] = True
+    except Exception as e:
+        ctx["dedupe_ledger_error"] = str(e)
+
+
+def _webhook_done(ctx: dict, doc_id):
+    """Drop a processed (or draft-deferred) webhook pick from the queue."""
+    try:
+        ctx["webhook_queue_done"] = bool(webhook_queue.done(int(doc_id)))
+    except Exception as e:
+        ctx["webhook_queue_error"] = str(e)
+
+
+def stage_cursor(ctx: dict, new_id: int):
+    """Batch mode: move the in-memory cursor forward (never back) and remember the
+    highest id for the final write. The monotonic floor check against GitHub happens
+    once in flush_deferred_state via _advance_cursor."""
+    new_id = int(new_id)
+    try:
+        cur = int(ctx.get("last_processed_id") or 0)
+    except Exception:
+        cur = 0
+    ctx["last_processed_id"] = max(cur, new_id)
+    staged = ctx.get("state_cursor_staged")
+    ctx["state_cursor_staged"] = max(int(staged), new_id) if staged else new_id
+
+
+def _stage_state(ctx: dict, ack: bool, is_forward_draft: bool, is_pending_pick: bool):
+    """Batch mode counterpart of run(): same transitions, applied to ctx only.
+    is_pending_pick covers every pick that must not move the cursor (pending, webhook)."""
+    fwd_id = ctx.get("next_document_id")
+
+    if is_forward_draft and fwd_id:
+        stage_cursor(ctx, int(fwd_id))
+        ctx["state_clear_in_progress"] = True
+        ctx["github_finalize_last_status"] = "staged(draft deferred)"
+        ctx["github_finalize_clear_status"] = "staged"
+        return ctx
+
+    if is_pending_pick:
+        if ack:
+            ctx["state_clear_in_progress"] = True
+            ctx["github_finalize_clear_status"] = "staged"
+        else:
+            webhook = ctx.get("picked_by") == "webhook_queue"
+            ctx["github_finalize_clear_status"] = "kept(webhook_queue_not_acked)" if webhook else "kept(pending_not_acked)"
+        return ctx
+
+    doc_id = ctx.get("next_document_id") or ctx.get("in_progress_id")
+    if not ack or not doc_id:
+        ctx["github_finalize_clear_status"] = "skipped(no_ack_or_no_doc)"
+        return ctx  # skipped webhook-done ids were staged by step_02
+
+    stage_cursor(ctx, int(doc_id))
+    ctx["state_clear_in_progress"] = True
+    ctx["github_finalize_last_status"] = "staged"
+    ctx["github_finalize_clear_status"] = "staged"
+    return ctx
+
+
+def flush_deferred_state(ctx: dict):
+    """Write the state staged by a batch run: pending list, cursor and in_progress,
+    each at most once per batch instead of once per document."""
+    if ctx.get("skip_state_update"):
+        return ctx
+    store = get_store()
+    if store.check():
+        return ctx
+
+    changes: dict = {}
+    _pending_change(ctx, changes)
+
+    staged = ctx.get("state_cursor_staged")
+    if staged:
+        _advance_cursor(store, ctx, changes, int(staged), note=" (batch)")
+
+    _webhook_done_change(ctx, changes)
+
+    if ctx.get("state_clear_in_progress"):
+        changes[STATE_INPROGRESS_PATH] = ("0", "clear in_progress_id")
+        ctx["in_progress_id"] = 0
+
+    _commit_state(store, ctx, changes)
+    return ctx
+
+
+def flush_stopped_run(ctx: dict):
+    """Single run that stopped before this step (idle / error after step_02): still write
+    the pending schedule if the re-check changed it (backoff, drops), and move the cursor
+    past webhook-acked ids the forward scan stepped over. Otherwise a quiet period
+    re-checks the same drafts and re-skips the same ids on every run."""
+    if ctx.get("skip_state_update") or "state_pending_orig" not in ctx:
+        return ctx
+    store = get_store()
+    if store.check():
+        return ctx
+    changes: dict = {}
+    _pending_change(ctx, changes)
+    skipped = ctx.get("webhook_done_skipped")
+    if skipped:
+        _advance_cursor(store, ctx, changes, max(skipped), note=" (webhook done)")
+    _webhook_done_change(ctx, changes)
+    _commit_state(store, ctx, changes)
+    return ctx
+
+
 def run(ctx: dict):
-    token = os.getenv("GITHUB_TOKEN")
-    if not token:
-        ctx["error"] = "Missing env: GITHUB_TOKEN"
+    store = get_store()
+    store_err = store.check()
+    if store_err:
+        ctx["error"] = store_err
         return ctx
 
     skip_state_update = bool(ctx.get("skip_state_update"))
-    if skip_state_update:
+    # Batch mode still stages in memory (the loop needs the cursor to move);
+    # flush_deferred_state honours skip_state_update.
+    if skip_state_update and not ctx.get("defer_state_writes"):
         ctx["github_finalize_clear_status"] = "skipped(test_mode)"
         ctx["github_finalize_last_status"] = "skipped(test_mode)"
         return ctx
 
-    ack = _worker_all_steps_ok(ctx)
+    # "not modified" (step_06 dedupe ledger): the worker already acked this exact content.
+    ack = bool(ctx.get("worker_not_modified")) or _worker_all_steps_ok(ctx)
     ctx["github_finalize_ack"] = ack
+    if ack and not ctx.get("worker_not_modified"):
+        _record_ack(ctx)
 
     picked_by = ctx.get("picked_by")
     is_pending_pick = (picked_by == "pending_draft_ready")
     # A forward-scan doc that was a draft and got skipped by the worker → defer it.
     is_forward_draft = bool(ctx.get("worker_skipped_draft")) and picked_by == "normal_after_last_processed"
-
-    # ---- pending list maintenance ----
-    orig_pending = sorted({int(x) for x in (ctx.get("pending_list") or [])})
-    pending = set(orig_pending)
-    pending -= {int(x) for x in (ctx.get("pending_drops") or [])}  # voided/gone
+    # /webhook/sale pick: like a pending pick it never moves the cursor. A draft goes to
+    # the pending schedule; either way it leaves the webhook queue.
+    is_webhook_pick = (picked_by == "webhook_queue")
+    is_webhook_draft = is_webhook_pick and bool(ctx.get("worker_skipped_draft"))
+
+    # ---- pending schedule maintenance ----
+    schedule = ctx.get("pending_schedule")
+    if not isinstance(schedule, dict):
+        schedule = {str(int(x)): [0, 0] for x in (ctx.get("pending_list") or [])}
+        ctx["pending_schedule"] = schedule
+    for x in ctx.get("pending_drops") or []:
+        schedule.pop(str(int(x)), None)  # voided/gone
+    ctx["pending_drops"] = []
 
     fwd_id = ctx.get("next_document_id")
     if is_forward_draft and fwd_id:
-        pending.add(int(fwd_id))  # remember the deferred draft
+        pending_queue.add(schedule, int(fwd_id))  # remember the deferred draft (first re-check after backoff)
     if is_pending_pick and ack and fwd_id:
-        pending.discard(int(fwd_id))  # processed successfully → stop tracking
-
-    new_pending = sorted(pending)
-    if new_pending != orig_pending:
-        body = ("\n".join(str(i) for i in new_pending) + "\n") if new_pending else ""
-        _, st_pend, _ = _github_put_text(
-            token,
-            STATE_PENDING_PATH,
-            body,
-            message=f"state: pending_draft_ids -> {new_pending}",
-        )
-        ctx["github_finalize_pending_status"] = st_pend
+        schedule.pop(str(int(fwd_id)), None)  # processed successfully → stop tracking
+    if is_webhook_draft and fwd_id:
+        pending_queue.add(schedule, int(fwd_id))
+    ctx["pending_list"] = pending_queue.ids_of(schedule)
+    if is_webhook_pick and fwd_id and (ack or is_webhook_draft):
+        _webhook_done(ctx, fwd_id)
+        _mark_webhook_done(ctx, fwd_id)
+
+    if ctx.get("defer_state_writes"):
+        # a deferred webhook draft is finished for this run: clear in_progress like an ack
+        return _stage_state(ctx, ack or is_webhook_draft, is_forward_draft, is_pending_pick or is_webhook_pick)
+
+    changes: dict = {}
+    _pending_change(ctx, changes)
 
     # ---- cursor rules ----
     # Forward draft: advance the cursor PAST it (never block the queue). The doc is now
     # tracked in pending and will be processed once it books. (Monotonic: only forward.)
     if is_forward_draft and fwd_id:
-        _advance_cursor(token, ctx, int(fwd_id), note=" (draft deferred)")
-        _, st_clear, _ = _github_put_text(
-            token, STATE_INPROGRESS_PATH, "0", message="state: clear in_progress_id"
-        )
-        ctx["github_finalize_clear_status"] = st_clear
+        _advance_cursor(store, ctx, changes, int(fwd_id), note=" (draft deferred)")
+        changes[STATE_INPROGRESS_PATH] = ("0", "clear in_progress_id")
+        _webhook_done_change(ctx, changes)
+        _commit_state(store, ctx, changes)
         return ctx
 
     # Pending doc: NEVER touch the forward cursor (its id is already behind it).
     if is_pending_pick:
         if ack:
-            _, st_clear, _ = _github_put_text(
-                token, STATE_INPROGRESS_PATH, "0",
-                message="state: clear in_progress_id (pending processed)",
-            )
-            ctx["github_finalize_clear_status"] = st_clear
+            changes[STATE_INPROGRESS_PATH] = ("0", "clear in_progress_id (pending processed)")
         else:
             ctx["github_finalize_clear_status"] = "kept(pending_not_acked)"
+        _webhook_done_change(ctx, changes)
+        _commit_state(store, ctx, changes)
+        return ctx
+
+    # Webhook doc: NEVER touch the forward cursor either; the id may be ahead of
+    # documents the forward scan hasn't processed yet (monotonic cursor stays intact).
+    if is_webhook_pick:
+        if ack or is_webhook_draft:
+            note = "webhook draft deferred" if is_webhook_draft else "webhook processed"
+            changes[STATE_INPROGRESS_PATH] = ("0", f"clear in_progress_id ({note})")
+        else:
+            ctx["github_finalize_clear_status"] = "kept(webhook_queue_not_acked)"
+        _webhook_done_change(ctx, changes)
+        _commit_state(store, ctx, changes)
         return ctx
 
     # Normal booked forward doc: advance cursor on ack. Prefer the freshly-picked
@@ -213,16 +439,17 @@ def run(ctx: dict):
     doc_id = ctx.get("next_document_id") or ctx.get("in_progress_id")
     if not ack or not doc_id:
         ctx["github_finalize_clear_status"] = "skipped(no_ack_or_no_doc)"
+        skipped = ctx.get("webhook_done_skipped")
+        if skipped:
+            # the ids step_02 stepped over were acked via the webhook queue
+            _advance_cursor(store, ctx, changes, max(skipped), note=" (webhook done)")
+        _webhook_done_change(ctx, changes)
+        _commit_state(store, ctx, changes)
         return ctx
 
-    _advance_cursor(token, ctx, int(doc_id), note="")
-
-    _, st_clear, _ = _github_put_text(
-        token,
-        STATE_INPROGRESS_PATH,
-        "0",
-        message="state: clear in_progress_id",
-    )
-    ctx["github_finalize_clear_status"] = st_clear
+    _advance_cursor(store, ctx, changes, int(doc_id), note="")
+    changes[STATE_INPROGRESS_PATH] = ("0", "clear in_progress_id")
+    _webhook_done_change(ctx, changes)
+    _commit_state(store, ctx, changes)
 
     return ctx